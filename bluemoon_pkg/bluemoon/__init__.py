@@ -1,17 +1,72 @@
+import os
 import glob
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
-def get_aggregate_data(path):
+# pandas is only imported by the functions that read exports, so that
+# importing bluemoon (eg. for add --help, or to query a snapshot) is fast
+
+def get_cache_dir():
+    """
+    Where bluemoon keeps derived data that can always be rebuilt;
+    set BLUEMOON_CACHE_DIR to override
+    """
+    return os.environ.get("BLUEMOON_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "bluemoon"))
+
+def _read_csv_options(usecols, dtype, names=None):
+    options = dict()
+    if names is not None:
+        # Exports without a header line
+        options.update(header=None, names=names)
+    if usecols is not None:
+        # Tolerate exports that lack some of the expected columns
+        columns = set(usecols)
+        options["usecols"] = lambda column: column in columns
+    if dtype is not None:
+        options["dtype"] = dtype
+    return options
+
+def find_datafiles(path):
+    """
+    The files matching path, a pattern or a list of them, in order
+    """
+    patterns = [path] if isinstance(path, str) else path
+    return sorted(set(datafile for pattern in patterns for datafile in glob.glob(pattern)))
+
+def get_aggregate_data(path, usecols=None, dtype=None, max_workers=None, names=None):
     """
     path: Expected to be either a file or set of files,
-          eg. "../../dirname/*.csv"
+          eg. "../../dirname/*.csv", or a list of them
+    usecols, dtype: Optionally passed on to pandas.read_csv,
+          eg. from DataSource.get_columns() and DataSource.get_dtypes()
+    names: The column names of files without a header line
+    max_workers: Size of the thread pool the files are read with
     return pandas DataFrame
     """
 
-    result = None
-    for datafile in glob.glob(path):
-        if result is None:
-            result = pd.read_csv(datafile)
-        else:
-            result = result.append(pd.read_csv(datafile))
-    return result
+    import pandas as pd
+
+    datafiles = find_datafiles(path)
+    if not datafiles:
+        return None
+
+    options = _read_csv_options(usecols, dtype, names)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(lambda datafile: pd.read_csv(datafile, **options), datafiles))
+    # Concatenate once, rather than growing the result file by file
+    return pd.concat(frames)
+
+def iter_aggregate_data(path, chunksize=100000, usecols=None, dtype=None, names=None):
+    """
+    Same as get_aggregate_data, but yields DataFrames of at most chunksize
+    rows, file by file, so that large exports are never fully in memory;
+    names are the column names of files without a header line
+    """
+
+    import pandas as pd
+
+    options = _read_csv_options(usecols, dtype, names)
+    for datafile in find_datafiles(path):
+        with pd.read_csv(datafile, chunksize=chunksize, **options) as reader:
+            for chunk in reader:
+                yield chunk
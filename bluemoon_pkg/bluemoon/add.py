@@ -1,45 +1,176 @@
-import json
 import argparse
+import cProfile
+import pstats
+import json
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from .models import Dataset, Day, AllData
 from .data_sources import DataSource
+from .instrument import stage, listening, Timings
+from .parse_cache import ParseCache
 from . import get_aggregate_data
 
 
-def bmdb_add_data(db_target, data_source, data, description):
+def _build_dataset(data_source, data, parse_cache, sync_cursor, scrobble_store):
+    # Runs in a worker process, so the advanced cursor is sent back
+    return data_source.build_dataset(data, parse_cache=parse_cache, sync_cursor=sync_cursor,
+        scrobble_store=scrobble_store), sync_cursor
+
+
+def bmdb_add_batch(db_target, sources, description, max_workers=None, parse_cache=None,
+        scrobble_store=None):
+    """
+    sources: (data_source, data) pairs, ingested together: the database is
+    loaded and saved once, analyses run once over all the new data, and
+    each source gets its own changelog entry. With several sources, they
+    are parsed in parallel worker processes; with one, max_workers
+    processes share its parsing and analyses. Given a ParseCache, files
+    parsed by earlier runs are taken from it (see DataSource.build_dataset).
+    Sources synced from an API keep their cursor in meta["sync_cursors"],
+    saved with the data they fetched. Given scrobble_store (a path), raw
+    Last.fm scrobbles are kept there, besides their per-day aggregates.
+    Returns the number of updates per source.
+    """
 
-    all_data = AllData.build(db_target)
+    with stage("bmdb_add_data", sources=len(sources)) as s:
+        # Only the days touched by the new data are materialized
+        all_data = AllData.build(db_target, lazy=True)
 
-    # First build the dataset without overwriting
-    ds = data_source.build_dataset(data, base_dataset=all_data.dataset)
-    ds.set_ready(True)
+        sync_cursors = [dict(all_data.meta.get("sync_cursors", {}).get(str(data_source), {})) \
+            for data_source, _ in sources]
+        with stage("build_datasets", sources=len(sources)):
+            if len(sources) == 1:
+                datasets = [sources[0][0].build_dataset(sources[0][1], base_dataset=all_data.dataset,
+                    workers=max_workers, parse_cache=parse_cache, sync_cursor=sync_cursors[0],
+                    scrobble_store=scrobble_store)]
+            else:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    datasets, sync_cursors = zip(*executor.map(_build_dataset, *zip(*sources),
+                        [parse_cache] * len(sources), sync_cursors, [scrobble_store] * len(sources)))
+
+        n_updates = apply_datasets(all_data, sources, datasets, description, sync_cursors,
+            workers=max_workers if len(sources) == 1 else None)
+        all_data.save()
+        s.set(updates=sum(n_updates))
+    return n_updates
 
-    n_updates = all_data.update(ds, description=description)
 
-    all_data.set_serializable_field(str(data_source))
-    with open(db_target, 'w', encoding='utf-8') as f:
-        json.dump(all_data.as_dict(), f, ensure_ascii=False, indent=4)
+def apply_datasets(all_data, sources, datasets, description, sync_cursors=None, workers=None):
+    """
+    Merge the datasets built from sources ((data_source, data) pairs) into
+    all_data, in a single AllData.update_batch, and mark their fields to
+    be stored; does not save. Returns the number of updates per source.
+    """
+    # Per-day fields a source sets directly (eg. *exist_steps), as
+    # opposed to those its analyses derive, are stored with it
+    imported_fields = [set(k for d in ds.days.values() for k in d.data \
+        if k.startswith(str(data_source) + "_")) for (data_source, _), ds in zip(sources, datasets)]
+    if description and len(sources) > 1:
+        descriptions = ["%s [%s %s]"%(description, data_source, data_source.redacted(data)) \
+            for data_source, data in sources]
+    else:
+        descriptions = [description] * len(sources)
+    with stage("AllData.update", days=sum(len(ds.days) for ds in datasets)):
+        n_updates = all_data.update_batch(datasets, descriptions, workers=workers)
+
+    for (data_source, data), sync_cursor, field_names in zip(sources,
+            sync_cursors or [None] * len(sources), imported_fields):
+        all_data.set_serializable_field(str(data_source))
+        for field_name in field_names:
+            all_data.set_serializable_field(field_name)
+        if sync_cursor:
+            all_data.meta.setdefault("sync_cursors", {})[str(data_source)] = sync_cursor
     return n_updates
 
 
+def add_description(args, sources):
+    """
+    The changelog description of a run with command line args, adding
+    sources; secrets given as data (see DataSource.redacted) are masked
+    """
+    description = ".add %s"%" ".join(args)
+    for data_source, data in sources:
+        if data_source.redacted(data) != data:
+            description = description.replace(data, data_source.redacted(data))
+    return description
+
+
+def bmdb_add_data(db_target, data_source, data, description, parse_cache=None):
+    """
+    Every step is timed as an instrument.stage; see instrument.add_listener
+    """
+    return bmdb_add_batch(db_target, [(data_source, data)], description, parse_cache=parse_cache)[0]
+
+
+def read_manifest(path):
+    """
+    A JSON list of {"data_source": ..., "data": ...} objects
+    """
+    with open(path) as f:
+        return [(DataSource(entry["data_source"]), entry["data"]) for entry in json.load(f)]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
           formatter_class=argparse.RawDescriptionHelpFormatter,
           epilog=DataSource.all_help())
 
     parser.add_argument('db_target', type=str, help="Please specify a valid filename; if nonexistent, will be created.")
-    parser.add_argument('--data_source', type=DataSource, choices=list(DataSource), help="Please use of one the available data source types.")
-    parser.add_argument('--data', '-d', type=str, help="Must conform to expected data source data formatting")
+    parser.add_argument('--data_source', type=DataSource, choices=list(DataSource), action='append', default=[],
+        help="Please use of one the available data source types. Repeat with --data to add several sources at once.")
+    parser.add_argument('--data', '-d', type=str, action='append', default=[],
+        help="Must conform to expected data source data formatting")
+    parser.add_argument('--manifest', type=str, default=None,
+        help='JSON list of {"data_source": ..., "data": ...} objects to add, in addition to any --data_source/--data pairs')
+    parser.add_argument('--workers', type=int, default=None,
+        help="Number of worker processes parsing sources in parallel, or sharing the parsing and analyses of a single source")
+    parser.add_argument('--parse_cache_mb', type=int, default=256,
+        help="Size of the cache of parsed files in the bluemoon cache dir, so unchanged exports are not parsed again; 0 turns it off")
+    parser.add_argument('--scrobble_store', type=str, default=None,
+        help="SQLite file to keep raw Last.fm scrobbles in; by default only their per-day aggregates are kept")
     parser.add_argument('--meta', '-m', type=str, help="Must conform to expected data source meta formatting")
     parser.add_argument('--silent', '-s', action='store_true', default=False,
         help="Flag that optionally turns off changelog saves")
+    parser.add_argument('--timings', action='store_true', default=False,
+        help="Flag that prints a per-stage time breakdown, with row and day counts")
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='STATS_FILE',
+        help="Run under cProfile and print the top functions, or dump the stats to STATS_FILE; implies --timings")
 
     opts = parser.parse_args()
-    n_updates = bmdb_add_data(
-        db_target=opts.db_target,
-        data_source=opts.data_source,
-        data=opts.data,
-        description=".add %s"%" ".join(sys.argv[1:]) if not opts.silent else None
-    )
-    print("Registered", n_updates, "updates")
+    if len(opts.data_source) != len(opts.data):
+        parser.error("Every --data_source needs exactly one --data")
+    sources = list(zip(opts.data_source, opts.data))
+    if opts.manifest:
+        sources += read_manifest(opts.manifest)
+
+    profiler = cProfile.Profile() if opts.profile is not None else None
+    timings = Timings()
+    with listening(timings):
+        if profiler:
+            profiler.enable()
+        if sources:
+            n_updates = bmdb_add_batch(
+                db_target=opts.db_target,
+                sources=sources,
+                description=add_description(sys.argv[1:], sources) if not opts.silent else None,
+                max_workers=opts.workers,
+                parse_cache=ParseCache(max_bytes=opts.parse_cache_mb << 20) if opts.parse_cache_mb else None,
+                scrobble_store=opts.scrobble_store
+            )
+        else:
+            # Only sets up the database, if it does not exist yet
+            AllData.build(opts.db_target)
+            n_updates = []
+        if profiler:
+            profiler.disable()
+    print("Registered", sum(n_updates), "updates")
+
+    if opts.timings or profiler:
+        timings.report()
+    if profiler:
+        if opts.profile:
+            profiler.dump_stats(opts.profile)
+            print("Profile written to", opts.profile, file=sys.stderr)
+        else:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(25)
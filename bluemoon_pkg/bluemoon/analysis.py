@@ -1,17 +1,32 @@
+import heapq
+import numpy as np
+import pandas as pd
+
+# Fields every day has from its date alone; they describe the calendar,
+# not the day, so they are not features
+CALENDAR_FIELDS = ["day_dt", "day_str", "moon", "weekday_str", "weekday_num", "season",
+    "availability", "days_before"]
+
+
 def get_top_K(count_dict, max_items=7, verbose=True, hide_shadowed=False):
-    count_dict_ = dict(sorted(count_dict.items(), key=lambda item: item[1], reverse=True))
+    """
+    Keys of the max_items largest values. With hide_shadowed, a key that
+    contains (or is contained in) one already selected does not take a
+    place of its own; the shorter of the two is kept.
+    """
+    if not hide_shadowed and not verbose:
+        return set(heapq.nlargest(max_items, count_dict, key=count_dict.get))
+
     top_K = set()
-    for k, v in count_dict_.items():
+    for k, v in sorted(count_dict.items(), key=lambda item: item[1], reverse=True):
         if verbose:
             print(k, v)
         if hide_shadowed:
-            found = None
-            for selected_term in top_K:
-                if selected_term in k or k in selected_term:
-                    found = selected_term
+            # Only the selected terms (at most max_items) are compared
+            found = next((t for t in top_K if t in k or k in t), None)
             if found:
-                if len(k) < len(selected_term):
-                    top_K.remove(selected_term)
+                if len(k) < len(found):
+                    top_K.remove(found)
                     top_K.add(k)
                 continue
         max_items -= 1
@@ -21,20 +36,221 @@ def get_top_K(count_dict, max_items=7, verbose=True, hide_shadowed=False):
     return top_K
 
 
-def prioritize_columns(df, max_items=7, cutoff=None):
-    priority_by_column = dict()
+def _max_repetition(X):
+    """
+    Per column of X, how many times its most common (non-NaN) value occurs
+    """
+    X = np.sort(X, axis=0)
+    n, m = X.shape
+    if n == 0:
+        return np.zeros(m, dtype=np.int64)
+    # Positions where a run of equal values starts, per column
+    starts = np.ones(X.shape, dtype=bool)
+    starts[1:] = X[1:] != X[:-1]
+    starts &= ~np.isnan(X)
+    run_ids = np.cumsum(starts, axis=0)
+    counts = np.zeros(m, dtype=np.int64)
+    for j in range(m):
+        valid = ~np.isnan(X[:, j])
+        if valid.any():
+            counts[j] = np.bincount(run_ids[valid, j]).max()
+    return counts
 
-    for column, dtype in df.dtypes.items():
-        if dtype == "int64":
-            repetition = False
-            item_counts = df[column].value_counts()
-            for k, v in item_counts.items():
-                if cutoff and v > cutoff:
-                    repetition = Tru
-            if repetition:
-                print("Excluding", column, "due to repetition", repetition)
-                # Rather than filter, use weighting
-                continue
-            priority_by_column[column] = df[column].std() / oura_data[column].mean()
 
-    return get_top_K(priority_by_column, max_items)
+def numeric_columns(df, exclude=CALENDAR_FIELDS):
+    return [c for c, dtype in df.dtypes.items() if c not in exclude and \
+        (pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype))]
+
+
+def _as_matrix(df, columns, dtype=np.float64):
+    X = np.empty((len(df), len(columns)), dtype=dtype)
+    for j, c in enumerate(columns):
+        X[:, j] = df[c].to_numpy(dtype=np.float64, na_value=np.nan)
+    return X
+
+
+def _column_moments(df, columns, cutoff=None):
+    # (repetition, std, mean) of the columns of df; repetition only given a cutoff
+    X = _as_matrix(df, columns)
+    with np.errstate(invalid='ignore'):
+        return (_max_repetition(X) if cutoff else None), np.nanstd(X, axis=0, ddof=1), \
+            np.nanmean(X, axis=0)
+
+
+def prioritize_columns(df, max_items=7, cutoff=None, stats=None):
+    """
+    Numeric columns (other than CALENDAR_FIELDS, see numeric_columns)
+    with the largest coefficient of variation; columns where any value
+    repeats more than cutoff times are excluded. Given a StatsCache
+    (AllData.statistics()), its fields are ranked from it instead, and df
+    is only needed for the fields it does not count (eg. *toggl_duration,
+    which analyses derive).
+    """
+    if stats is not None:
+        columns = [c for c in stats.fields if c not in CALENDAR_FIELDS]
+        repetition = np.array([stats.fields[c].max_repetition for c in columns], dtype=np.int64)
+        std = np.array([stats.fields[c].std for c in columns])
+        mean = np.array([stats.fields[c].mean for c in columns])
+        missing = [c for c in numeric_columns(df) if c not in stats.fields] if df is not None else []
+        if missing:
+            missing_repetition, missing_std, missing_mean = _column_moments(df, missing, cutoff)
+            columns = columns + missing
+            if cutoff:
+                repetition = np.concatenate([repetition, missing_repetition])
+            std, mean = np.concatenate([std, missing_std]), np.concatenate([mean, missing_mean])
+    else:
+        columns = numeric_columns(df)
+        repetition, std, mean = _column_moments(df, columns, cutoff)
+    if cutoff:
+        for column, count in zip(columns, repetition):
+            if count > cutoff:
+                print("Excluding", column, "due to repetition", count)
+        keep = repetition <= cutoff
+        columns, std, mean = [c for c, k in zip(columns, keep) if k], std[keep], mean[keep]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variation = std / mean
+    priority_by_column = {c: v for c, v in zip(columns, variation) if np.isfinite(v)}
+    return get_top_K(priority_by_column, max_items, verbose=False)
+
+
+def feature_matrix(df, columns=None, min_availability=0.05, stats=None):
+    """
+    Standardized day x feature matrix (float32): each column is centered
+    on its mean and scaled by its standard deviation, with missing values
+    at 0. Columns are weighted by the share of days they are available on
+    (scaled by its square root, so squared distances are weighted by it);
+    those available on fewer than min_availability of days, or constant,
+    are left out. Given a StatsCache, the means, standard deviations and
+    availability of all days are taken from it, rather than from df, for
+    the fields it counts. Returns (X, weights, columns, observed).
+    """
+    columns = numeric_columns(df) if columns is None else list(columns)
+    X = _as_matrix(df, columns, dtype=np.float32)
+    observed = ~np.isnan(X)
+    np.copyto(X, 0, where=~observed)
+
+    n_observed = observed.sum(axis=0)
+    availability = n_observed / max(len(X), 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = X.sum(axis=0, dtype=np.float64) / n_observed
+        std = np.sqrt(np.maximum(np.einsum('ij,ij->j', X, X, dtype=np.float64) / n_observed \
+            - mean * mean, 0))
+    if stats is not None:
+        # Fields the cache does not count (eg. those analyses derive) keep
+        # the moments of df; the standard deviation is that of all values,
+        # as above, so the same days give the same matrix
+        for j, c in enumerate(columns):
+            f = stats.fields.get(c)
+            if f is not None and f.n:
+                availability[j] = stats.availability(c)
+                mean[j] = f.mean
+                std[j] = np.sqrt(f.m2 / f.n)
+    keep = (availability >= min_availability) & (std > 1e-6 * np.abs(mean)) & (std > 0)
+
+    if not keep.all():
+        X, observed = X[:, keep], observed[:, keep]
+    mean, std, availability = mean[keep], std[keep], availability[keep]
+    X -= mean.astype(np.float32)
+    X *= (np.sqrt(availability) / std).astype(np.float32)
+    np.copyto(X, 0, where=~observed)
+    return X, availability, [c for c, k in zip(columns, keep) if k], observed
+
+
+def _squared_distances(X, centers, squared_norms):
+    d = squared_norms[:, None] - 2 * (X @ centers.T) + np.einsum('ij,ij->i', centers, centers)
+    return np.maximum(d, 0)
+
+
+def kmeans(X, n_clusters=8, n_iter=20, sample_size=4096, seed=0):
+    """
+    k-means with k-means++ seeding, fitted on a random sample of at most
+    sample_size rows and then applied to all of them; returns (centers,
+    labels, squared distances of every row to every center)
+    """
+    n = len(X)
+    rng = np.random.default_rng(seed)
+    sample = X[np.sort(rng.choice(n, sample_size, replace=False))] if n > sample_size else X
+    m = len(sample)
+    n_clusters = max(1, min(n_clusters, m))
+    squared_norms = np.einsum('ij,ij->i', sample, sample)
+
+    centers = sample[[rng.integers(m)]]
+    closest = _squared_distances(sample, centers, squared_norms)[:, 0]
+    for _ in range(1, n_clusters):
+        total = closest.sum(dtype=np.float64)
+        i = rng.choice(m, p=closest / total) if total > 0 else rng.integers(m)
+        centers = np.vstack([centers, sample[i]])
+        closest = np.minimum(closest, _squared_distances(sample, sample[[i]], squared_norms)[:, 0])
+
+    labels = None
+    for _ in range(n_iter):
+        new_labels = _squared_distances(sample, centers, squared_norms).argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=len(centers))
+        one_hot = np.zeros((m, len(centers)), dtype=sample.dtype)
+        one_hot[np.arange(m), labels] = 1
+        sums = one_hot.T @ sample
+        # An empty cluster keeps its center
+        nonempty = counts > 0
+        centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    d = _squared_distances(X, centers, np.einsum('ij,ij->i', X, X))
+    return centers, d.argmin(axis=1), d
+
+
+def exceptional_days(df, n_clusters=8, columns=None, max_features=None, threshold=3.5,
+        min_share=0.05, n_reasons=3, seed=0, stats=None):
+    """
+    Score how exceptional each day is: days are clustered on the weighted,
+    standardized feature matrix (see feature_matrix), and a day's score is
+    its distance to the nearest center of a large cluster (one with at
+    least min_share of the days), per feature observed that day; days in
+    small clusters are thereby measured against the usual days. Days
+    scoring more than threshold robust deviations above the median are
+    exceptional.
+
+    df is a Dataset.asDataFrame() frame; max_features limits the features
+    to those of prioritize_columns. Given stats (AllData.statistics()),
+    both read the per field statistics from it. Returns a DataFrame with
+    day_str, score, cluster, exceptional and, for exceptional days,
+    reasons (the features that set the day most apart), in the order of df.
+    """
+    if columns is None and max_features:
+        columns = sorted(prioritize_columns(df, max_items=max_features, stats=stats))
+    X, weights, columns, observed = feature_matrix(df, columns, stats=stats)
+    n = len(X)
+    if n == 0 or X.shape[1] == 0:
+        return pd.DataFrame(dict(day_str=df["day_str"].to_numpy() if "day_str" in df else [],
+            score=np.zeros(n), cluster=np.zeros(n, dtype=np.int64),
+            exceptional=np.zeros(n, dtype=bool), reasons=[[] for _ in range(n)]))
+
+    centers, labels, distances = kmeans(X, n_clusters=n_clusters, seed=seed)
+    share = np.bincount(labels, minlength=len(centers)) / n
+    large = np.flatnonzero(share >= min(min_share, share.max()))
+    nearest = large[distances[:, large].argmin(axis=1)]
+    # Days with fewer observed features are not less exceptional
+    observed_weight = np.maximum(observed @ weights, 1e-9) / weights.sum()
+    score = np.sqrt(distances[np.arange(n), nearest] / observed_weight)
+
+    median = np.median(score)
+    spread = 1.4826 * np.median(np.abs(score - median)) or score.std() or 1.0
+    exceptional = (score - median) / spread > threshold
+
+    reasons = [[] for _ in range(n)]
+    rows = np.flatnonzero(exceptional)
+    n_reasons = min(n_reasons, len(columns))
+    if len(rows) and n_reasons:
+        deviation = np.abs(X[rows] - centers[nearest[rows]])
+        top = np.argsort(-deviation, axis=1)[:, :n_reasons]
+        for i, row in zip(rows, top):
+            reasons[i] = [columns[j] for j in row]
+
+    return pd.DataFrame(dict(
+        day_str=df["day_str"].to_numpy(),
+        score=score,
+        cluster=labels,
+        exceptional=exceptional,
+        reasons=reasons
+    ))
@@ -0,0 +1,322 @@
+# Benchmark suite
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import pandas as pd
+from datetime import datetime, timedelta
+
+from . import get_aggregate_data, lastfm
+from .data_sources import DataSource
+from .models import AllData, Dataset, as_serializable
+from .storage import get_storage
+from .analysis import exceptional_days, numeric_columns
+
+PROJECTS = ["Wage Labor", "Voice / German", "TBC", "Reading", "Side Project"]
+TAGS = ["code", "learning", "collaboration", "admin", ""]
+DESCRIPTIONS = ["Office", "React", "LL A2.2 Class", "Lost Mail", "Review", "Planning"]
+ARTISTS = ["Artist %d"%i for i in range(500)]
+START = datetime(2010, 1, 1)
+
+
+def synthetic_toggl(n_days, records_per_day=8, start=START, seed=0):
+    """
+    A Toggl detailed export as a DataFrame, records_per_day rows for each
+    of n_days days
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_days):
+        day = (start + timedelta(days=i)).strftime('%Y-%m-%d')
+        for j in range(records_per_day):
+            minutes = rng.randint(5, 120)
+            rows.append({
+                "User": "uname", "Email": "uname@notasite.com", "Client": None,
+                "Project": rng.choice(PROJECTS), "Task": None,
+                "Description": rng.choice(DESCRIPTIONS), "Billable": "No",
+                "Start date": day, "Start time": "%02d:%02d:00"%(8 + j, rng.randint(0, 59)),
+                "End date": day, "End time": "%02d:00:00"%(9 + j),
+                "Duration": "%02d:%02d:00"%(minutes // 60, minutes % 60),
+                "Tags": rng.choice(TAGS) or None, "Amount ()": None
+            })
+    return pd.DataFrame(rows, columns=list(rows[0].keys())).astype(
+        DataSource.toggl.get_dtypes())
+
+
+def synthetic_oura(n_days, start=START, seed=0):
+    """
+    An Oura export as a DataFrame, one row per day
+    """
+    rng = random.Random(seed)
+    fields = list(dict.fromkeys(DataSource.oura.get_fields()))
+    rows = [dict(date=(start + timedelta(days=i)).strftime('%Y-%m-%d'),
+        **{f: rng.randint(0, 100) for f in fields}) for i in range(n_days)]
+    return pd.DataFrame(rows)
+
+
+def write_synthetic_lastfm(path, n_scrobbles, n_days, start=START, seed=0):
+    """
+    A Last.fm scrobble export (artist, album, track, date; no header),
+    written row by row so millions of scrobbles need no memory
+    """
+    rng = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for i in range(n_scrobbles):
+            played = start + timedelta(minutes=rng.randrange(n_days * 24 * 60))
+            artist = rng.choice(ARTISTS)
+            writer.writerow([artist, "%s album %d"%(artist, rng.randrange(5)),
+                "Track %d"%rng.randrange(20), played.strftime('%d %b %Y %H:%M')])
+
+
+def synthetic_worklog(n_days, start=START, seed=0):
+    rng = random.Random(seed)
+    return {
+        "comments": "Synthetic worklog",
+        "first_day": start.strftime('%Y-%m-%d'),
+        "last_day": (start + timedelta(days=n_days - 1)).strftime('%Y-%m-%d'),
+        "working_days": "MTWRF",
+        "working_hours": 8,
+        "exceptions": {(start + timedelta(days=rng.randrange(n_days))).strftime('%Y-%m-%d'): \
+            rng.randint(0, 8) for i in range(n_days // 30)}
+    }
+
+
+def generate(directory, years=10, scrobbles=100000, seed=0):
+    """
+    Write synthetic exports for every supported source into directory:
+    monthly Toggl csvs, an Oura csv, a Last.fm csv and a worklog json.
+    Returns the data paths by source, as passed to --data.
+    """
+    n_days = int(round(365.25 * years))
+    toggl_dir = os.path.join(directory, "toggl")
+    os.makedirs(toggl_dir, exist_ok=True)
+    toggl = synthetic_toggl(n_days, seed=seed)
+    for month, rows in toggl.groupby(toggl["Start date"].str[:7]):
+        rows.to_csv(os.path.join(toggl_dir, "%s.csv"%month), index=False)
+
+    synthetic_oura(n_days, seed=seed).to_csv(os.path.join(directory, "oura.csv"), index=False)
+    write_synthetic_lastfm(os.path.join(directory, "lastfm.csv"), scrobbles, n_days, seed=seed)
+    with open(os.path.join(directory, "worklog.json"), 'w') as f:
+        json.dump(synthetic_worklog(n_days, seed=seed), f, indent=1)
+
+    return {
+        DataSource.toggl: os.path.join(toggl_dir, "*.csv"),
+        DataSource.oura: os.path.join(directory, "oura.csv"),
+        DataSource.lastfm: os.path.join(directory, "lastfm.csv"),
+        DataSource.worklog: os.path.join(directory, "worklog.json"),
+    }
+
+
+def _copy_str(value):
+    # A new string object with the same content, as parsing json would make
+    return (value + ".")[:-1] if type(value) == str else value
+
+
+class _PlainDay:
+    """
+    A day as it was stored before Day had __slots__ and records were tuples
+    """
+
+    def __init__(self, day):
+        self.day_as_dt = day.day_as_dt
+        self.day_as_str = _copy_str(day.day_as_str)
+        self.data = {_copy_str(k): v for k, v in day.data.items()}
+        self.cumulative = {k: [{_copy_str(f): _copy_str(v) for f, v in as_serializable(r).items()} \
+            for r in vs] for k, vs in day.cumulative.items()}
+
+
+def _traced(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def benchmark_memory(directory, n_days=3650, records_per_day=8):
+    """
+    Memory held by a decade of Toggl days as AllData.build loads them from
+    storage: compact Day and Record objects, against plain objects with a
+    dict per record
+    """
+    ds = Dataset()
+    for d in DataSource.toggl.build_days(synthetic_toggl(n_days, records_per_day)):
+        ds.add(d, overwrite_fields=[])
+    db_target = os.path.join(directory, "memory.json")
+    all_data = AllData(storage=get_storage(db_target))
+    all_data.update(ds, description="benchmark")
+    all_data.save(days_affected=None)
+    del ds, all_data
+    # Only the days are kept, not the text index or statistics loaded with them
+    days, compact = _traced(lambda: AllData.build(db_target).dataset.days)
+    plain_days, plain = _traced(lambda: [_PlainDay(d) for d in days.values()])
+    return dict(
+        name="memory",
+        days=n_days,
+        records=n_days * records_per_day,
+        compact_bytes=compact,
+        plain_bytes=plain,
+        reduction=round(1 - compact / plain, 3)
+    )
+
+
+def measure(name, fn, memory=True, **counts):
+    """
+    Wall time of fn(), and with memory=True the peak traced memory of a
+    second, separate run (tracing slows down the timed run otherwise).
+    Returns (fn's result, a result row)
+    """
+    start = time.perf_counter()
+    result = fn()
+    row = dict(name=name, seconds=round(time.perf_counter() - start, 4))
+    if memory:
+        tracemalloc.start()
+        fn()
+        row["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    row.update({k: v(result) if callable(v) else v for k, v in counts.items()})
+    return result, row
+
+
+def run(directory, years=10, scrobbles=100000, memory=True, seed=0):
+    """
+    Generate synthetic data in directory and time each stage of ingestion,
+    analysis, saving and loading; returns a JSON-serializable report
+    """
+    paths = generate(directory, years=years, scrobbles=scrobbles, seed=seed)
+    results = []
+    def timed(name, fn, **counts):
+        result, row = measure(name, fn, memory=memory, **counts)
+        results.append(row)
+        return result
+
+    toggl = DataSource.toggl
+    timed("get_aggregate_data.toggl", lambda: get_aggregate_data(paths[toggl],
+        usecols=toggl.get_columns(), dtype=toggl.get_dtypes()), rows=len)
+    timed("get_aggregate_data.lastfm", lambda: get_aggregate_data(paths[DataSource.lastfm],
+        names=lastfm.COLUMNS), rows=len)
+
+    datasets = []
+    for source in [DataSource.toggl, DataSource.oura, DataSource.lastfm, DataSource.worklog]:
+        datasets.append(timed("build_dataset.%s"%source.name,
+            lambda: source.build_dataset(paths[source]), days=lambda ds: len(ds.days)))
+
+    def merged():
+        ds = Dataset()
+        for other in datasets:
+            ds.update(other)
+        return ds
+    # One fresh dataset for each run, so merging is not part of the timing
+    not_ready = [merged(), merged()]
+    ds = merged()
+    timed("Dataset.set_ready", lambda: not_ready.pop().set_ready(True), days=len(ds.days))
+    ds.set_ready(True)
+    df = timed("Dataset.asDataFrame", ds.asDataFrame, days=len(ds.days))
+    timed("analysis.exceptional_days", lambda: exceptional_days(df), days=len(ds.days),
+        features=len(numeric_columns(df)))
+
+    db_target = os.path.join(directory, "bench.json")
+    all_data = AllData(storage=get_storage(db_target))
+    all_data.update(ds, description="benchmark")
+    timed("AllData.save", lambda: all_data.save(days_affected=None), days=len(ds.days))
+    timed("AllData.build", lambda: AllData.build(db_target), days=len(ds.days),
+        file_bytes=os.path.getsize(db_target))
+    timed("AllData.build.lazy", lambda: AllData.build(db_target, lazy=True), days=len(ds.days))
+    last_year = sorted(ds.days.keys())[-365]
+    timed("AllData.build.last_year", lambda: AllData.build(db_target, start=last_year),
+        days=lambda all_data: len(all_data.dataset.days))
+
+    compressed_target = os.path.join(directory, "bench.json.gz")
+    all_data.storage = get_storage(compressed_target, indent=None)
+    timed("AllData.save.compact_gzip", lambda: all_data.save(days_affected=None), days=len(ds.days))
+    timed("AllData.build.compact_gzip", lambda: AllData.build(compressed_target), days=len(ds.days),
+        file_bytes=os.path.getsize(compressed_target))
+
+    snapshot_target = os.path.join(directory, "bench.bmsnap")
+    all_data.storage = get_storage(snapshot_target)
+    timed("AllData.save.snapshot", lambda: all_data.save(days_affected=None), days=len(ds.days))
+    timed("AllData.build.snapshot", lambda: AllData.build(snapshot_target), days=len(ds.days),
+        file_bytes=os.path.getsize(snapshot_target))
+    timed("AllData.build.snapshot_lazy", lambda: AllData.build(snapshot_target, lazy=True),
+        days=len(ds.days))
+    timed("AllData.query.json", lambda: AllData.query(db_target, as_arrays=True), days=len(ds.days))
+    timed("AllData.query.snapshot", lambda: AllData.query(snapshot_target, as_arrays=True),
+        days=len(ds.days))
+
+    results.append(benchmark_memory(directory, min(len(ds.days), 3650)))
+    return dict(
+        meta=dict(
+            years=years,
+            scrobbles=scrobbles,
+            seed=seed,
+            python=platform.python_version(),
+            pandas=pd.__version__,
+            timestamp=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        ),
+        results=results
+    )
+
+
+def compare(before, after):
+    """
+    Per stage timings of two reports, with the speedup of after over before
+    """
+    before_rows = {row["name"]: row for row in before["results"]}
+    rows = []
+    for row in after["results"]:
+        previous = before_rows.get(row["name"])
+        if previous and previous.get("seconds") and row.get("seconds"):
+            rows.append(dict(
+                name=row["name"],
+                before=previous["seconds"],
+                after=row["seconds"],
+                speedup=round(previous["seconds"] / row["seconds"], 2)
+            ))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time bluemoon ingestion, analysis, save and load on synthetic data.")
+    parser.add_argument('--years', type=float, default=10,
+        help="Span of synthetic data, eg. 1 to 20 years")
+    parser.add_argument('--scrobbles', type=int, default=100000,
+        help="Number of synthetic Last.fm scrobbles")
+    parser.add_argument('--dir', type=str, default=None,
+        help="Where to write the synthetic data; a temporary directory by default")
+    parser.add_argument('--output', '-o', type=str, default=None,
+        help="Write the JSON report here instead of stdout")
+    parser.add_argument('--no_memory', action='store_true', default=False,
+        help="Flag that skips the peak memory runs")
+    parser.add_argument('--compare', type=str, default=None,
+        help="Earlier JSON report to print speedups against")
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    if opts.dir:
+        report = run(opts.dir, opts.years, opts.scrobbles, not opts.no_memory, opts.seed)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            report = run(directory, opts.years, opts.scrobbles, not opts.no_memory, opts.seed)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            for row in compare(json.load(f), report):
+                print("{name:<32} {before:>10} {after:>10} {speedup:>8}x".format(**row),
+                    file=sys.stderr)
@@ -0,0 +1,188 @@
+import argparse
+from datetime import date, datetime, timedelta
+
+
+def _ordinal(key):
+    return date.fromisoformat(key).toordinal()
+
+def _key(ordinal):
+    return date.fromordinal(ordinal).isoformat()
+
+
+def as_ranges(keys):
+    """
+    Day keys as a sorted list of [first, last] runs of consecutive days
+    """
+    ranges = []
+    for ordinal in sorted(set(_ordinal(k) for k in keys)):
+        if ranges and ranges[-1][1] == ordinal - 1:
+            ranges[-1][1] = ordinal
+        else:
+            ranges.append([ordinal, ordinal])
+    return [[_key(first), _key(last)] for first, last in ranges]
+
+def range_keys(ranges):
+    """
+    Every day key in ranges, the inverse of as_ranges
+    """
+    return [_key(o) for first, last in ranges for o in range(_ordinal(first), _ordinal(last) + 1)]
+
+
+def compact_entry(entry):
+    """
+    An entry with its days_affected list (as written before changelogs
+    had their own segment) turned into ranges; other entries are kept as
+    they are
+    """
+    if "ranges" in entry:
+        return entry
+    days_affected = entry.get("days_affected", [])
+    return dict(
+        day=entry.get("day"),
+        description=entry.get("description"),
+        ranges=as_ranges(days_affected),
+        n_days=len(set(days_affected))
+    )
+
+
+class Changelog:
+    """
+    One entry per import: the day it ran, its description, and the days
+    it affected as date ranges. Storage keeps entries apart from the days,
+    appending new entries on save; entries[:stored] are already stored,
+    unless retention or compaction requires a rewrite.
+    """
+
+    def __init__(self, entries=None, stored=0):
+        self.entries = list(entries or [])
+        self.stored = stored
+        self.rewrite = False
+        self._index = None
+
+    @classmethod
+    def load(cls, legacy=None, segment=None):
+        """
+        legacy: entries kept with the other documents by earlier versions;
+        they are moved into the segment (before its entries) on next save
+        """
+        legacy = [compact_entry(e) for e in legacy or []]
+        changelog = cls(legacy + list(segment or []), stored=len(segment or []))
+        if legacy:
+            changelog.stored = 0
+            changelog.rewrite = True
+        return changelog
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        return self.entries[i]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def append(self, days_affected, description, day):
+        entry = dict(
+            day=day,
+            description=description,
+            ranges=as_ranges(days_affected),
+            n_days=len(set(days_affected))
+        )
+        self.entries.append(entry)
+        if self._index is not None:
+            self._add_to_index(len(self.entries) - 1)
+        return entry
+
+    def unsaved(self):
+        return self.entries[self.stored:]
+
+    def saved(self):
+        self.stored = len(self.entries)
+        self.rewrite = False
+
+    def _add_to_index(self, i):
+        for first, last in self.entries[i]["ranges"]:
+            for ordinal in range(_ordinal(first), _ordinal(last) + 1):
+                self._index.setdefault(ordinal, []).append(i)
+
+    def touched(self, day):
+        """
+        Entries (oldest first) of the imports that affected day, a day key
+        or datetime; looked up in an index by day
+        """
+        if self._index is None:
+            self._index = dict()
+            for i in range(len(self.entries)):
+                self._add_to_index(i)
+        ordinal = day.toordinal() if hasattr(day, "toordinal") else _ordinal(day)
+        return [self.entries[i] for i in self._index.get(ordinal, [])]
+
+    def apply_policy(self, max_entries=None, max_age_days=None, compact=False, today=None):
+        """
+        Retention: keep at most max_entries entries, and none that ran more
+        than max_age_days before today. Compaction: merge each run of
+        consecutive entries with the same description into one, keeping
+        the first and last day it ran and how many runs it stands for.
+        Returns the number of entries removed.
+        """
+        n = len(self.entries)
+        entries = self.entries
+        if max_age_days is not None:
+            today = today or datetime.today()
+            oldest = (today - timedelta(days=max_age_days)).strftime('%Y-%m-%d')
+            entries = [e for e in entries if (e.get("day") or "") >= oldest]
+        if compact:
+            merged = []
+            for e in entries:
+                previous = merged[-1] if merged else None
+                if previous and previous["description"] == e["description"]:
+                    days = range_keys(previous["ranges"]) + range_keys(e["ranges"])
+                    merged[-1] = dict(
+                        day=e["day"],
+                        first_day=previous.get("first_day", previous["day"]),
+                        description=e["description"],
+                        ranges=as_ranges(days),
+                        n_days=len(set(days)),
+                        runs=previous.get("runs", 1) + e.get("runs", 1)
+                    )
+                else:
+                    merged.append(e)
+            entries = merged
+        if max_entries is not None:
+            entries = entries[-max_entries:] if max_entries else []
+        if len(entries) != n:
+            self.entries = entries
+            self.rewrite = True
+            self._index = None
+        return n - len(entries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show which imports touched a day, or apply retention and compaction to a changelog.")
+    parser.add_argument('bmdb', type=str, help="bluemoon database")
+    parser.add_argument('--day', type=str, default=None, help="List the imports that affected this day")
+    parser.add_argument('--max_entries', type=int, default=None)
+    parser.add_argument('--max_age_days', type=int, default=None)
+    parser.add_argument('--compact', action='store_true', default=False,
+        help="Flag that merges consecutive entries with the same description")
+    parser.add_argument('--keep_policy', action='store_true', default=False,
+        help="Flag that stores the policy, to be applied on every save")
+    opts = parser.parse_args()
+
+    from .models import AllData
+    all_data = AllData.build(opts.bmdb, lazy=True)
+    if opts.day:
+        for entry in all_data.changelog.touched(opts.day):
+            print(entry["day"], entry["description"])
+
+    # 0 is a policy too (eg. keep no entries)
+    policy = {k: v for k, v in dict(max_entries=opts.max_entries,
+        max_age_days=opts.max_age_days).items() if v is not None}
+    if opts.compact:
+        policy["compact"] = True
+    if policy:
+        if opts.keep_policy:
+            all_data.meta["changelog_policy"] = policy
+        print("Removed", all_data.changelog.apply_policy(**policy), "entries")
+        all_data.save()
@@ -0,0 +1,233 @@
+import numpy as np
+from datetime import date
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _kind(value):
+    if isinstance(value, (bool, np.bool_)):
+        return "bool"
+    if isinstance(value, (int, np.integer)):
+        return "int"
+    if isinstance(value, (float, np.floating)):
+        return "float"
+    return "object"
+
+def _common_kind(a, b):
+    if a == b:
+        return a
+    if {a, b} == {"int", "float"}:
+        return "float"
+    return "object"
+
+DTYPES = dict(bool=np.bool_, int=np.int64, float=np.float64, object=object)
+
+
+class Column:
+    """
+    Values of one field for every row, with a mask that is True where
+    the day has no value, instead of storing None
+    """
+
+    def __init__(self, kind, capacity):
+        self.kind = kind
+        self.values = np.zeros(capacity, dtype=DTYPES[kind])
+        self.mask = np.ones(capacity, dtype=bool)
+
+    @classmethod
+    def wrap(cls, kind, values, mask):
+        """
+        A column of existing arrays (eg. views on a snapshot.Snapshot),
+        without copying them
+        """
+        column = cls.__new__(cls)
+        column.kind, column.values, column.mask = kind, values, mask
+        return column
+
+    def resize(self, capacity):
+        values = np.zeros(capacity, dtype=self.values.dtype)
+        values[:len(self.values)] = self.values
+        mask = np.ones(capacity, dtype=bool)
+        mask[:len(self.mask)] = self.mask
+        self.values, self.mask = values, mask
+
+    def astype(self, kind):
+        self.kind = kind
+        self.values = self.values.astype(DTYPES[kind])
+
+    def as_array(self, n):
+        """
+        A pandas-ready array over the first n rows, without copying when
+        possible; masked extension arrays are used for missing values
+        """
+        return self._array(self.values[:n], self.mask[:n])
+
+    def as_numpy(self, n):
+        """
+        Same as as_array, as plain numpy arrays, without pandas: numbers
+        are float with NaN where missing, and bools and objects have None
+        """
+        values, mask = self.values[:n], self.mask[:n]
+        if not mask.any():
+            return values
+        if self.kind in ("int", "float"):
+            values = values.astype(np.float64)
+            values[mask] = np.nan
+            return values
+        values = values.astype(object)
+        values[mask] = None
+        return values
+
+    def take(self, rows):
+        """
+        Same as as_array, for the given rows only
+        """
+        return self._array(self.values[rows], self.mask[rows])
+
+    def _array(self, values, mask):
+        import pandas as pd
+
+        if self.kind == "object":
+            values = values.copy()
+            values[mask] = None
+            return values
+        if not mask.any():
+            return values
+        if self.kind == "int":
+            return pd.arrays.IntegerArray(values, mask)
+        if self.kind == "float":
+            return pd.arrays.FloatingArray(values, mask)
+        return pd.arrays.BooleanArray(values, mask)
+
+
+class ColumnStore:
+    """
+    Columnar copy of Day.data for a Dataset: one row per day, in the order
+    days were added, with per-field numpy arrays
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.n = 0
+        self.rows = dict()
+        self.keys = np.empty(capacity, dtype=object)
+        self.ordinals = np.zeros(capacity, dtype=np.int64)
+        self.columns = dict()
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, capacity):
+        keys = np.empty(capacity, dtype=object)
+        keys[:self.n] = self.keys[:self.n]
+        ordinals = np.zeros(capacity, dtype=np.int64)
+        ordinals[:self.n] = self.ordinals[:self.n]
+        self.keys, self.ordinals = keys, ordinals
+        for column in self.columns.values():
+            column.resize(capacity)
+        self.capacity = capacity
+
+    def row(self, day):
+        """
+        Row of the day, appending a new one if needed
+        """
+        i = self.rows.get(day.key)
+        if i is None:
+            if self.n == self.capacity:
+                self._grow(2 * self.capacity)
+            i = self.n
+            self.n += 1
+            self.rows[day.key] = i
+            self.keys[i] = day.key
+            self.ordinals[i] = day.ordinal
+        return i
+
+    def _column_for(self, field_name, kind):
+        column = self.columns.get(field_name)
+        if column is None:
+            column = self.columns[field_name] = Column(kind, self.capacity)
+        elif column.kind != kind:
+            common = _common_kind(column.kind, kind)
+            if common != column.kind:
+                column.astype(common)
+        return column
+
+    def set_value(self, i, field_name, value):
+        if value is None:
+            column = self.columns.get(field_name)
+            if column is not None:
+                column.mask[i] = True
+            return
+        column = self._column_for(field_name, _kind(value))
+        column.values[i] = value
+        column.mask[i] = False
+
+    def set_day(self, day):
+        """
+        Copy every field of day.data into the day's row
+        """
+        i = self.row(day)
+        for column in self.columns.values():
+            column.mask[i] = True
+        for field_name, value in day.data.items():
+            self.set_value(i, field_name, value)
+
+    def set_column(self, field_name, keys, values):
+        """
+        Set a whole field at once; values are aligned with keys
+        """
+        self.drop_column(field_name)
+        rows = np.fromiter((self.rows[k] for k in keys), dtype=np.int64, count=len(keys))
+        present = [v is not None for v in values]
+        kind = None
+        for v in values:
+            if v is not None:
+                kind = _kind(v) if kind is None else _common_kind(kind, _kind(v))
+        if kind is None:
+            kind = "object"
+        column = self.columns[field_name] = Column(kind, self.capacity)
+        if kind == "object":
+            for i, v in zip(rows, values):
+                column.values[i] = v
+        else:
+            column.values[rows] = np.array([v if v is not None else 0 for v in values],
+                dtype=DTYPES[kind])
+        column.mask[rows] = ~np.array(present, dtype=bool)
+
+    def update_column(self, field_name, keys, values):
+        """
+        Set a field for some rows only; values are aligned with keys
+        """
+        for k, v in zip(keys, values):
+            self.set_value(self.rows[k], field_name, v)
+
+    def take(self, field_name, keys):
+        """
+        Pandas-ready array of a field for the rows of keys; a field that
+        is not stored is all None
+        """
+        rows = np.fromiter((self.rows[k] for k in keys), dtype=np.int64, count=len(keys))
+        column = self.columns.get(field_name)
+        if column is None:
+            return np.full(len(keys), None, dtype=object)
+        return column.take(rows)
+
+    def drop_column(self, field_name):
+        self.columns.pop(field_name, None)
+
+    def as_dataframe(self):
+        """
+        Same columns as a DataFrame of Day.as_dict() rows; the arrays are
+        views on the store wherever no missing values need masking, so the
+        frame should be rebuilt rather than kept across updates
+        """
+        import pandas as pd
+
+        day_dt = (self.ordinals[:self.n] - EPOCH_ORDINAL).astype('datetime64[D]')
+        columns = dict(
+            day_dt=day_dt.astype('datetime64[us]'),
+            day_str=self.keys[:self.n]
+        )
+        for field_name, column in self.columns.items():
+            columns[field_name] = column.as_array(self.n)
+        return pd.DataFrame(columns, copy=False)
@@ -1,9 +1,40 @@
+import os
+import sys
+import glob
 import textwrap
 import json
+import numpy as np
 from enum import Enum
-from .models import Day, Dataset, str_to_day, compound_field_name
-from . import get_aggregate_data
+from .models import Day, Dataset, str_to_day, compound_field_name, \
+    vectorized_analysis, dependency_window, with_digest, RecordSchema
+from . import get_aggregate_data, find_datafiles
+from .instrument import stage
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Per-day field names by data source, see DataSource.get_data_fields
+_data_fields = dict()
+
+
+def _build_worklog_days(worklog_, first_day, last_day):
+    days = []
+    day_cursor = first_day
+    while day_cursor <= last_day:
+        d = Day(day_dt=day_cursor)
+
+        worktime = worklog_["working_hours"] if d.weekday_char in worklog_["working_days"] else 0
+        if d.key in worklog_["exceptions"]:
+            worktime = int(worklog_["exceptions"][d.key])
+
+        day_cursor += timedelta(days=1)
+        d.set_value(str(DataSource.worklog), worktime)
+        days.append(d)
+    return days
+
+
+# Stands for a secret given as data, see DataSource.redacted
+REDACTED = "<redacted>"
 
 
 class DataSource(Enum):
@@ -21,13 +52,116 @@ class DataSource(Enum):
     exist = '*exist'
     lastfm = '*last.fm'
 
-    def build_dataset(self, data, base_dataset=None):
+    def build_dataset(self, data, base_dataset=None, workers=None, parse_cache=None, sync_cursor=None,
+            scrobble_store=None):
+        """
+        data: for exports, a file or a pattern (eg. "exports/toggl*.csv"),
+        or a list of them.
+
+        With workers > 1, days are built in that many worker processes,
+        each given a contiguous share of the days; the result is the same
+        as building them in this process.
+
+        Given a ParseCache, the files matching data are parsed one at a
+        time, and only those it has not seen with the same content; the
+        days of each are then merged, as Dataset.add does for overlapping
+        exports.
+
+        Sources synced from an API (DataSource.exist) only fetch the days
+        since those in sync_cursor (see ExistClient.sync), which is then
+        advanced in place; AllData keeps it in meta["sync_cursors"].
+
+        Last.fm exports are streamed a chunk at a time into one aggregate
+        record per day (see lastfm.DayAggregates), which counts a scrobble
+        that several of the files have once; the scrobbles themselves are
+        only kept given scrobble_store, the path of a lastfm.ScrobbleStore
+        """
+        with stage("build_dataset.%s"%self.name, workers=workers or 1) as s:
+            ds = self._build_dataset(data, s, workers, parse_cache, sync_cursor, scrobble_store)
+            s.set(days=len(ds.days))
+        return ds
+
+    def _parse_file(self, datafile, workers):
+        # (days, rows) of one file, see ParseCache.parsed; for Last.fm, its
+        # scrobbles (in their compact form) rather than days, so that they
+        # are aggregated together with those of the other files
+        if self == DataSource.lastfm:
+            from . import lastfm
+            return lastfm.read_compact(glob.escape(datafile))
+        df = get_aggregate_data(glob.escape(datafile), usecols=self.get_columns(), dtype=self.get_dtypes())
+        if df is None:
+            return [], 0
+        if workers and workers > 1:
+            return self._build_days_parallel(df, workers), len(df)
+        return self.build_days(df), len(df)
+
+    def _build_dataset(self, data, counts, workers, parse_cache=None, sync_cursor=None,
+            scrobble_store=None):
         ds = Dataset()
         accumulator_params = {}
 
-        if self in [DataSource.oura, DataSource.lastfm, DataSource.toggl]:
-            for index, row in get_aggregate_data(data).iterrows():
-                ds.add(self.build_day(row), overwrite_fields=[])
+        # Scrobbles are only stored when their file is parsed
+        if self in [DataSource.oura, DataSource.lastfm, DataSource.toggl] and parse_cache is not None \
+                and scrobble_store is None:
+            with stage("parse_cache") as s:
+                hits = parse_cache.hits
+                n_rows = 0
+                if self == DataSource.lastfm:
+                    from . import lastfm
+                    aggregates = lastfm.DayAggregates()
+                for datafile in find_datafiles(data):
+                    parsed, rows = parse_cache.parsed(self, datafile, lambda path: self._parse_file(path, workers))
+                    n_rows += rows
+                    if self == DataSource.lastfm:
+                        aggregates.add(parsed)
+                        continue
+                    for d in parsed:
+                        ds.add(d, overwrite_fields=[])
+                if self == DataSource.lastfm:
+                    for d in aggregates.days(str(self), self.get_record_schema()):
+                        ds.add(d, overwrite_fields=[])
+                parse_cache.save()
+                s.set(cached=parse_cache.hits - hits, rows=n_rows)
+            counts.set(rows=s["rows"])
+
+        elif self == DataSource.lastfm:
+            from . import lastfm
+            days, rows = lastfm.build_days(data, str(self), self.get_record_schema(),
+                scrobble_store=scrobble_store)
+            counts.set(rows=rows)
+            for d in days:
+                ds.add(d, overwrite_fields=[])
+
+        elif self in [DataSource.oura, DataSource.toggl]:
+            with stage("read_csv") as s:
+                df = get_aggregate_data(data, usecols=self.get_columns(), dtype=self.get_dtypes())
+                s.set(rows=0 if df is None else len(df))
+            counts.set(rows=s["rows"])
+            if df is not None:
+                with stage("build_days", rows=len(df)):
+                    if workers and workers > 1:
+                        days = self._build_days_parallel(df, workers)
+                    else:
+                        days = self.build_days(df)
+                    for d in days:
+                        ds.add(d, overwrite_fields=[])
+
+        elif self == DataSource.exist:
+            from .exist import sync_exist, read_exist_config, EXIST_URL
+            config = read_exist_config(data)
+            with stage("sync_exist") as s:
+                histories = sync_exist(config["token"], config.get("attributes"), sync_cursor,
+                    base_url=config.get("base_url", EXIST_URL))
+                s.set(values=sum(len(history) for history in histories.values()))
+            days = dict()
+            for attribute, history in histories.items():
+                field_name = compound_field_name(self, attribute)
+                for key, value in history:
+                    if key not in days:
+                        days[key] = Day(day_as_str=key)
+                    days[key].set_value(field_name, value)
+            for d in days.values():
+                ds.add(d, overwrite_fields=[])
 
         elif self == DataSource.worklog:
 
@@ -37,21 +171,35 @@ class DataSource(Enum):
 
             accumulator_params = {}
 
-            day_cursor = first_day
-            while day_cursor <= last_day:
-                d = Day(day_dt=day_cursor)
-
-                worktime = worklog_["working_hours"] if d.weekday_char in worklog_["working_days"] else 0
-                if d.key in worklog_["exceptions"]:
-                    worktime = int(worklog_["exceptions"][d.key])
-
-                day_cursor += timedelta(days=1)
-                d.set_value(str(self), worktime)
+            if workers and workers > 1:
+                n_days = (last_day - first_day).days + 1
+                bounds = [first_day + timedelta(days=n_days * i // workers) for i in range(workers + 1)]
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunks = list(executor.map(_build_worklog_days, [worklog_] * workers,
+                        bounds[:-1], [b - timedelta(days=1) for b in bounds[1:]]))
+                days = [d for chunk in chunks for d in chunk]
+            else:
+                days = _build_worklog_days(worklog_, first_day, last_day)
+            for d in days:
                 ds.add(d, overwrite_fields=True)
 
         ds.add_dataset_analysis(str(self), self.get_accumulator(accumulator_params))
         return ds
 
+    def _build_days_parallel(self, df, workers):
+        """
+        build_days over contiguous shares of the dates, in worker processes;
+        all rows of a date go to the same worker, and dates keep their order
+        """
+        import pandas as pd
+
+        codes, uniques = pd.factorize(df[self.get_date_column()], sort=False)
+        bounds = [len(uniques) * i // workers for i in range(workers + 1)]
+        chunks = [df[(codes >= lo) & (codes < hi)] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(DataSource.build_days, [self] * len(chunks), chunks))
+        return [d for days in results for d in days]
+
     def get_filter(self):
         """
         How should data with a very large number of fields be filtered?
@@ -65,21 +213,74 @@ class DataSource(Enum):
         return i
 
     @staticmethod
-    def _toggl_accumulator(days):
+    def _toggl_minutes(record):
+        # Parsed at ingest; records stored before that only have the Duration
+        minutes = record.get("Minutes")
+        if minutes is None and type(record.get("Duration")) == str and record["Duration"]:
+            minutes = DataSource._toggl_duration_parse(record["Duration"])
+        return minutes or 0
+
+    @staticmethod
+    @vectorized_analysis
+    @dependency_window(0)
+    def _toggl_accumulator(days, keys, ordinals):
         ## Given days, provides a per-day analysis of work duration and variety
-        result = dict()
-
-        for key, d in days.items():
-            vs = d.cumulative.get(str(DataSource.toggl), [])
-            result[key] = dict()
-            result[key]["ct"] = len(vs)
-            result[key]["duration"] = sum([
-                DataSource._toggl_duration_parse(v["Duration"]) for v in vs if v.get("Duration")
-            ])
-            result[key]["overwork"] = 0 if result[key]["duration"] <=11 else (
-                1 if result[key]["duration"] <= 14 else 2
-            )
-        return result
+        field = str(DataSource.toggl)
+        ct = np.zeros(len(keys), dtype=np.int64)
+        duration = np.zeros(len(keys), dtype=np.int64)
+
+        for i, d in enumerate(days.values()):
+            vs = d.cumulative.get(field)
+            if vs:
+                ct[i] = len(vs)
+                duration[i] = sum([DataSource._toggl_minutes(v) for v in vs])
+        return dict(
+            ct=ct,
+            duration=duration,
+            overwork=np.where(duration <= 11, 0, np.where(duration <= 14, 1, 2))
+        )
+
+    @staticmethod
+    @vectorized_analysis
+    @dependency_window(0)
+    def _lastfm_accumulator(days, keys, ordinals):
+        ## Given days, provides a per-day analysis of listening: plays, distinct artists, and when
+        field = str(DataSource.lastfm)
+        plays = np.zeros(len(keys), dtype=np.int64)
+        artists = np.zeros(len(keys), dtype=np.int64)
+        hours = np.zeros((len(keys), 24), dtype=np.int64)
+
+        for i, d in enumerate(days.values()):
+            vs = d.cumulative.get(field)
+            if vs:
+                # Several records of a day come from databases that added
+                # exports split within it one at a time
+                plays[i] = sum([v["Plays"] for v in vs])
+                artists[i] = len(set().union(*[v["Artists"] for v in vs]))
+                hours[i] = np.sum([v["Hours"] for v in vs], axis=0)
+        return dict(
+            plays=plays,
+            artists=artists,
+            hours=np.count_nonzero(hours, axis=1),
+            peak_hour=np.where(plays > 0, hours.argmax(axis=1), -1),
+            night_plays=hours[:, :6].sum(axis=1)
+        )
+
+    def redacted(self, data):
+        """
+        data as it may be shown or stored, eg. in the changelog: an Exist
+        token given as data, rather than in a config file, is masked
+        """
+        if self == DataSource.exist and data and not os.path.isfile(data):
+            return REDACTED
+        return data
+
+    def has_aggregate_records(self):
+        """
+        Is a day's cumulative record an aggregate of its entries (which can
+        not be merged with another one), rather than one of them?
+        """
+        return self == DataSource.lastfm
 
     def get_accumulator(self, accumulator_params={}):
         """
@@ -90,6 +291,8 @@ class DataSource(Enum):
 
         if self == DataSource.toggl:
             return DataSource._toggl_accumulator
+        if self == DataSource.lastfm:
+            return DataSource._lastfm_accumulator
         return None
 
     def get_fields(self):
@@ -119,25 +322,130 @@ class DataSource(Enum):
                 "HRV Balance Score,Recovery Index Score").split(",")
         return None
 
+    def get_record_schema(self):
+        """
+        Field names shared by all cumulative records of this source
+        """
+        if self == DataSource.toggl:
+            return RecordSchema.get(
+                ["Texts"] + self.get_fields() + ["Minutes", "Digest"],
+                categorical_fields=["Project", "Task", "Tags"])
+        if self == DataSource.lastfm:
+            # One aggregate per day, see lastfm.DayAggregates
+            return RecordSchema.get(["Plays", "Artists", "Hours", "Scrobbles", "Digest"])
+        return None
+
+    def get_data_fields(self):
+        """
+        Names of the per-day fields set from each csv column, shared by all days
+        """
+        if self not in _data_fields:
+            _data_fields[self] = {k: sys.intern(compound_field_name(self, k)) \
+                for k in self.get_fields()}
+        return _data_fields[self]
+
+    def get_date_column(self):
+        if self == DataSource.toggl:
+            return "Start date"
+        elif self == DataSource.oura:
+            return "date"
+        return None
+
+    def get_columns(self):
+        """
+        Which columns of the csv export are needed to build days?
+        None means all of them.
+        """
+        fields = self.get_fields()
+        if fields is None:
+            return None
+        columns = [self.get_date_column()] + list(fields)
+        return list(dict.fromkeys(columns))
+
+    def get_dtypes(self):
+        """
+        Which columns should be read as-is, without type inference?
+        """
+        if self == DataSource.toggl:
+            return {k: str for k in self.get_columns()}
+        return None
+
+    def get_text_fields(self):
+        if self == DataSource.toggl:
+            return ["Project", "Task", "Tags", "Description"]
+        return None
+
     def build_day(self, df_row):
         if self == DataSource.toggl:
             d = df_row["Start date"].split("-")
             # TODO needs to specify accumulator function
             d = Day(year=int(d[0]), month=int(d[1]), day=int(d[2]))
-            d.add_record(str(self), dict(
-                Texts=" ".join([df_row[k] for k in [
-                    "Project", "Task", "Tags", "Description"
-                ] if type(df_row[k]) == str]),
-                **{k:df_row[k] for k in self.get_fields()})
-                )
+            d.add_record(str(self), self.get_record_schema().record(with_digest(dict(
+                Texts=" ".join([df_row[k] for k in self.get_text_fields() \
+                    if type(df_row[k]) == str]),
+                **{k:df_row[k] for k in self.get_fields()},
+                Minutes=DataSource._toggl_duration_parse(df_row["Duration"]) \
+                    if type(df_row["Duration"]) == str and df_row["Duration"] else None)
+                )))
             return d
         elif self == DataSource.oura:
             d = df_row["date"].split("-")
             d = Day(year=int(d[0]), month=int(d[1]), day=int(d[2]))
-            d.update({"%s_%s"%(self, k):df_row[k] for k in self.get_fields()})
+            for k, field_name in self.get_data_fields().items():
+                d.set_value(field_name, df_row[k])
             return d
+        elif self == DataSource.lastfm:
+            import pandas as pd
+            return self.build_days(pd.DataFrame([df_row]))[0]
         assert False
 
+    def build_days(self, df):
+        """
+        Equivalent to build_day for every row, merged per day: dates are
+        factorized once, each Day is built once per unique date and its
+        records are attached in bulk
+        """
+        import pandas as pd
+
+        if self == DataSource.lastfm:
+            from . import lastfm
+            aggregates = lastfm.DayAggregates()
+            aggregates.add(lastfm.CompactScrobbles.from_scrobbles(lastfm.parse_scrobbles(df)))
+            return aggregates.days(str(self), self.get_record_schema())
+
+        codes, uniques = pd.factorize(df[self.get_date_column()], sort=False)
+        days = [Day(day_as_str=u) for u in uniques]
+        fields = list(dict.fromkeys(self.get_fields()))
+
+        if self == DataSource.toggl:
+            texts = [" ".join([v for v in vs if type(v) == str]) \
+                for vs in zip(*[df[k] for k in self.get_text_fields()])]
+            # Each distinct duration string is parsed once
+            duration_codes, durations = pd.factorize(df["Duration"])
+            minutes = [DataSource._toggl_duration_parse(v) if type(v) == str and v else None \
+                for v in durations]
+            records = df[fields].to_dict('records')
+            # Identical rows, eg. from overlapping exports, are kept once
+            seen = [set() for d in days]
+            schema = self.get_record_schema()
+            for code, text, record, duration_code in zip(codes, texts, records, duration_codes):
+                if code >= 0:
+                    record = with_digest(dict(Texts=text, **record,
+                        Minutes=minutes[duration_code] if duration_code >= 0 else None))
+                    if record["Digest"] not in seen[code]:
+                        seen[code].add(record["Digest"])
+                        days[code].add_record(str(self), schema.record(record))
+        elif self == DataSource.oura:
+            records = df[fields].to_dict('records')
+            data_fields = self.get_data_fields()
+            for code, record in zip(codes, records):
+                if code >= 0:
+                    for k, v in record.items():
+                        days[code].set_value(data_fields[k], v)
+        else:
+            assert False
+        return days
+
     def __str__(self):
         return self.value
 
@@ -153,6 +461,20 @@ class DataSource(Enum):
             h += "\n%s\n"%intro_msg(is_optional=False, src="data")
             h += "\n%s\n"%intro_msg(is_optional=True, src="meta")
 
+        elif self == DataSource.exist:
+            h += "\n%s\n"%(intro_msg(is_optional=False, src="data"))
+            h += textwrap.dedent('''\
+                     Synced from the Exist.io API with a bearer token; each run only fetches the
+                     days since the last one, per attribute. Either the token itself, or a JSON
+                     with the token and, optionally, which attributes to sync (all by default).
+
+                     --data exist.json
+                       {
+                        "token": "...",
+                        "attributes": ["steps", "mood", "sleep"]
+                       }
+                     ''')
+
         elif self == DataSource.worklog:
             h += "\n%s\n"%(intro_msg(is_optional=False, src="data"))
             h += textwrap.dedent('''\
@@ -0,0 +1,217 @@
+import os
+import json
+import numpy as np
+from bisect import bisect_right
+from datetime import datetime
+
+from . import get_cache_dir
+
+CACHE_FILENAME = "ephemeris.json"
+CACHE_VERSION = 1
+
+# Events are tabulated per whole year, so that looking up a single new day
+# does not trigger a search for every day after it.
+def _year_start(dt):
+    return datetime(dt.year, 1, 1)
+
+def _next_year_start(dt):
+    return datetime(dt.year + 1, 1, 1)
+
+def ephem_moon(day_dt):
+    """
+    Reference implementation: days to the nearest full moon, searched with ephem
+    """
+    import ephem
+
+    return min(
+        (ephem.localtime(ephem.next_full_moon(day_dt)) - day_dt).days,
+        (day_dt - ephem.localtime(ephem.previous_full_moon(day_dt))).days
+    )
+
+def ephem_season(day_dt):
+    """
+    Reference implementation: days to the nearest equinox or solstice
+    """
+    import ephem
+
+    return min(
+        (ephem.localtime(ephem.next_equinox(day_dt)) - day_dt).days,
+        (day_dt - ephem.localtime(ephem.previous_equinox(day_dt))).days,
+        (ephem.localtime(ephem.next_solstice(day_dt)) - day_dt).days,
+        (day_dt - ephem.localtime(ephem.previous_solstice(day_dt))).days
+    )
+
+def _search_events(previous_fn, next_fn, start, end):
+    """
+    All events from the last one before start to the first one after end,
+    as ephem dates (floats, UTC)
+    """
+    import ephem
+
+    events = [float(previous_fn(start))]
+    while ephem.Date(events[-1]).datetime() <= end:
+        # Step past the current event so the search can not land on it again
+        events.append(float(next_fn(ephem.Date(events[-1] + 1))))
+    return events
+
+def _merge_events(events, new_events):
+    merged = []
+    for e in sorted(events + new_events):
+        # The same event found from a different starting point differs only
+        # by the search tolerance; events themselves are weeks apart.
+        if merged and e - merged[-1] < 1:
+            continue
+        merged.append(e)
+    return merged
+
+
+class EphemerisIndex:
+    """
+    Sorted table of full moon, equinox and solstice instants, covering whole
+    years from start (inclusive) to end (exclusive). Lookups give the same
+    results as ephem_moon and ephem_season, extending the table as needed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.start = None
+        self.end = None
+        self.full_moons = []
+        self.equinoxes = []
+        self.solstices = []
+        self._dirty = False
+        self._reindex()
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        try:
+            with open(path) as f:
+                d = json.load(f)
+            if d.get("version") == CACHE_VERSION:
+                index.start = datetime.strptime(d["start"], '%Y-%m-%d')
+                index.end = datetime.strptime(d["end"], '%Y-%m-%d')
+                index.full_moons = d["full_moons"]
+                index.equinoxes = d["equinoxes"]
+                index.solstices = d["solstices"]
+                index._reindex()
+        except (OSError, ValueError, KeyError):
+            pass
+        return index
+
+    def as_dict(self):
+        return dict(
+            version=CACHE_VERSION,
+            start=self.start.strftime('%Y-%m-%d') if self.start else None,
+            end=self.end.strftime('%Y-%m-%d') if self.end else None,
+            full_moons=self.full_moons,
+            equinoxes=self.equinoxes,
+            solstices=self.solstices
+        )
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = "%s.tmp"%self.path
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.as_dict(), f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError:
+            # The cache is only an optimization; it is rebuilt when missing
+            pass
+
+    def _reindex(self):
+        # ephem is only imported once a day's calendar features are needed
+        import ephem
+
+        seasons = sorted(self.equinoxes + self.solstices)
+        self._moon_utc = [ephem.Date(e).datetime() for e in self.full_moons]
+        self._moon_local = [ephem.localtime(ephem.Date(e)) for e in self.full_moons]
+        self._season_utc = [ephem.Date(e).datetime() for e in seasons]
+        self._season_local = [ephem.localtime(ephem.Date(e)) for e in seasons]
+
+    def covers(self, start, end):
+        return self.start is not None and self.start <= start and end < self.end
+
+    def extend(self, start, end):
+        """
+        Make sure every day from start to end (inclusive) can be looked up
+        """
+        if self.covers(start, end):
+            return
+        start, end = _year_start(start), _next_year_start(end)
+        if self.start is None:
+            missing = [(start, end)]
+        else:
+            missing = [(start, self.start), (self.end, end)]
+            start, end = min(start, self.start), max(end, self.end)
+
+        import ephem
+
+        for (lo, hi) in missing:
+            if lo >= hi:
+                continue
+            self.full_moons = _merge_events(self.full_moons, _search_events(
+                ephem.previous_full_moon, ephem.next_full_moon, lo, hi))
+            self.equinoxes = _merge_events(self.equinoxes, _search_events(
+                ephem.previous_equinox, ephem.next_equinox, lo, hi))
+            self.solstices = _merge_events(self.solstices, _search_events(
+                ephem.previous_solstice, ephem.next_solstice, lo, hi))
+
+        self.start, self.end = start, end
+        self._dirty = True
+        self._reindex()
+        self.save()
+
+    @staticmethod
+    def _nearest(utc, local, day_dt):
+        # Same convention as ephem: the naive day is taken as UTC for the
+        # search, and the found instant is compared in local time.
+        i = bisect_right(utc, day_dt)
+        return min((local[i] - day_dt).days, (day_dt - local[i - 1]).days)
+
+    def moon(self, day_dt):
+        self.extend(day_dt, day_dt)
+        return EphemerisIndex._nearest(self._moon_utc, self._moon_local, day_dt)
+
+    def season(self, day_dt):
+        self.extend(day_dt, day_dt)
+        return EphemerisIndex._nearest(self._season_utc, self._season_local, day_dt)
+
+    @staticmethod
+    def _nearest_array(utc, local, days):
+        utc = np.array(utc, dtype='datetime64[us]')
+        local = np.array(local, dtype='datetime64[us]')
+        i = np.searchsorted(utc, days, side='right')
+        one_day = np.timedelta64(1, 'D')
+        return np.minimum((local[i] - days) // one_day, (days - local[i - 1]) // one_day)
+
+    def moon_and_season(self, start, end):
+        """
+        Bulk lookup for every day from start to end (inclusive);
+        returns (days, moon, season) as numpy arrays
+        """
+        self.extend(start, end)
+        days = np.arange(
+            np.datetime64(start.date()), np.datetime64(end.date()) + 1
+        ).astype('datetime64[us]')
+        return (
+            days,
+            EphemerisIndex._nearest_array(self._moon_utc, self._moon_local, days),
+            EphemerisIndex._nearest_array(self._season_utc, self._season_local, days)
+        )
+
+
+_index = None
+
+def get_index():
+    """
+    Process-wide index, loaded from (and saved to) the bluemoon cache dir
+    """
+    global _index
+    if _index is None:
+        _index = EphemerisIndex.load(os.path.join(get_cache_dir(), CACHE_FILENAME))
+    return _index
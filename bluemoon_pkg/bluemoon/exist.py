@@ -0,0 +1,222 @@
+import os
+import ssl
+import json
+import asyncio
+import random
+from urllib.parse import urlsplit, urlencode
+
+EXIST_URL = "https://exist.io"
+# Most values a page of attribute history can hold
+PAGE_SIZE = 100
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to one host, shared by concurrent
+    requests; at most max_connections are open (and requests in flight)
+    at a time
+    """
+
+    def __init__(self, base_url, max_connections=4, timeout=30):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.tls = url.scheme == "https"
+        self.port = url.port or (443 if self.tls else 80)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.connections_opened = 0
+        self._idle = []
+        self._slots = None
+
+    async def _connect(self):
+        self.connections_opened += 1
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port,
+            ssl=ssl.create_default_context() if self.tls else None), self.timeout)
+
+    async def _exchange(self, connection, method, target, headers):
+        reader, writer = connection
+        lines = ["%s %s HTTP/1.1"%(method, target), "Host: %s"%self.host, "Connection: keep-alive"] + \
+            ["%s: %s"%(k, v) for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by %s"%self.host)
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        response_headers = dict()
+        while True:
+            line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and response_headers.get("connection", "").lower() != "close"
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        elif "content-length" in response_headers:
+            body = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), response_headers, body, keep_alive
+
+    async def _attempt(self, connection, method, target, headers):
+        # An exchange on connection, which is closed if it fails in any way
+        # (including a timeout), as it may be left in the middle of one
+        try:
+            return await asyncio.wait_for(self._exchange(connection, method, target, headers), self.timeout)
+        except BaseException:
+            connection[1].close()
+            raise
+
+    async def request(self, method, target, headers={}):
+        """
+        (status, headers, body) of the response; headers are lowercase
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        async with self._slots:
+            reused = bool(self._idle)
+            connection = self._idle.pop() if reused else await self._connect()
+            try:
+                status, response_headers, body, keep_alive = await self._attempt(
+                    connection, method, target, headers)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if not reused:
+                    raise
+                # The server closed an idle connection (or no longer answers
+                # on it); try once on a new one
+                connection = await self._connect()
+                status, response_headers, body, keep_alive = await self._attempt(
+                    connection, method, target, headers)
+            if keep_alive:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+            return status, response_headers, body
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+
+class ExistClient:
+    """
+    Attribute history from the Exist.io API (version 1), with a bearer
+    token. Pages of an attribute are requested concurrently once the first
+    page tells how many there are, over a ConnectionPool. Rate limited
+    requests (429, or 503) are retried after the Retry-After the server
+    sends, or else after an exponential backoff, up to max_retries times;
+    so are requests that time out, after the backoff.
+    """
+
+    def __init__(self, token, base_url=EXIST_URL, max_connections=4, max_retries=5,
+            backoff=1.0, page_size=PAGE_SIZE, timeout=30):
+        self.token = token
+        self.pool = ConnectionPool(base_url, max_connections=max_connections, timeout=timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.page_size = page_size
+        self.retries = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.pool.close()
+
+    async def get_json(self, path, params=None):
+        target = path + ("?" + urlencode(params) if params else "")
+        headers = {"Authorization": "Bearer %s"%self.token, "Accept": "application/json"}
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, headers_, body = await self.pool.request("GET", target, headers)
+            except asyncio.TimeoutError:
+                if attempt == self.max_retries:
+                    raise
+                status, headers_, body = None, {}, b""
+            if status == 200:
+                return json.loads(body.decode("utf-8"))
+            if status not in (None, 429, 503) or attempt == self.max_retries:
+                raise OSError("Exist.io request %s returned %d: %s"%(target, status, body[:200]))
+            self.retries += 1
+            retry_after = headers_.get("retry-after")
+            delay = float(retry_after) if retry_after and retry_after.replace(".", "", 1).isdigit() \
+                else self.backoff * 2 ** attempt * (1 + random.random())
+            await asyncio.sleep(delay)
+
+    async def attribute_names(self):
+        """
+        Names of the attributes of the user, eg. "steps" and "mood"
+        """
+        attributes = await self.get_json("/api/1/users/$self/attributes/", dict(limit=1))
+        return [a["attribute"] for a in attributes]
+
+    async def attribute_history(self, attribute, date_min=None):
+        """
+        (date, value) of attribute for every day from date_min (a day key,
+        or None for all of its history), oldest first; days without a
+        value are left out
+        """
+        path = "/api/1/users/$self/attributes/%s/"%attribute
+        params = dict(limit=self.page_size)
+        if date_min:
+            params["date_min"] = date_min
+        first = await self.get_json(path, dict(params, page=1))
+        n_pages = max(1, -(-first.get("count", 0) // self.page_size))
+        pages = [first] + list(await asyncio.gather(*[
+            self.get_json(path, dict(params, page=page)) for page in range(2, n_pages + 1)]))
+        values = {r["date"]: r["value"] for page in pages for r in page.get("results", []) \
+            if r.get("value") is not None}
+        return sorted(values.items())
+
+    async def sync(self, attributes=None, cursor=None):
+        """
+        History of attributes (all of the user's, by default) since the
+        days in cursor, a dict of the last day synced by attribute; that
+        day is fetched again, as its value may have changed since. cursor
+        is advanced in place. Returns the (date, value) lists by attribute.
+        """
+        cursor = {} if cursor is None else cursor
+        attributes = attributes or await self.attribute_names()
+        histories = await asyncio.gather(*[
+            self.attribute_history(a, date_min=cursor.get(a)) for a in attributes])
+        for attribute, history in zip(attributes, histories):
+            if history:
+                cursor[attribute] = max(cursor.get(attribute, ""), history[-1][0])
+        return dict(zip(attributes, histories))
+
+
+def sync_exist(token, attributes=None, cursor=None, base_url=EXIST_URL, **client_options):
+    """
+    ExistClient.sync, run to completion
+    """
+    async def run():
+        async with ExistClient(token, base_url=base_url, **client_options) as client:
+            return await client.sync(attributes, cursor)
+    return asyncio.run(run())
+
+
+def read_exist_config(data):
+    """
+    data: a JSON file with a "token" (and optionally "attributes" and
+    "base_url"), or the token itself
+    """
+    if not os.path.isfile(data):
+        return dict(token=data)
+    with open(data) as f:
+        return json.load(f)
@@ -0,0 +1,110 @@
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Callbacks for finished stages, see add_listener
+_listeners = []
+# Names of the stages currently running in each thread, outermost first
+_local = threading.local()
+
+
+def add_listener(callback):
+    """
+    callback is called with a dict for every finished stage: name,
+    parent (name of the enclosing stage in the same thread, or None),
+    depth, thread, seconds, and counts such as rows and days. Use it to
+    ship timings to metrics.
+    """
+    _listeners.append(callback)
+
+def remove_listener(callback):
+    if callback in _listeners:
+        _listeners.remove(callback)
+
+@contextmanager
+def listening(callback):
+    add_listener(callback)
+    try:
+        yield callback
+    finally:
+        remove_listener(callback)
+
+
+class _Counts(dict):
+
+    def set(self, **counts):
+        self.update(counts)
+
+
+@contextmanager
+def stage(name, **counts):
+    """
+    Time the enclosed block as one stage; counts known up front can be
+    given here, the rest set on the yielded dict:
+
+        with stage("build_dataset") as s:
+            ...
+            s.set(days=len(ds.days))
+
+    Costs next to nothing when nobody is listening.
+    """
+    counts = _Counts(counts)
+    if not _listeners:
+        yield counts
+        return
+
+    running = getattr(_local, "running", None)
+    if running is None:
+        running = _local.running = []
+    parent = running[-1] if running else None
+    running.append(name)
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        seconds = time.perf_counter() - start
+        running.pop()
+        event = dict(name=name, parent=parent, depth=len(running), thread=threading.get_ident(),
+            seconds=seconds, **counts)
+        for callback in list(_listeners):
+            callback(event)
+
+
+class Timings:
+    """
+    A listener that keeps every stage, for a per-stage breakdown
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def breakdown(self):
+        """
+        Stages in the order they started, so nested stages follow their parent
+        """
+        ordered, pending = [], []
+        for event in self.events:
+            # Stages finish innermost first; a parent closes its children,
+            # which ran in the same thread
+            nested = lambda e: e["thread"] == event["thread"] and e["depth"] > event["depth"]
+            children = [e for e in pending if nested(e)]
+            pending = [e for e in pending if not nested(e)]
+            pending.append(dict(event, children=children))
+
+        def flatten(events):
+            for event in events:
+                ordered.append({k: v for k, v in event.items() if k != "children"})
+                flatten(event["children"])
+        flatten(pending)
+        return ordered
+
+    def report(self, file=sys.stderr):
+        for event in self.breakdown():
+            counts = ", ".join("%s=%s"%(k, v) for k, v in event.items() \
+                if k not in ("name", "parent", "depth", "thread", "seconds"))
+            print("{:<48} {:>9.4f}s  {}".format(
+                "  " * event["depth"] + event["name"], event["seconds"], counts), file=file)
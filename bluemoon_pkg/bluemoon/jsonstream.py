@@ -0,0 +1,334 @@
+import io
+import re
+import gzip
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+# Everything up to the next bracket outside of a string
+_SKIP = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# A member's key and colon; a string, number, true, false or null, with
+# the comma or brace after it
+_KEY = re.compile(r'[ \t\n\r]*"((?:[^"\\]|\\.)*)"[ \t\n\r]*:')
+_SCALAR = re.compile(r'[ \t\n\r]*(?:"(?:[^"\\]|\\.)*"|[^ \t\n\r,}\]{\["]+)[ \t\n\r]*([,}])')
+
+
+def _compression(path):
+    path = path.lower()
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        assert zstandard is not None, "Reading and writing .zst files needs the zstandard package"
+        return "zstd"
+    return None
+
+
+def open_text(path):
+    """
+    Open a database file for reading as text, decompressing .gz and .zst files
+    """
+    compression = _compression(path)
+    if compression == "gzip":
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == "zstd":
+        return io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True),
+            encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+class TextWriter:
+    """
+    Text written to an open binary file, compressed by the extension of
+    path; closing it finishes the compressed stream but leaves the binary
+    file open (eg. to fsync it)
+    """
+
+    def __init__(self, path, raw):
+        compression = _compression(path)
+        if compression == "gzip":
+            self.compressor = gzip.GzipFile(fileobj=raw, mode='wb')
+        elif compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            self.compressor = None
+        self.text = io.TextIOWrapper(self.compressor or raw, encoding='utf-8')
+
+    def __enter__(self):
+        return self.text
+
+    def __exit__(self, *exc_info):
+        self.text.flush()
+        self.text.detach()
+        if self.compressor is not None:
+            self.compressor.close()
+
+
+class _Reader:
+    """
+    JSON tokens from a text file, read a chunk at a time; values are
+    parsed (or skipped) one at a time, so the whole document is never in
+    memory at once
+    """
+
+    def __init__(self, f, chunk_size=None):
+        self.f = f
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.f.read(max(size or 0, self.chunk_size))
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self):
+        """
+        Next non-whitespace character, or "" at the end of the file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected %r at %r, found %r"%(char, self.buf[self.pos:self.pos + 40], found))
+        self.pos += 1
+
+    def value(self):
+        """
+        Parse the next value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the
+                # next chunk, even after what parsed (eg. "-0" of "-0.5")
+                if self.eof or (end < len(self.buf) and self.buf[end] not in ".eE+-"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(len(self.buf) - self.pos)
+
+    def raw(self):
+        """
+        Skip the next object or list without parsing it; returns its text
+        """
+        if self.peek() not in "{[":
+            return json.dumps(self.value(), ensure_ascii=False)
+        while True:
+            depth = 0
+            end = self.pos
+            while True:
+                end = _SKIP.match(self.buf, end).end()
+                # A quote here starts a string that is cut off by the end of the buffer
+                if end == len(self.buf) or self.buf[end] == '"':
+                    break
+                depth += 1 if self.buf[end] in "{[" else -1
+                end += 1
+                if depth == 0:
+                    text = self.buf[self.pos:end]
+                    self.pos = end
+                    return text
+            # The value continues in the next chunk; scan it again from the start
+            if not self._fill(len(self.buf) - self.pos):
+                raise ValueError("Unexpected end of file")
+
+    def members(self):
+        """
+        Keys of the object at the current position; after each key, the
+        caller reads or skips its value
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def selected(self, selection):
+        """
+        Parse the object at the current position, with only the members
+        selected by selection (a MemberSelection); the others are skipped
+        """
+        self.expect("{")
+        value = dict()
+        if self.peek() == "}":
+            self.pos += 1
+            return value
+        while True:
+            self.pos = selection.skip.match(self.buf, self.pos).end()
+            end = selection.take.match(self.buf, self.pos).end()
+            if end > self.pos:
+                value.update(json.loads("{%s}"%self.buf[self.pos:end].rstrip(" \t\n\r,")))
+                self.pos = end
+                continue
+            match = _KEY.match(self.buf, self.pos)
+            if match is None:
+                # The key is cut off by the end of the buffer, or invalid
+                key = self.value()
+                self.expect(":")
+            else:
+                key = match.group(1)
+                if "\\" in key:
+                    key = json.loads('"%s"'%key)
+                self.pos = match.end()
+            if selection(key):
+                value[key] = self.value()
+            else:
+                match = _SCALAR.match(self.buf, self.pos)
+                if match is not None:
+                    self.pos = match.end()
+                    if match.group(1) == "}":
+                        return value
+                    continue
+                if self.peek() in "{[":
+                    self.raw()
+                else:
+                    self.value()
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return value
+
+
+class MemberSelection:
+    """
+    The members of an object whose key is one of names, or starts with
+    one of prefixes. skip and take match runs of members (other and
+    selected ones) with a string, number, true, false or null value, so
+    that they are skipped, or parsed, at once.
+    """
+
+    def __init__(self, names, prefixes=()):
+        self.names = set(names)
+        self.prefixes = tuple(prefixes)
+        # Keys with escapes are never in a run, as they may not read as
+        # written in the file; they are decoded and looked at one by one
+        selected = [re.escape(name) + '"' for name in self.names] + [re.escape(p) for p in self.prefixes]
+        run = r'(?:[ \t\n\r]*"%s[^"\\]*"[ \t\n\r]*:[ \t\n\r]*' \
+            r'(?:"(?:[^"\\]|\\.)*"|[^ \t\n\r,}\]{\["]+)[ \t\n\r]*,)*'
+        self.skip = re.compile(run%("(?!%s)"%"|".join(selected) if selected else ""))
+        self.take = re.compile(run%("(?=%s)"%"|".join(selected) if selected else "(?!)"))
+
+    def __call__(self, key):
+        return key in self.names or key.startswith(self.prefixes)
+
+
+def _in_range(key, start, end):
+    return (start is None or key >= start) and (end is None or key <= end)
+
+
+def _part(reader, part, selection=None):
+    value = None
+    for name in reader.members():
+        if name != part:
+            reader.raw()
+        elif selection is None or reader.peek() != "{":
+            value = reader.value()
+        else:
+            value = reader.selected(selection)
+    return value
+
+
+def _iter_document(f, start, end, raw, documents, part=None, selection=None):
+    reader = _Reader(f)
+    for name in reader.members():
+        if name != "days":
+            if documents is None:
+                reader.raw()
+            else:
+                documents[name] = reader.value()
+            continue
+        for key in reader.members():
+            if not _in_range(key, start, end):
+                reader.raw()
+            elif part is not None:
+                yield key, _part(reader, part, selection)
+            elif raw:
+                yield key, reader.raw()
+            else:
+                yield key, reader.value()
+
+
+def iter_days(f, start=None, end=None, raw=False, part=None, selection=None):
+    """
+    (key, payload) for the stored days from start to end (inclusive day
+    keys, None for open ended); other days are skipped without being
+    parsed. With raw=True, payloads are left as JSON text; given part
+    (eg. "data"), only that entry of each payload is parsed and returned,
+    and given selection too (a MemberSelection), only its selected members.
+    """
+    return _iter_document(f, start, end, raw, None, part, selection)
+
+
+def read_document(f, start=None, end=None, raw=False):
+    """
+    The whole database layout as a dict, with only the days from start to
+    end; see iter_days
+    """
+    d = dict(days=dict())
+    d["days"].update(_iter_document(f, start, end, raw, d))
+    return d
+
+
+def _dumps(value, indent, level):
+    if indent is None:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    # Strings never hold a raw newline, so this only indents the structure
+    return json.dumps(value, ensure_ascii=False, indent=indent).replace(
+        "\n", "\n" + " " * (indent * level))
+
+
+def write_document(f, days, documents, indent=4):
+    """
+    Write the database layout a day at a time: days is an iterable of
+    (key, payload), where a str payload is JSON text written as it is,
+    and documents are the other top level entries (experiments, meta,
+    changelog). indent=None writes compact JSON; otherwise the output is
+    the same as json.dump with that indent.
+    """
+    newline = (lambda level: "") if indent is None else \
+        (lambda level: "\n" + " " * (indent * level))
+    colon = ":" if indent is None else ": "
+
+    f.write("{" + newline(1) + '"days"' + colon + "{")
+    n_days = 0
+    for key, payload in days:
+        f.write(("," if n_days else "") + newline(2) + json.dumps(key, ensure_ascii=False) + colon)
+        f.write(payload if isinstance(payload, str) else _dumps(payload, indent, 2))
+        n_days += 1
+    f.write((newline(1) if n_days else "") + "}")
+    for name, value in documents.items():
+        f.write("," + newline(1) + json.dumps(name, ensure_ascii=False) + colon + _dumps(value, indent, 1))
+    f.write(newline(0) + "}")
+    return n_days
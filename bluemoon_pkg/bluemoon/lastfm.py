@@ -0,0 +1,320 @@
+import base64
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from . import iter_aggregate_data
+from .models import Day, with_digest
+from .instrument import stage
+
+# A scrobble export (eg. from https://benjaminbenben.com/lastfm-to-csv/)
+# has these columns and no header line; played is "31 Jan 2021 18:25", in UTC
+COLUMNS = ["artist", "album", "track", "played"]
+DAY_FORMAT = '%d %b %Y'
+CHUNK_SIZE = 100000
+
+
+def parse_played(values):
+    """
+    Scrobble times as datetime64, NaT where invalid; each distinct date,
+    and each distinct time of day, is parsed once
+    """
+    values = pd.Series(values, dtype=object).fillna("")
+    day_codes, days = pd.factorize(values.str[:-6])
+    days = pd.to_datetime(pd.Series(days), format=DAY_FORMAT, errors="coerce")
+    time_codes, times = pd.factorize(values.str[-6:])
+    hours = pd.to_numeric(pd.Series(times).str[1:3], errors="coerce")
+    minutes = pd.to_numeric(pd.Series(times).str[4:], errors="coerce")
+    valid = (pd.Series(times).str[:1] == " ") & (pd.Series(times).str[3:4] == ":") & \
+        (hours < 24) & (minutes < 60)
+    offsets = np.where(valid, hours * 60 + minutes, np.nan).astype('timedelta64[m]')
+    return pd.Series(days.to_numpy(dtype='datetime64[m]')[day_codes] + offsets[time_codes])
+
+
+def parse_scrobbles(chunk):
+    """
+    The scrobbles of chunk that have a valid time, with played parsed;
+    rows that do not (eg. a header line) are left out
+    """
+    played = parse_played(chunk["played"].to_numpy())
+    valid = played.notna().to_numpy()
+    return pd.DataFrame(dict(
+        artist=chunk["artist"][valid].fillna("").to_numpy(dtype=object),
+        album=chunk["album"][valid].fillna("").to_numpy(dtype=object),
+        track=chunk["track"][valid].fillna("").to_numpy(dtype=object),
+        played=played[valid].to_numpy()
+    ))
+
+
+class CompactScrobbles:
+    """
+    Scrobbles reduced to what their day aggregates need, as arrays: the
+    hash of each (of its artist, track and minute played), the minute it
+    was played, and the code of its artist among artists; 20 bytes per
+    scrobble, and each artist name once. This, rather than the scrobbles,
+    is what the parse cache keeps of a file.
+    """
+
+    def __init__(self, hashes, minutes, artist_codes, artists):
+        self.hashes = hashes
+        self.minutes = minutes
+        self.artist_codes = artist_codes
+        self.artists = artists
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def from_scrobbles(cls, scrobbles):
+        """
+        The compact form of parsed scrobbles (see parse_scrobbles)
+        """
+        minutes = scrobbles["played"].to_numpy().astype('datetime64[m]').astype(np.int64)
+        # Hashed by the minute as a number, so that hashes kept with the
+        # aggregates do not depend on how played is stored
+        hashes = pd.util.hash_pandas_object(pd.DataFrame(dict(
+            artist=scrobbles["artist"].to_numpy(), track=scrobbles["track"].to_numpy(), played=minutes)),
+            index=False).to_numpy()
+        codes, artists = pd.factorize(scrobbles["artist"])
+        return cls(hashes.astype(np.uint64), minutes, codes.astype(np.int32),
+            np.asarray(artists, dtype=object))
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        All the scrobbles of parts, each once, sorted by hash
+        """
+        if not parts:
+            return cls(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int32), np.zeros(0, dtype=object))
+        # Artist codes of each part, offset into the names of all parts
+        offsets = np.cumsum([0] + [len(p.artists) for p in parts])
+        codes = np.concatenate([p.artist_codes.astype(np.int64) + o for p, o in zip(parts, offsets)])
+        remap, artists = pd.factorize(np.concatenate([p.artists for p in parts]))
+        hashes, first = np.unique(np.concatenate([p.hashes for p in parts]), return_index=True)
+        return cls(hashes, np.concatenate([p.minutes for p in parts])[first],
+            remap[codes[first]].astype(np.int32), np.asarray(artists, dtype=object))
+
+
+def read_compact(path, chunksize=None):
+    """
+    The valid scrobbles of the exports matching path as CompactScrobbles,
+    parsed a chunk at a time, and the number of rows read; only the
+    compact form of each chunk is kept
+    """
+    parts, n_rows = [], 0
+    for chunk in iter_aggregate_data(path, chunksize=chunksize or CHUNK_SIZE, dtype=str, names=COLUMNS):
+        parts.append(CompactScrobbles.from_scrobbles(parse_scrobbles(chunk)))
+        n_rows += len(chunk)
+    return CompactScrobbles.concat(parts), n_rows
+
+
+def encode_hashes(hashes):
+    """
+    Scrobble hashes as the text an aggregate keeps them in
+    """
+    return base64.b64encode(np.asarray(hashes, dtype='<u8').tobytes()).decode('ascii')
+
+
+def decode_hashes(text):
+    return np.frombuffer(base64.b64decode(text), dtype='<u8').astype(np.uint64)
+
+
+class DayAggregates:
+    """
+    Scrobbles reduced to one aggregate per day: how many plays, which
+    artists, and how many plays in each hour of the day. A scrobble (an
+    artist and track played at a minute) is only counted once, however
+    many of the inputs have it, eg. overlapping exports. Memory grows with
+    the number of days (and artists per day), and by 16 bytes per distinct
+    scrobble.
+
+    Each aggregate also keeps the hashes of its scrobbles, by hour, so
+    that aggregates of the same day can be merged (see merge_aggregates).
+    """
+
+    def __init__(self):
+        self.hours = dict()
+        self.artists = dict()
+        # Hashes of the scrobbles counted so far, sorted, and the hour
+        # (since the epoch) each was played in
+        self.seen = np.zeros(0, dtype=np.uint64)
+        self.seen_hours = np.zeros(0, dtype=np.int64)
+
+    def _unseen(self, hashes, hours):
+        # Positions of the scrobbles not counted yet, each once
+        hashes, first = np.unique(hashes, return_index=True)
+        positions = np.searchsorted(self.seen, hashes)
+        counted = self.seen[np.minimum(positions, len(self.seen) - 1)] == hashes \
+            if len(self.seen) else np.zeros(len(hashes), dtype=bool)
+        # Both sorted, so merged in one pass
+        self.seen = np.insert(self.seen, positions[~counted], hashes[~counted])
+        self.seen_hours = np.insert(self.seen_hours, positions[~counted], hours[first[~counted]])
+        return first[~counted]
+
+    def add(self, scrobbles):
+        """
+        Count scrobbles (CompactScrobbles) that are not counted yet
+        """
+        if not len(scrobbles):
+            return
+        unseen = self._unseen(scrobbles.hashes, scrobbles.minutes // 60)
+        minutes = scrobbles.minutes[unseen]
+        artist_codes = scrobbles.artist_codes[unseen].astype(np.int64)
+        days, codes = np.unique(minutes // (24 * 60), return_inverse=True)
+        if not len(days):
+            return
+        keys = days.astype('datetime64[D]').astype(str)
+        hours = np.bincount(codes * 24 + minutes % (24 * 60) // 60,
+            minlength=len(days) * 24).reshape(len(days), 24)
+        # Distinct (day, artist) pairs, sorted by day
+        n_artists = len(scrobbles.artists)
+        pairs = np.unique(codes.astype(np.int64) * n_artists + artist_codes)
+        bounds = np.searchsorted(pairs // n_artists, np.arange(len(days) + 1))
+        pair_names = scrobbles.artists[pairs % n_artists]
+        for i, key in enumerate(keys):
+            artists = pair_names[bounds[i]:bounds[i + 1]]
+            if key in self.hours:
+                self.hours[key] += hours[i]
+                self.artists[key].update(artists)
+            else:
+                self.hours[key] = hours[i].copy()
+                self.artists[key] = set(artists)
+
+    def days(self, field_name, schema):
+        """
+        A Day for every day with scrobbles, with its aggregate as its one
+        cumulative record of field_name
+        """
+        # The hashes of each day, by hour
+        order = np.argsort(self.seen_hours, kind='stable')
+        by_hour = self.seen_hours[order]
+        days = []
+        for key in sorted(self.hours):
+            first_hour = np.datetime64(key, 'D').astype(np.int64) * 24
+            start, end = np.searchsorted(by_hour, [first_hour, first_hour + 24])
+            d = Day(day_as_str=key)
+            d.add_record(field_name, aggregate_record(schema, self.hours[key], self.artists[key],
+                self.seen[order[start:end]]))
+            days.append(d)
+        return days
+
+
+def aggregate_record(schema, hours, artists, hashes):
+    # hashes are those of the day's scrobbles, by hour, as many as hours counts
+    return schema.record(with_digest(dict(
+        Plays=int(np.sum(hours)),
+        Artists=sorted(artists),
+        Hours=[int(h) for h in hours],
+        Scrobbles=encode_hashes(hashes)
+    )))
+
+
+def merge_aggregates(schema, stored, records):
+    """
+    The aggregate of a day's stored records and records (both lists of
+    aggregate records, eg. of exports ingested one at a time), counting a
+    scrobble they share once. Aggregates stored before they kept their
+    scrobbles can not be merged; records replace them.
+    """
+    aggregates = list(stored) + list(records)
+    if not stored or any(r.get("Scrobbles") is None for r in aggregates):
+        return list(records)
+    artists = set()
+    by_hour = [[] for _ in range(24)]
+    for r in aggregates:
+        artists.update(r["Artists"])
+        bounds = np.cumsum([0] + list(r["Hours"]))
+        hashes = decode_hashes(r["Scrobbles"])
+        for hour in range(24):
+            by_hour[hour].append(hashes[bounds[hour]:bounds[hour + 1]])
+    by_hour = [np.unique(np.concatenate(hashes)) for hashes in by_hour]
+    return [aggregate_record(schema, [len(hashes) for hashes in by_hour], artists,
+        np.concatenate(by_hour))]
+
+
+class ScrobbleStore:
+    """
+    Raw scrobbles, kept only on request, in an SQLite file next to the
+    database: every distinct (artist, album, track) is stored once, and a
+    scrobble as the minute it was played and the id of its track. A
+    scrobble that is already stored (eg. from an overlapping export) is
+    not added again.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, "
+            "artist TEXT NOT NULL, album TEXT NOT NULL, track TEXT NOT NULL, UNIQUE (artist, album, track))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scrobbles (played INTEGER NOT NULL, "
+            "track_id INTEGER NOT NULL, PRIMARY KEY (played, track_id)) WITHOUT ROWID")
+        self._ids = dict()
+
+    def _track_ids(self, tracks):
+        missing = [t for t in set(tracks) if t not in self._ids]
+        if missing:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tracks (artist, album, track) VALUES (?, ?, ?)", missing)
+            for t in missing:
+                self._ids[t] = self.connection.execute(
+                    "SELECT id FROM tracks WHERE artist = ? AND album = ? AND track = ?", t).fetchone()[0]
+        return [self._ids[t] for t in tracks]
+
+    def add(self, scrobbles):
+        """
+        Returns how many of scrobbles were not stored yet
+        """
+        tracks = list(zip(scrobbles["artist"], scrobbles["album"], scrobbles["track"]))
+        minutes = scrobbles["played"].to_numpy().astype('datetime64[m]').astype(np.int64).tolist()
+        before = self.connection.total_changes
+        self.connection.executemany("INSERT OR IGNORE INTO scrobbles (played, track_id) VALUES (?, ?)",
+            zip(minutes, self._track_ids(tracks)))
+        return self.connection.total_changes - before
+
+    def scrobbles(self, start=None, end=None):
+        """
+        Stored scrobbles from start to end (inclusive day keys, None for
+        open ended) as a DataFrame, in the order they were played
+        """
+        start_minute = None if start is None else \
+            int(np.datetime64(start, 'm').astype(np.int64))
+        end_minute = None if end is None else \
+            int((np.datetime64(end, 'D') + 1).astype('datetime64[m]').astype(np.int64))
+        rows = self.connection.execute(
+            "SELECT artist, album, track, played FROM scrobbles JOIN tracks ON tracks.id = track_id "
+            "WHERE (? IS NULL OR played >= ?) AND (? IS NULL OR played < ?) ORDER BY played, track_id",
+            (start_minute, start_minute, end_minute, end_minute)).fetchall()
+        df = pd.DataFrame(rows, columns=COLUMNS)
+        df["played"] = pd.to_datetime(df["played"].to_numpy(dtype=np.int64).astype('datetime64[m]'))
+        return df
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def build_days(path, field_name, schema, chunksize=None, scrobble_store=None):
+    """
+    Stream the scrobble exports matching path, chunksize rows at a time,
+    into per-day aggregates (see DayAggregates), counting the scrobbles
+    that several of them have once; given scrobble_store (a path), the
+    scrobbles themselves are also kept there. Returns the days and the
+    number of rows read.
+    """
+    aggregates = DayAggregates()
+    store = ScrobbleStore(scrobble_store) if scrobble_store else None
+    with stage("stream_scrobbles") as s:
+        n_rows, n_stored = 0, 0
+        try:
+            for chunk in iter_aggregate_data(path, chunksize=chunksize or CHUNK_SIZE,
+                    dtype=str, names=COLUMNS):
+                scrobbles = parse_scrobbles(chunk)
+                aggregates.add(CompactScrobbles.from_scrobbles(scrobbles))
+                if store is not None:
+                    n_stored += store.add(scrobbles)
+                n_rows += len(chunk)
+        finally:
+            if store is not None:
+                store.close()
+        s.set(rows=n_rows, stored=n_stored)
+    return aggregates.days(field_name, schema), n_rows
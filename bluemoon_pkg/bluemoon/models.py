@@ -1,8 +1,17 @@
-from datetime import datetime, timedelta
-import pandas as pd
+from datetime import datetime
+import numpy as np
+import sys
 import json
-import ephem
+import hashlib
 import calendar
+from concurrent.futures import ProcessPoolExecutor
+from .ephemeris import get_index
+from .storage import get_storage
+from .changelog import Changelog
+from .stats import StatsCache
+from .textindex import TextIndex
+from .columnar import ColumnStore, Column, EPOCH_ORDINAL
+from .instrument import stage
 
 def parse_day(day_as_str):
     pieces = day_as_str.split("-")
@@ -14,6 +23,246 @@ def str_to_day(day_as_str):
 def compound_field_name(field_name, subfield):
     return "{}_{}".format(field_name, subfield)
 
+def day_key(value):
+    """
+    Key of a day given as a datetime or a string, eg. "2018-5-1"
+    """
+    return Day.get_key(str_to_day(value) if isinstance(value, str) else value)
+
+def _json_default(value):
+    # numpy scalars digest the same as the python values they hold
+    return value.item() if hasattr(value, "item") else str(value)
+
+class RecordSchema:
+    """
+    Field names shared by all cumulative records of a data source. Records
+    are stored as Record tuples in field order, with the values of
+    categorical fields (eg. Project, Tags) interned.
+    """
+
+    _schemas = dict()
+
+    def __init__(self, fields, categorical_fields=()):
+        self.fields = tuple(sys.intern(f) for f in fields)
+        self.positions = {f: i for i, f in enumerate(self.fields)}
+        self.categorical = tuple(self.positions[f] for f in categorical_fields)
+        # A Digest field is computed when records are made, not stored
+        self.digest = self.positions.get("Digest")
+        self.stored_fields = frozenset(f for f in self.fields if f != "Digest")
+        self.record_class = type("Record", (Record,), dict(__slots__=(), schema=self))
+
+    @classmethod
+    def get(cls, fields, categorical_fields=()):
+        """
+        One schema per set of fields, so records can share it
+        """
+        fields = tuple(fields)
+        if fields not in cls._schemas:
+            cls._schemas[fields] = cls(fields, categorical_fields)
+        return cls._schemas[fields]
+
+    def record(self, record_dict):
+        values = [record_dict.get(f) for f in self.fields]
+        for i in self.categorical:
+            if type(values[i]) == str:
+                values[i] = sys.intern(values[i])
+        if self.digest is not None and values[self.digest] is None:
+            values[self.digest] = record_digest(record_dict)
+        return self.record_class(values)
+
+class Record(tuple):
+    """
+    A cumulative record that reads like the dict it was made from
+    """
+
+    __slots__ = ()
+    schema = None
+
+    def __getitem__(self, key):
+        if type(key) == str:
+            return tuple.__getitem__(self, self.schema.positions[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self.schema.positions.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self.schema.fields
+
+    def items(self):
+        return zip(self.schema.fields, self)
+
+    def as_dict(self):
+        return dict(zip(self.schema.fields, self))
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def __reduce__(self):
+        return (_restore_record, (self.schema.fields, self.schema.categorical, tuple(self)))
+
+def _restore_record(fields, categorical, values):
+    schema = RecordSchema.get(fields, [fields[i] for i in categorical])
+    return schema.record(dict(zip(fields, values)))
+
+_field_schemas = dict()
+
+def _record_schema(field_name):
+    # The RecordSchema of the data source named field_name, if it has one
+    if field_name not in _field_schemas:
+        from .data_sources import DataSource
+        try:
+            _field_schemas[field_name] = DataSource(field_name).get_record_schema()
+        except ValueError:
+            _field_schemas[field_name] = None
+    return _field_schemas[field_name]
+
+def intern_keys(data):
+    # Field names loaded day by day are otherwise one string per day
+    return {sys.intern(k): v for k, v in data.items()}
+
+def compact_records(cumulative):
+    """
+    Turn the records of cumulative (eg. as loaded from storage) into Record
+    tuples of their source's RecordSchema, in place, with their Digest
+    computed again; records that do not have exactly its other fields (eg.
+    from older versions) are left as they are
+    """
+    for field_name, records in cumulative.items():
+        schema = _record_schema(field_name)
+        if schema is not None:
+            compact = []
+            for r in records:
+                if type(r) == dict:
+                    # Digests stored by earlier versions covered derived fields too
+                    r.pop("Digest", None)
+                    if r.keys() == schema.stored_fields:
+                        r = schema.record(r)
+                compact.append(r)
+            cumulative[field_name] = compact
+    return cumulative
+
+def as_serializable(record):
+    return {k: v for k, v in record.items() if k != "Digest"} \
+        if isinstance(record, (dict, Record)) else record
+
+# Fields of cumulative records that are derived at ingest rather than read
+# from the source's export
+DERIVED_RECORD_FIELDS = frozenset(["Texts", "Minutes", "Digest"])
+
+def record_digest(record):
+    """
+    Stable digest of a cumulative record's fields as read from the source's
+    export, so a record digests the same whichever version ingested it.
+    Record tuples carry theirs, computed when they are made.
+    """
+    if isinstance(record, Record) and record.get("Digest"):
+        return record["Digest"]
+    if isinstance(record, (dict, Record)):
+        record = {k: v for k, v in record.items() if k not in DERIVED_RECORD_FIELDS}
+    content = json.dumps(record, sort_keys=True, default=_json_default)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+
+def with_digest(record):
+    record["Digest"] = record_digest(record)
+    return record
+
+def vectorized_analysis(analysis_function):
+    """
+    Marks a dataset analysis as vectorized, see Dataset.add_dataset_analysis
+    """
+    analysis_function.vectorized = True
+    return analysis_function
+
+def dependency_window(window):
+    """
+    Marks a dataset analysis as depending only on days at most window days
+    away, see Dataset.add_dataset_analysis
+    """
+    def mark(analysis_function):
+        analysis_function.window = window
+        return analysis_function
+    return mark
+
+def _within(ordinals, center_ordinals, window):
+    """
+    Mask of ordinals at most window days away from any of center_ordinals
+    """
+    centers = np.unique(center_ordinals)
+    if len(centers) == 0:
+        return np.zeros(len(ordinals), dtype=bool)
+    i = np.searchsorted(centers, ordinals)
+    after = centers[np.minimum(i, len(centers) - 1)]
+    before = centers[np.maximum(i - 1, 0)]
+    return np.minimum(np.abs(after - ordinals), np.abs(ordinals - before)) <= window
+
+def _selected_fields(names, fields, sources):
+    """
+    The names in fields, in that order, then those of names belonging to
+    sources (eg. DataSource.oura or "*oura", and its compound fields);
+    all names when neither is given
+    """
+    if fields is None and sources is None:
+        return list(names)
+    selected = list(fields or [])
+    prefixes = [str(source) for source in sources or []]
+    for name in names:
+        if name not in selected and \
+                any(name == p or name.startswith(p + "_") for p in prefixes):
+            selected.append(name)
+    return selected
+
+def _selection(keys, ordinals, columns, as_arrays=False):
+    """
+    Selected days as a DataFrame with day_dt and day_str, as asDataFrame;
+    or as a dict of numpy arrays, numeric ones with NaN where missing
+    """
+    import pandas as pd
+
+    day_dt = (np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+    frame = dict(day_dt=day_dt.astype('datetime64[us]'), day_str=np.asarray(keys, dtype=object))
+    frame.update(columns)
+    frame = pd.DataFrame(frame)
+    if not as_arrays:
+        return frame
+    arrays = dict()
+    for name, series in frame.items():
+        if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            arrays[name] = series.to_numpy(dtype=np.float64 if series.hasnans else None,
+                na_value=np.nan)
+        else:
+            arrays[name] = series.to_numpy()
+    return arrays
+
+def _column_arrays(keys, ordinals, columns):
+    """
+    Same as _selection with as_arrays, for columnar.Column objects, without
+    pandas (see Column.as_numpy)
+    """
+    day_dt = (np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+    arrays = dict(day_dt=day_dt.astype('datetime64[us]'), day_str=np.asarray(keys, dtype=object))
+    for name, column in columns.items():
+        arrays[name] = column.as_numpy(len(keys))
+    return arrays
+
+def _compute_analysis(analysis_function, vectorized, days, keys, ordinals, target=None):
+    """
+    Run an analysis on days, keeping only the results for the target days;
+    may run in a worker process
+    """
+    if vectorized:
+        values = analysis_function(days, keys, ordinals)
+        if target is None:
+            return values
+        if type(values) == dict:
+            return {subfield: np.asarray(v)[target] for subfield, v in values.items()}
+        return np.asarray(values)[target]
+    values = analysis_function(days)
+    if target is None:
+        return values
+    return {k: values.get(k) for k in keys[target]}
+
 class Dataset:
 
     def count_cumulative_entries(self, field):
@@ -25,22 +274,43 @@ class Dataset:
 
     def update(self, immutable_dataset):
         days_affected = []
-        # The self object will be updated with values from immutable_dataset
-        for key, d in self.days.items():
-            other_day = immutable_dataset.days.get(key)
-            if other_day and d.update(other_day, overwrite_fields=True):
+        new_days = []
+        # The self object will be updated with values from immutable_dataset;
+        # only its days are looked at, so updates do not grow with history
+        for key, other_day in immutable_dataset.days.items():
+            d = self.days.get(key)
+            if not d:
+                new_days.append(key)
+            elif d.update(other_day, overwrite_fields=True):
                 days_affected.append(key)
-        for key, d in immutable_dataset.days.items():
-            if not self.days.get(key):
-                days_affected.append(key)
-                self.days[key] = d
+        for key in new_days:
+            self.days[key] = immutable_dataset.days[key]
+        days_affected.extend(new_days)
+        if self.columns is not None:
+            for key in days_affected:
+                self.columns.set_day(self.days[key])
+        if self.text_index is not None:
+            for key in days_affected:
+                self.text_index.set_day(self.days[key])
+
+        for field_name, analysis_function in immutable_dataset.dataset_analyses.items():
+            if field_name not in self.dataset_analyses:
+                self.add_dataset_analysis(field_name, analysis_function,
+                    vectorized=field_name in immutable_dataset.vectorized_analyses,
+                    window=immutable_dataset.analysis_windows.get(field_name))
+        if self.ready:
+            self.set_ready(True, days_affected=days_affected)
         return days_affected
 
-    def __init__(self, today=None):
+    def __init__(self, today=None, columnar=False):
         """
-        When today is not explicitly set, datetime.today() will be used
+        When today is not explicitly set, datetime.today() will be used.
+        With columnar=True, day data is mirrored in a ColumnStore, which
+        asDataFrame is built from.
         """
         self.days = dict()
+        self.columns = ColumnStore() if columnar else None
+        self.text_index = None
         self._ready = False
         if today:
             assert type(today) == datetime
@@ -49,77 +319,329 @@ class Dataset:
             self.today = datetime.today()
             self.today = datetime(self.today.year, self.today.month, self.today.day)
 
-        self.dataset_analyses = dict(
-            availability=Dataset.calculate_data_availability,
-            days_before=self.calculate_days_before
-        )
+        self.dataset_analyses = dict()
+        self.vectorized_analyses = set()
+        self.analysis_windows = dict()
+        # Fields written by each analysis, so they can be dropped again
+        self.analysis_fields = dict()
+        self._sorted_index = None
+        self.add_dataset_analysis("availability", Dataset.calculate_data_availability)
+        self.add_dataset_analysis("days_before", self.calculate_days_before)
 
-    def add_dataset_analysis(self, field_name, analysis_function):
+    def add_dataset_analysis(self, field_name, analysis_function, vectorized=None, window=None):
         """
         Have a field name to bind the result to; if result is itself a dict,
         that many filds will be added with the field_name as prefix.
         Analysis function should expect all days as a dict, and should
         provide a dict of values or a dict of dicts of values.
+
+        Vectorized analyses (vectorized=True, or marked with
+        @vectorized_analysis) are called with all days as a dict plus their
+        keys and day ordinals as aligned numpy arrays, and should provide
+        an array of values or a dict of arrays of values.
+
+        An analysis with a dependency window (window=n, or marked with
+        @dependency_window(n)) only looks at days up to n days away, so
+        after an update it is only rerun around the affected days.
+        Without one, it is always rerun over all days.
         """
         if analysis_function is not None:
             self.dataset_analyses[field_name] = analysis_function
+            if vectorized is None:
+                vectorized = getattr(analysis_function, "vectorized", False)
+            if vectorized:
+                self.vectorized_analyses.add(field_name)
+            else:
+                self.vectorized_analyses.discard(field_name)
+            if window is None:
+                window = getattr(analysis_function, "window", None)
+            self.analysis_windows[field_name] = window
+            if self.ready:
+                self._run_analysis(field_name)
+
+    def day_index(self):
+        """
+        Keys and day ordinals of all days, as numpy arrays in days order
+        """
+        keys = np.array(list(self.days.keys()), dtype=object)
+        ordinals = np.fromiter((d.ordinal for d in self.days.values()),
+            dtype=np.int64, count=len(self.days))
+        return keys, ordinals
+
+    def sorted_index(self):
+        """
+        Keys and day ordinals of all days, as numpy arrays in date order;
+        kept until days are added
+        """
+        if self._sorted_index is None or len(self._sorted_index[0]) != len(self.days):
+            keys, ordinals = self.day_index()
+            order = np.argsort(ordinals, kind='stable')
+            self._sorted_index = (keys[order], ordinals[order])
+        return self._sorted_index
+
+    def select(self, fields=None, start=None, end=None, sources=None, as_arrays=False):
+        """
+        Data fields (by name, and/or all those of the given sources) of the
+        days from start to end (inclusive; day keys or datetimes, None for
+        open ended), in date order. Returns a DataFrame with day_dt and
+        day_str, as asDataFrame, or with as_arrays=True a dict of arrays.
+        Only the selected days are looked at.
+        """
+        keys, ordinals = self.sorted_index()
+        lo = 0 if start is None else \
+            np.searchsorted(ordinals, str_to_day(day_key(start)).toordinal(), side='left')
+        hi = len(ordinals) if end is None else \
+            np.searchsorted(ordinals, str_to_day(day_key(end)).toordinal(), side='right')
+        keys, ordinals = keys[lo:hi], ordinals[lo:hi]
+
+        if self.columns is not None:
+            names = _selected_fields(self.columns.columns.keys(), fields, sources)
+            columns = {name: self.columns.take(name, keys) for name in names}
+        else:
+            data = [self.days[k].data for k in keys]
+            names = _selected_fields(dict.fromkeys(name for d in data for name in d), fields, sources)
+            columns = {name: [d.get(name) for d in data] for name in names}
+        return _selection(keys, ordinals, columns, as_arrays)
+
+    def enable_columnar(self):
+        if self.columns is None:
+            self.columns = ColumnStore()
+            for day in self.days.values():
+                self.columns.set_day(day)
+
+    def enable_text_index(self):
+        """
+        Index the Texts of cumulative records (see TextIndex), from then on
+        kept up to date as days are added and updated
+        """
+        if self.text_index is None:
+            self.text_index = TextIndex.build(self.days.values())
+        return self.text_index
+
+    def search(self, query, field=None):
+        """
+        Keys of the days, in date order, with a cumulative record (of field,
+        or any) whose Texts mention every word of query, eg. "React"
+        """
+        ordinals = self.enable_text_index().days(query, field)
+        return (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype(str).tolist()
 
     def add(self, day, overwrite_fields):
         if self.days.get(day.key):
             self.days[day.key].update(day, overwrite_fields)
         else:
             self.days[day.key] = day
+        if self.columns is not None:
+            self.columns.set_day(self.days[day.key])
+        if self.text_index is not None:
+            self.text_index.set_day(self.days[day.key])
 
     def drop_field(self, field_name):
         for day in self.days.values():
             day.drop_field(field_name)
+        if self.columns is not None:
+            self.columns.drop_column(field_name)
 
-    def create_field(self, field_name, values_by_day):
-        for key, day in self.days.items():
+    def create_field(self, field_name, values_by_day, keys=None):
+        """
+        Set the field for every day, or only for the days in keys;
+        returns the names of the fields that were set
+        """
+        new_columns = dict()
+        days = self.days.items() if keys is None else [(k, self.days[k]) for k in keys]
+        for key, day in days:
             if type(values_by_day.get(key)) == dict:
                 for subfield, value in values_by_day.get(key).items():
                     day.set_value(
                         compound_field_name(field_name, subfield),
                         value
                     )
+                    new_columns.setdefault(compound_field_name(field_name, subfield), {})[key] = value
             else:
                 day.set_value(field_name, values_by_day.get(key))
+                new_columns.setdefault(field_name, {})[key] = values_by_day.get(key)
+
+        if self.columns is not None:
+            for column_name, values in new_columns.items():
+                if keys is None:
+                    self.columns.set_column(column_name, list(values.keys()), list(values.values()))
+                else:
+                    self.columns.update_column(column_name, list(values.keys()), list(values.values()))
+        return list(new_columns.keys())
+
+    def create_field_from_arrays(self, field_name, keys, values, partial=False):
+        """
+        Same as create_field, for values (or a dict of subfield values)
+        given as arrays aligned with keys; partial when keys are not all days
+        """
+        if type(values) != dict:
+            values = {None: values}
+        column_names = []
+        for subfield, subfield_values in values.items():
+            column_name = field_name if subfield is None else \
+                compound_field_name(field_name, subfield)
+            subfield_values = np.asarray(subfield_values).tolist()
+            for key, value in zip(keys, subfield_values):
+                self.days[key].set_value(column_name, value)
+            if self.columns is not None:
+                if partial:
+                    self.columns.update_column(column_name, keys, subfield_values)
+                else:
+                    self.columns.set_column(column_name, keys, subfield_values)
+            column_names.append(column_name)
+        return column_names
 
     @property
     def ready(self):
         return self._ready
 
-    def set_ready(self, value):
+    def _run_analysis(self, field_name, day_index=None, days_affected=None, executor=None, workers=1):
+        """
+        Run one analysis over all days; or, given days_affected and a
+        dependency window, only set its fields within the window around
+        those days, running it on those days and their own window.
+        Given an executor, an analysis with a dependency window runs on
+        workers contiguous shares of the days, each with the window around
+        it; analyses that are methods of this dataset always run here.
+        """
+        analysis_function = self.dataset_analyses[field_name]
+        vectorized = field_name in self.vectorized_analyses
+        keys, ordinals = day_index or self.day_index()
+        window = self.analysis_windows.get(field_name)
+        parallel = executor is not None and window is not None and \
+            getattr(analysis_function, "__self__", None) is not self
+
+        if window is None or (days_affected is None and not parallel):
+            targets = None
+        else:
+            if days_affected is None:
+                target = np.ones(len(keys), dtype=bool)
+            else:
+                target = _within(ordinals, [self.days[k].ordinal for k in days_affected], window)
+            if not target.any():
+                return
+            indices = np.flatnonzero(target)
+            if parallel:
+                indices = indices[np.argsort(ordinals[indices], kind='stable')]
+                targets = [t for t in np.array_split(indices, workers) if len(t)]
+            else:
+                targets = [indices]
+
+        if targets is None:
+            values = _compute_analysis(analysis_function, vectorized, self.days, keys, ordinals)
+            if vectorized:
+                column_names = self.create_field_from_arrays(field_name, keys, values)
+            else:
+                column_names = self.create_field(field_name, values)
+            self.analysis_fields.setdefault(field_name, set()).update(column_names)
+            return
+
+        jobs = []
+        for target in targets:
+            context = _within(ordinals, ordinals[target], window)
+            in_target = np.zeros(len(keys), dtype=bool)
+            in_target[target] = True
+            jobs.append((analysis_function, vectorized, {k: self.days[k] for k in keys[context]},
+                keys[context], ordinals[context], in_target[context]))
+        if parallel:
+            results = list(executor.map(_compute_analysis, *zip(*jobs)))
+        else:
+            results = [_compute_analysis(*job) for job in jobs]
+        target_keys = np.concatenate([job[3][job[5]] for job in jobs])
+
+        # Results are merged in the order of the shares, so they do not
+        # depend on which worker finishes first
+        partial = days_affected is not None
+        if vectorized:
+            if type(results[0]) == dict:
+                values = {subfield: np.concatenate([r[subfield] for r in results]) \
+                    for subfield in results[0]}
+            else:
+                values = np.concatenate(results)
+            column_names = self.create_field_from_arrays(field_name, target_keys, values,
+                partial=partial)
+        else:
+            values = dict()
+            for r in results:
+                values.update(r)
+            column_names = self.create_field(field_name, values,
+                keys=target_keys if partial else None)
+        self.analysis_fields.setdefault(field_name, set()).update(column_names)
+
+    def set_ready(self, value, days_affected=None, workers=None):
+        """
+        Given days_affected (eg. as returned by update) on a ready dataset,
+        only the days within each analysis's dependency window are redone.
+        With workers > 1, analyses with a dependency window are split
+        across that many worker processes.
+        """
         if value:
-            for field_name, analysis_function in self.dataset_analyses.items():
-                self.create_field(field_name, analysis_function(self.days))
+            if not self.ready:
+                days_affected = None
+            day_index = self.day_index()
+            executor = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+            try:
+                for field_name in self.dataset_analyses.keys():
+                    with stage("analysis.%s"%field_name,
+                            days=len(self.days) if days_affected is None else len(days_affected)):
+                        self._run_analysis(field_name, day_index, days_affected,
+                            executor=executor, workers=workers)
+            finally:
+                if executor is not None:
+                    executor.shutdown()
 
             self._ready = True
         else:
             self._ready = False
             for field_name in self.dataset_analyses.keys():
-                self.drop_field(field_name)
+                for column_name in self.analysis_fields.pop(field_name, [field_name]):
+                    self.drop_field(column_name)
 
     @staticmethod
-    def calculate_data_availability(all_days):
-        data_availability = {}
-        for key, day in all_days.items():
-            data_availability[key] = data_availability.get(key, 0) + 1
-
-            for other_day in [
-                Day.get_key(day.day_as_dt + timedelta(days=1)),
-                Day.get_key(day.day_as_dt - timedelta(days=1))
-            ]:
-                if other_day in all_days:
-                    data_availability[other_day] = data_availability.get(other_day, 0) + 1/3
+    @vectorized_analysis
+    @dependency_window(1)
+    def calculate_data_availability(all_days, keys, ordinals):
+        """
+        1 for the day itself, plus 1/3 for each neighbouring day with data
+        """
+        if len(ordinals) == 0:
+            return np.zeros(0)
+        order = np.argsort(ordinals, kind='stable')
+        sorted_ordinals = ordinals[order]
+        consecutive = np.diff(sorted_ordinals) == 1
+        has_previous = np.concatenate([[False], consecutive])
+        has_next = np.concatenate([consecutive, [False]])
+
+        data_availability = np.empty(len(ordinals))
+        data_availability[order] = 1 + has_previous / 3 + has_next / 3
         return data_availability
 
-    def calculate_days_before(self, all_days):
-        return {key: (self.today - day.day_as_dt).days for key, day in all_days.items()}
+    @vectorized_analysis
+    @dependency_window(0)
+    def calculate_days_before(self, all_days, keys, ordinals):
+        return self.today.toordinal() - ordinals
 
-    def asDataFrame(self):
+    def asDataFrame(self, text_features=None, as_bool=False):
+        """
+        text_features: queries (or a dict of column names to queries) of
+        the text index (see search), added as columns with the number of
+        records of each day that match, or whether any do with as_bool
+        """
         assert self.ready
-        return pd.DataFrame([d.as_dict() for d in self.days.values()])
+        if self.columns is not None:
+            df = self.columns.as_dataframe()
+        else:
+            import pandas as pd
+            df = pd.DataFrame([d.as_dict() for d in self.days.values()])
+        if text_features:
+            if type(text_features) != dict:
+                text_features = {"text_%s"%query: query for query in text_features}
+            ordinals = df["day_dt"].to_numpy().astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+            index = self.enable_text_index()
+            for column, query in text_features.items():
+                counts = index.count_array(query, ordinals)
+                df[column] = counts > 0 if as_bool else counts
+        return df
 
 class Day:
 
@@ -131,40 +653,42 @@ class Day:
     def get_key(datetime):
         return datetime.strftime('%Y-%m-%d')
 
+    # Days are kept for years of history, so they carry no __dict__;
+    # the date itself is kept as its ordinal
+    __slots__ = ("ordinal", "day_as_str", "data", "cumulative")
+
     def __init__(self, day_dt=None, year=None, month=None, day=None, day_as_str=None):
         if day_dt:
             year, month, day = day_dt.year, day_dt.month, day_dt.day
         elif day_as_str:
             year, month, day = parse_day(day_as_str)
         assert year and month and day
-        self.day_as_dt = datetime(year, month, day)
-        self.day_as_str = Day.get_key(self.day_as_dt)
+        day_as_dt = datetime(year, month, day)
+        self.ordinal = day_as_dt.toordinal()
+        self.day_as_str = Day.get_key(day_as_dt)
 
         self.data = dict(
             moon=self._get_moon(),
-            weekday_str=calendar.day_name[self.day_as_dt.weekday()],
-            weekday_num=self.day_as_dt.weekday(),
+            weekday_str=calendar.day_name[day_as_dt.weekday()],
+            weekday_num=day_as_dt.weekday(),
             season=self._get_season()
         )
         self.cumulative = dict()
 
+    @property
+    def day_as_dt(self):
+        return datetime.fromordinal(self.ordinal)
+
     @property
     def weekday_char(self):
         return "R" if self.data["weekday_str"] == "Thursday" else self.data["weekday_str"][0]
 
     def _get_moon(self):
-        return min(
-            (ephem.localtime(ephem.next_full_moon(self.day_as_dt)) - self.day_as_dt).days,
-            (self.day_as_dt - ephem.localtime(ephem.previous_full_moon(self.day_as_dt))).days
-        )
+        # Lookup in the precomputed table, see ephemeris.ephem_moon
+        return get_index().moon(self.day_as_dt)
 
     def _get_season(self):
-        return min(
-            (ephem.localtime(ephem.next_equinox(self.day_as_dt)) - self.day_as_dt).days,
-            (self.day_as_dt - ephem.localtime(ephem.previous_equinox(self.day_as_dt))).days,
-            (ephem.localtime(ephem.next_solstice(self.day_as_dt)) - self.day_as_dt).days,
-            (self.day_as_dt - ephem.localtime(ephem.previous_solstice(self.day_as_dt))).days
-        )
+        return get_index().season(self.day_as_dt)
 
     def drop_field(self, field_name):
         if field_name in self.data:
@@ -185,7 +709,8 @@ class Day:
             in dict_.items() if k in serialize_fields or not serialize_fields}
         return dict(
             data=serialized_only(self.data),
-            cumulative=serialized_only(self.cumulative)
+            cumulative={k: [as_serializable(v) for v in vs] for k, vs \
+                in serialized_only(self.cumulative).items()}
         )
 
     def as_dict(self):
@@ -203,12 +728,20 @@ class Day:
         overwritten = False
         for key, vs in other_day.cumulative.items():
             if overwrite_fields:
-                if str(self.cumulative.get(key)) != str(vs):
+                if [record_digest(v) for v in self.cumulative.get(key, [])] != \
+                        [record_digest(v) for v in vs]:
                     overwritten = True
                 self.cumulative[key] = vs
             else:
+                # Records that are already there (eg. from overlapping
+                # exports) are not added again
                 self.cumulative[key] = self.cumulative.get(key, [])
-                self.cumulative[key].extend(vs)
+                seen = set([record_digest(v) for v in self.cumulative[key]])
+                for v in vs:
+                    digest = record_digest(v)
+                    if digest not in seen:
+                        seen.add(digest)
+                        self.cumulative[key].append(v)
 
         for k, v in other_day.data.items():
             if self.data.get(k) != v:
@@ -216,56 +749,289 @@ class Day:
             self.data[k] = v
         return overwritten
 
+class LazyDay(Day):
+    """
+    A day loaded from its serialized payload (a dict, its JSON text, or a
+    function that reads it, eg. from a snapshot).
+    Calendar features are not computed, and data and cumulative are only
+    materialized when first accessed.
+    """
+
+    __slots__ = ("_payload", "_data", "_cumulative")
+
+    def __init__(self, day_as_str, payload):
+        day_as_dt = str_to_day(day_as_str)
+        self.ordinal = day_as_dt.toordinal()
+        self.day_as_str = Day.get_key(day_as_dt)
+        self._payload = payload
+        self._data = None
+        self._cumulative = None
+
+    @property
+    def materialized(self):
+        return self._payload is None
+
+    def _parsed_payload(self):
+        if isinstance(self._payload, str):
+            return json.loads(self._payload)
+        if callable(self._payload):
+            return self._payload()
+        return self._payload
+
+    def _materialize(self):
+        if self._payload is not None:
+            payload = self._parsed_payload()
+            self._data = intern_keys(payload.get("data", {}))
+            self._cumulative = compact_records(payload.get("cumulative", {}))
+            self._payload = None
+
+    @property
+    def data(self):
+        self._materialize()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._materialize()
+        self._data = value
+
+    @property
+    def cumulative(self):
+        self._materialize()
+        return self._cumulative
+
+    @cumulative.setter
+    def cumulative(self, value):
+        self._materialize()
+        self._cumulative = value
+
+    def serialize(self, serialize_fields=[]):
+        if self.materialized:
+            return Day.serialize(self, serialize_fields)
+        # Untouched days are written back from the payload as they are
+        payload = self._parsed_payload()
+        serialized_only = lambda dict_: {k:v for k, v \
+            in dict_.items() if k in serialize_fields or not serialize_fields}
+        return dict(
+            data=serialized_only(payload.get("data", {})),
+            cumulative=serialized_only(payload.get("cumulative", {}))
+        )
+
 class AllData:
 
-    def __init__(self):
+    def __init__(self, storage=None):
+        self.storage = storage
         self.from_dict({})
 
     def set_serializable_field(self, field_name):
         self.meta["serialize_fields"].add(field_name)
 
     @classmethod
-    def build(cls, db_target):
-        all_data = cls()
-        try:
-            f = open(db_target)
-            all_data.from_dict(json.load(f))
-        except Exception as e:
-            print(e)
-            print("Created a new StorytellerDB.")
-            with open(db_target, 'w', encoding='utf-8') as f:
-                json.dump(all_data.as_dict(), f, ensure_ascii=False, indent=2)
+    def build(cls, db_target, lazy=False, start=None, end=None):
+        """
+        The storage backend is picked by storage.get_storage(db_target).
+        With lazy=True, stored days are kept as LazyDay objects, so only
+        the days that are accessed (eg. by an update) are materialized.
+        Given start and/or end (day keys or datetimes, inclusive), only
+        those days are loaded; saving keeps the others as they are stored.
+        """
+        all_data = cls(storage=get_storage(db_target))
+        start = day_key(start) if start else None
+        end = day_key(end) if end else None
+        with stage("AllData.build", lazy=lazy) as s:
+            try:
+                d = all_data.storage.load(start=start, end=end, lazy=lazy)
+                all_data.from_dict(d, lazy=lazy, changelog=all_data.storage.load_changelog(),
+                    complete=not (start or end))
+            except Exception as e:
+                print(e)
+                print("Created a new StorytellerDB.")
+                all_data.save(days_affected=None)
+            s.set(days=len(all_data.dataset.days))
         return all_data
 
-    def from_dict(self, d):
+    @classmethod
+    def query(cls, db_target, fields=None, start=None, end=None, sources=None, as_arrays=False):
+        """
+        Same as select, straight from storage, without loading the
+        database: only the data of the days from start to end is read,
+        and only the fields selected are parsed (picked by SQLite, from
+        an SQLite database).
+        From a snapshot, numeric fields are its arrays as they are, and
+        as_arrays needs no pandas; the arrays are read-only.
+        """
+        storage = get_storage(db_target)
+        start = day_key(start) if start else None
+        end = day_key(end) if end else None
+        if hasattr(storage, "load_columns"):
+            keys, ordinals, stored = storage.load_columns(start=start, end=end,
+                fields=fields, sources=sources)
+            columns = {name: stored[name] if name in stored else Column("object", len(keys)) \
+                for name in _selected_fields(stored.keys(), fields, sources)}
+            if as_arrays:
+                return _column_arrays(keys, ordinals, columns)
+            return _selection(keys, ordinals, {name: c.as_numpy(len(keys)) for name, c in columns.items()})
+        rows = storage.load_data(start=start, end=end, fields=fields, sources=sources)
+        data = [d for k, d in rows]
+        names = _selected_fields(dict.fromkeys(name for d in data for name in d), fields, sources)
+        return _selection(
+            [k for k, d in rows],
+            [str_to_day(k).toordinal() for k, d in rows],
+            {name: [d.get(name) for d in data] for name in names},
+            as_arrays
+        )
+
+    def select(self, fields=None, start=None, end=None, sources=None, as_arrays=False):
+        """
+        See Dataset.select; AllData.query does the same without loading
+        """
+        return self.dataset.select(fields=fields, start=start, end=end, sources=sources,
+            as_arrays=as_arrays)
+
+    def save(self, days_affected=None):
+        """
+        Persist through the storage backend. By default, only the days
+        affected by updates since the last load or save are written,
+        where the backend supports it.
+        """
+        assert self.storage is not None
+        # eg. {"max_entries": 1000, "compact": true}, see Changelog.apply_policy
+        self.changelog.apply_policy(**self.meta.get("changelog_policy", {}))
+        serialize_fields = self.meta.get("serialize_fields")
+        if serialize_fields:
+            # Statistics and the text index only cover the data that is stored
+            if self.stats is not None:
+                self.stats.keep(lambda field_name: field_name in serialize_fields)
+            if self.dataset.text_index is not None:
+                self.dataset.text_index.keep(lambda field_name: field_name in serialize_fields)
+        if days_affected is None and self.days_affected is not None:
+            days_affected = sorted(self.days_affected)
+        with stage("AllData.save", storage=type(self.storage).__name__,
+                days=len(self.dataset.days) if days_affected is None else len(days_affected)):
+            self.storage.save(self, days_affected=days_affected)
+        self.days_affected = set()
+        self.changelog.saved()
+
+    def from_dict(self, d, lazy=False, changelog=None, complete=True):
+        """
+        changelog: entries stored apart from d (see Changelog); entries in
+        d itself are from earlier versions. complete: whether d holds all
+        stored days, rather than a date range of them
+        """
         self.dataset = Dataset()
         for k, v in d.get("days", {}).items():
-            day = Day(day_as_str=k)
-            day.data = v.get("data", {})
-            day.cumulative = v.get("cumulative", {})
+            if lazy:
+                day = LazyDay(k, v)
+            else:
+                if isinstance(v, str):
+                    v = json.loads(v)
+                elif callable(v):
+                    v = v()
+                day = Day(day_as_str=k)
+                day.data = intern_keys(v.get("data", {}))
+                day.cumulative = compact_records(v.get("cumulative", {}))
             self.dataset.add(day, overwrite_fields=False)
+        # Databases from before the text index get theirs on first search;
+        # one built from only some of the days is not stored
+        self.complete = complete
+        text_index = d.get("text_index")
+        if text_index is not None:
+            self.dataset.text_index = TextIndex.from_dict(text_index)
+        elif not self.dataset.days and complete:
+            self.dataset.enable_text_index()
+        self.text_index_complete = complete or text_index is not None
         self.experiments = d.get("experiments", {})
         self.meta = d.get("meta", {})
         self.meta["serialize_fields"] = set(self.meta.get("serialize_fields", set()))
-        self.changelog = d.get("changelog", [])
+        # Databases from before the statistics cache get theirs on first use
+        stats = self.meta.pop("stats", None)
+        self.stats = StatsCache.from_dict(stats) if stats is not None else \
+            (None if self.dataset.days or not complete else StatsCache())
+        legacy = d.get("changelog")
+        self.changelog = Changelog.load(legacy=legacy if isinstance(legacy, list) else [],
+            segment=changelog)
+        # None means unknown, so the next save writes every day
+        self.days_affected = set() if d else None
 
-    def as_dict(self):
+    def as_dict(self, days=True):
         meta_ = {k:v for k, v in self.meta.items()}
         meta_["serialize_fields"] = list(meta_.get("serialize_fields", []))
-        days_ = {k: v.serialize(self.meta.get("serialize_fields")) for k, v in self.dataset.days.items()}
-        return dict(
+        if self.stats is not None:
+            meta_["stats"] = self.stats.as_dict()
+        days_ = {k: v.serialize(self.meta.get("serialize_fields")) for k, v in self.dataset.days.items()} \
+            if days else {}
+        d = dict(
             days=days_,
             experiments=self.experiments,
             meta=meta_,
-            changelog=self.changelog
+            changelog=self.changelog.entries
         )
+        if self.dataset.text_index is not None and self.text_index_complete:
+            d["text_index"] = self.dataset.text_index.as_dict()
+        return d
+
+    def statistics(self):
+        """
+        Per field running statistics over all days (see StatsCache), built
+        from the days only the first time for databases without them (and
+        over the loaded days only, and not kept, after a date range load)
+        """
+        if self.stats is None:
+            stats = StatsCache.build(self.dataset.days.values(), self.dataset.dataset_analyses)
+            if not self.complete:
+                return stats
+            self.stats = stats
+        return self.stats
+
+    def _stats_snapshot(self, immutable_dataset):
+        # Data of the stored days the update may change, before it does
+        if self.stats is None:
+            return None
+        self.stats.derive(set(self.dataset.dataset_analyses).union(immutable_dataset.dataset_analyses,
+            *(d.cumulative.keys() for d in immutable_dataset.days.values())))
+        days = self.dataset.days
+        return {k: dict(days[k].data) for k in immutable_dataset.days.keys() if k in days}
+
+    def _update_stats(self, days_affected, before):
+        if self.stats is not None:
+            self.stats.update(before, {k: self.dataset.days[k].data for k in days_affected})
+
+    def update_batch(self, datasets, descriptions, workers=None):
+        """
+        Merge several datasets (eg. one per source) in a single update:
+        their analyses run once, over all of them together (see
+        Dataset.set_ready for workers), and each one gets its own changelog
+        entry. Returns the number of days each dataset affected.
+        """
+        keys = [list(ds.days.keys()) for ds in datasets]
+        if len(datasets) == 1:
+            combined = datasets[0]
+        else:
+            combined = Dataset()
+            for ds in datasets:
+                combined.update(ds)
+        with stage("Dataset.set_ready", days=len(combined.days)):
+            combined.set_ready(True, workers=workers)
+
+        before = self._stats_snapshot(combined)
+        days_affected = set(self.dataset.update(combined))
+        self._update_stats(days_affected, before)
+        if self.days_affected is not None:
+            self.days_affected.update(days_affected)
+        n_updates = []
+        for ds_keys, description in zip(keys, descriptions):
+            affected = [k for k in ds_keys if k in days_affected]
+            if affected and description:
+                self.changelog.append(affected, description, day=Day.get_today())
+            n_updates.append(len(affected))
+        return n_updates
 
     def update(self, immutable_dataset, description):
+        before = self._stats_snapshot(immutable_dataset)
         days_affected = self.dataset.update(immutable_dataset)
+        self._update_stats(days_affected, before)
+        if self.days_affected is not None:
+            self.days_affected.update(days_affected)
         if days_affected and description:
-            self.changelog.append(dict(
-                day=Day.get_today(),
-                days_affected=days_affected,
-                description=description
-            ))
+            self.changelog.append(days_affected, description, day=Day.get_today())
         return len(days_affected)
@@ -0,0 +1,172 @@
+import os
+import json
+import pickle
+import hashlib
+
+from . import get_cache_dir
+
+CACHE_DIRNAME = "parsed"
+# Bump when parsing changes, so older entries are no longer used
+CACHE_VERSION = 5
+DEFAULT_MAX_BYTES = 256 << 20
+INDEX_FILENAME = "index.json"
+
+
+def file_digest(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ParseCache:
+    """
+    What was parsed from each source file (its days, or for Last.fm its
+    lastfm.CompactScrobbles), and from how many rows, stored in the
+    bluemoon cache dir under the hash of the file's content (and the data
+    source), so a file that is exported again unchanged is never parsed
+    twice. Files are
+    only hashed again when their size or modification time changes.
+
+    Entries are evicted least recently used first once together they take
+    more than max_bytes; one that alone takes more is not kept at all. The
+    cache is only an optimization: unreadable entries are parsed again,
+    and failing writes are ignored.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or os.path.join(get_cache_dir(), CACHE_DIRNAME)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._index_dirty = False
+
+    def _entry_path(self, data_source, digest):
+        name = hashlib.sha256(("%s|%s|%s"%(CACHE_VERSION, data_source.value, digest)).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".pickle")
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(os.path.join(self.directory, INDEX_FILENAME)) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = dict()
+        return self._index
+
+    def digest(self, path):
+        """
+        Content hash of path, looked up by its size and modification time
+        """
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        index = self._load_index()
+        entry = index.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = file_digest(path)
+        index[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._index_dirty = True
+        return digest
+
+    def get(self, data_source, path):
+        """
+        (parsed, rows) cached for the file at path, or None
+        """
+        entry_path = self._entry_path(data_source, self.digest(path))
+        try:
+            with open(entry_path, 'rb') as f:
+                parsed, rows = pickle.load(f)
+            # Recently used entries are evicted last
+            os.utime(entry_path)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return parsed, rows
+
+    def put(self, data_source, path, parsed, rows):
+        entry_path = self._entry_path(data_source, self.digest(path))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = "%s.%d.tmp"%(entry_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((parsed, rows), f, protocol=pickle.HIGHEST_PROTOCOL)
+                too_large = f.tell() > self.max_bytes
+            if too_large:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, entry_path)
+            self.evict(keep=entry_path)
+        except OSError:
+            pass
+
+    def parsed(self, data_source, path, parse):
+        """
+        (parsed, rows) of the file at path, from the cache, or from
+        parse(path) when it has not been parsed before (or has changed
+        since)
+        """
+        entry = self.get(data_source, path)
+        if entry is None:
+            entry = parse(path)
+            self.put(data_source, path, *entry)
+        return entry
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for e in it:
+                    if e.name.endswith(".pickle"):
+                        stat = e.stat()
+                        entries.append((stat.st_mtime_ns, stat.st_size, e.path))
+        except OSError:
+            pass
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries (other than keep) until the
+        rest fit in max_bytes; returns how many were removed
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def save(self):
+        """
+        Store the index of file hashes, if it changed
+        """
+        if not self._index_dirty:
+            return
+        index = self._load_index()
+        # Files that are gone need not be remembered
+        self._index = {path: entry for path, entry in index.items() if os.path.exists(path)}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            index_path = os.path.join(self.directory, INDEX_FILENAME)
+            tmp_path = "%s.%d.tmp"%(index_path, os.getpid())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, index_path)
+            self._index_dirty = False
+        except OSError:
+            pass
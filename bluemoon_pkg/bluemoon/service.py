@@ -0,0 +1,320 @@
+import os
+import sys
+import glob
+import json
+import math
+import time
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+
+from .models import AllData, record_digest
+from .data_sources import DataSource
+from .add import apply_datasets, read_manifest
+from .parse_cache import ParseCache
+from .instrument import stage
+
+
+class IngestService:
+    """
+    Keeps a database loaded (as AllData.build with lazy=True) and ingests
+    the export files of the watched sources as they appear or change, one
+    file at a time, so an ingest costs as much as the new file rather than
+    the whole history.
+
+    watches: (data_source, pattern) pairs, eg. (DataSource.toggl,
+    "exports/toggl*.csv"). The files matching each pattern are polled;
+    a new or changed file is ingested once its size and modification time
+    have not changed for settle polls, so files that are still being
+    written are left alone. Ingested files are remembered, with their
+    size and modification time, in meta["watched_files"], which is saved
+    with the data they brought. A day's records from a file are added to
+    those stored from other files (eg. an export of the days before), as
+    when both are added at once; records a file no longer has are kept.
+    Sources whose records are per-day aggregates (see
+    DataSource.has_aggregate_records, eg. Last.fm) have a day's aggregate
+    from a file merged with the stored one (see lastfm.merge_aggregates),
+    so the scrobbles of a file that grew, or overlaps another, are
+    counted once, and those imported from other files are kept.
+
+    Saves are debounced: the database is saved once no file has been
+    ingested for save_delay seconds, or once the oldest unsaved ingest is
+    max_save_delay seconds old. With SQLite storage, a save only writes
+    the days affected since the last one.
+    """
+
+    def __init__(self, db_target, watches, settle=1, save_delay=5.0, max_save_delay=60.0,
+            parse_cache=None, scrobble_store=None, clock=time.monotonic):
+        self.all_data = AllData.build(db_target, lazy=True)
+        self.watches = list(watches)
+        self.settle = settle
+        self.save_delay = save_delay
+        self.max_save_delay = max_save_delay
+        self.parse_cache = parse_cache
+        self.scrobble_store = scrobble_store
+        self.clock = clock
+        # Ingests, saves and queries of the socket server's threads take turns
+        self.lock = threading.RLock()
+        self.seen = self.all_data.meta.setdefault("watched_files", {})
+        # path -> (size, mtime_ns, polls without a change)
+        self.pending = dict()
+        self.first_unsaved = None
+        self.last_ingest = None
+        self.n_ingested = 0
+        self.n_updates = 0
+
+    def changed_files(self):
+        """
+        (data_source, path, [size, mtime_ns]) of the watched files that are
+        new or changed since ingested, and have settled
+        """
+        changed = []
+        for data_source, pattern in self.watches:
+            for path in sorted(glob.glob(pattern)):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                path = os.path.abspath(path)
+                current = [stat.st_size, stat.st_mtime_ns]
+                if self.seen.get(path) == current:
+                    self.pending.pop(path, None)
+                    continue
+                size, mtime_ns, polls = self.pending.get(path, (None, None, 0))
+                polls = polls + 1 if [size, mtime_ns] == current else 0
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, polls)
+                if polls >= self.settle:
+                    changed.append((data_source, path, current))
+        return changed
+
+    def ingest(self, files):
+        """
+        Build a dataset from each of files (as returned by changed_files)
+        and merge it into the database, one file after the other; returns
+        the number of updates. A file that can not be ingested is
+        reported, and only tried again once it changes.
+        """
+        if not files:
+            return 0
+        with self.lock, stage("service.ingest", files=len(files)) as s:
+            n_updates = 0
+            for data_source, path, current in files:
+                try:
+                    data = glob.escape(path)
+                    ds = data_source.build_dataset(data, base_dataset=self.all_data.dataset,
+                        parse_cache=self.parse_cache, scrobble_store=self.scrobble_store)
+                    self._add_stored_records(data_source, ds)
+                    n_updates += apply_datasets(self.all_data, [(data_source, data)], [ds],
+                        ".service %s %s"%(data_source, path))[0]
+                except Exception as e:
+                    print("Could not ingest", path, e, file=sys.stderr)
+                self.seen[path] = current
+                self.pending.pop(path, None)
+            now = self.clock()
+            self.last_ingest = now
+            if self.first_unsaved is None:
+                self.first_unsaved = now
+            self.n_ingested += len(files)
+            self.n_updates += n_updates
+            s.set(updates=n_updates)
+        return n_updates
+
+    def _add_stored_records(self, data_source, ds):
+        # Only the days of the file are looked at (and materialized)
+        days = self.all_data.dataset.days
+        for key, d in ds.days.items():
+            stored = days.get(key)
+            if stored is None:
+                continue
+            for field_name, records in d.cumulative.items():
+                if data_source.has_aggregate_records():
+                    from . import lastfm
+                    d.cumulative[field_name] = lastfm.merge_aggregates(data_source.get_record_schema(),
+                        stored.cumulative.get(field_name, []), records)
+                    continue
+                merged = list(stored.cumulative.get(field_name, []))
+                seen = set(record_digest(r) for r in merged)
+                for r in records:
+                    digest = record_digest(r)
+                    if digest not in seen:
+                        seen.add(digest)
+                        merged.append(r)
+                d.cumulative[field_name] = merged
+
+    def poll(self):
+        """
+        Ingest the files that changed, then save if it is time to
+        """
+        n_updates = self.ingest(self.changed_files())
+        self.save_if_due()
+        return n_updates
+
+    def save_due(self):
+        if self.first_unsaved is None:
+            return False
+        now = self.clock()
+        return now - self.last_ingest >= self.save_delay or \
+            now - self.first_unsaved >= self.max_save_delay
+
+    def save_if_due(self):
+        if self.save_due():
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if self.first_unsaved is not None:
+                self.all_data.save()
+                self.first_unsaved = None
+
+    def status(self):
+        return dict(
+            days=len(self.all_data.dataset.days),
+            watched_files=len(self.seen),
+            pending_files=len(self.pending),
+            ingested_files=self.n_ingested,
+            updates=self.n_updates,
+            unsaved=self.first_unsaved is not None
+        )
+
+    def handle(self, request):
+        """
+        Answer a request, a dict with an "op":
+        - select: fields, sources, start and end as for AllData.select;
+          the selected fields as lists (NaN and missing values as None)
+        - search: the day keys matching query (and field), see Dataset.search
+        - status: counts of days and files, and whether a save is pending
+        - save: save now, if anything is unsaved
+        - poll: look for changed files now
+        """
+        op = request.get("op")
+        with self.lock:
+            if op == "select":
+                sources = request.get("sources")
+                arrays = self.all_data.select(fields=request.get("fields"),
+                    sources=[DataSource(s) for s in sources] if sources else None,
+                    start=request.get("start"), end=request.get("end"), as_arrays=True)
+                arrays.pop("day_dt")
+                return {name: _as_json(values) for name, values in arrays.items()}
+            if op == "search":
+                return self.all_data.dataset.search(request["query"], field=request.get("field"))
+            if op == "status":
+                return self.status()
+            if op == "save":
+                self.save()
+                return self.status()
+            if op == "poll":
+                return dict(updates=self.poll())
+        assert False, "Unknown op %r"%op
+
+    def serve(self, socket_path):
+        """
+        Answer requests on a Unix socket at socket_path, in a background
+        thread: each line a client sends is a JSON request (see handle),
+        and is answered with a line {"ok": true, "result": ...}, or
+        {"ok": false, "error": ...}. Returns the server; shut it down
+        with server.shutdown().
+        """
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = dict(ok=True, result=service.handle(json.loads(line)))
+                    except Exception as e:
+                        response = dict(ok=False, error="%s: %s"%(type(e).__name__, e))
+                    self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def run(self, poll_interval=2.0, stop=None):
+        """
+        Poll every poll_interval seconds until stop (a threading.Event) is
+        set, then save whatever is unsaved
+        """
+        stop = stop or threading.Event()
+        try:
+            while not stop.is_set():
+                self.poll()
+                stop.wait(poll_interval)
+        finally:
+            self.save()
+
+
+def _as_json(values):
+    return [None if isinstance(v, float) and math.isnan(v) else v for v in values.tolist()]
+
+
+def request(socket_path, op, **params):
+    """
+    Send a request to an IngestService listening on socket_path, and
+    return its result
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile('rwb') as f:
+            f.write((json.dumps(dict(params, op=op)) + "\n").encode("utf-8"))
+            f.flush()
+            response = json.loads(f.readline())
+    assert response["ok"], response["error"]
+    return response["result"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep a database loaded, ingest export files as they land in watched directories, and answer queries on a Unix socket.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=DataSource.all_help())
+    parser.add_argument('db_target', type=str, help="Database to keep loaded; if nonexistent, will be created.")
+    parser.add_argument('--data_source', type=DataSource, choices=list(DataSource), action='append', default=[],
+        help="Data source of the files matched by the --data pattern with the same position.")
+    parser.add_argument('--data', '-d', type=str, action='append', default=[],
+        help='Files to watch, as a pattern, eg. "exports/toggl*.csv"')
+    parser.add_argument('--manifest', type=str, default=None,
+        help='JSON list of {"data_source": ..., "data": ...} objects to watch, in addition to any --data_source/--data pairs')
+    parser.add_argument('--socket', type=str, default=None,
+        help="Unix socket to answer queries on; defaults to the database path with .sock appended")
+    parser.add_argument('--poll_interval', type=float, default=2.0,
+        help="Seconds between looking for new or changed files")
+    parser.add_argument('--save_delay', type=float, default=5.0,
+        help="Seconds without new files before the database is saved")
+    parser.add_argument('--max_save_delay', type=float, default=60.0,
+        help="Most seconds an ingested file waits to be saved")
+    parser.add_argument('--parse_cache_mb', type=int, default=256,
+        help="Size of the cache of parsed files in the bluemoon cache dir, so unchanged exports are not parsed again; 0 turns it off")
+    parser.add_argument('--scrobble_store', type=str, default=None,
+        help="SQLite file to keep raw Last.fm scrobbles in; by default only their per-day aggregates are kept")
+
+    opts = parser.parse_args()
+    if len(opts.data_source) != len(opts.data):
+        parser.error("Every --data_source needs exactly one --data")
+    watches = list(zip(opts.data_source, opts.data))
+    if opts.manifest:
+        watches += read_manifest(opts.manifest)
+    if not watches:
+        parser.error("Nothing to watch; give --data_source/--data pairs or a --manifest")
+
+    service = IngestService(opts.db_target, watches, save_delay=opts.save_delay,
+        max_save_delay=opts.max_save_delay,
+        parse_cache=ParseCache(max_bytes=opts.parse_cache_mb << 20) if opts.parse_cache_mb else None,
+        scrobble_store=opts.scrobble_store)
+    socket_path = opts.socket or "%s.sock"%opts.db_target
+    server = service.serve(socket_path)
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+    print("Watching %d patterns; queries on %s"%(len(watches), socket_path), file=sys.stderr)
+    try:
+        service.run(poll_interval=opts.poll_interval, stop=stop)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+    print("Ingested", service.n_ingested, "files with", service.n_updates, "updates", file=sys.stderr)
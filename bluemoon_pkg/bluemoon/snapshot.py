@@ -0,0 +1,258 @@
+import json
+import mmap
+import struct
+import numpy as np
+
+from .columnar import Column, EPOCH_ORDINAL
+
+MAGIC = b"BMSNAP\x00\x01"
+# Magic, then the length of the JSON header that follows it
+PREFIX = struct.Struct("<8sQ")
+# Arrays start on this boundary after the header, and on 8 bytes after
+# one another, so that every view on them is aligned
+ALIGNMENT = 64
+KEY_DTYPE = "S10"
+_ABSENT = object()
+
+
+def _aligned(n, alignment=ALIGNMENT):
+    return n + (-n % alignment)
+
+
+def _data_kind(values):
+    """
+    How a data field is stored: bool, int and float values in a numeric
+    array (ints mixed with floats as floats, when that is exact), anything
+    else as JSON in the string table
+    """
+    kinds = set()
+    for v in values:
+        if v is None or v is _ABSENT:
+            continue
+        if isinstance(v, (bool, np.bool_)):
+            kinds.add("bool")
+        elif isinstance(v, (int, np.integer)):
+            kinds.add("int" if -2**63 <= v < 2**63 else "json")
+        elif isinstance(v, (float, np.floating)):
+            kinds.add("float")
+        else:
+            kinds.add("json")
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds == {"int", "float"} and all(abs(v) <= 2**53 for v in values \
+            if isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))):
+        return "float"
+    return "json"
+
+
+class _Writer:
+    """
+    Arrays laid out one after the other; each is referenced from the
+    header as [offset, dtype, length]
+    """
+
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+        self.strings = dict()
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        self.size = _aligned(self.size, 8)
+        self.arrays.append((self.size, array))
+        ref = [self.size, array.dtype.str, len(array)]
+        self.size += array.nbytes
+        return ref
+
+    def string(self, text):
+        # Identical strings (eg. recurring records) are stored once
+        i = self.strings.get(text)
+        if i is None:
+            i = self.strings[text] = len(self.strings)
+        return i
+
+    def add_strings(self):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return dict(offsets=self.add(offsets),
+            blob=self.add(np.frombuffer(b"".join(encoded), dtype=np.uint8)))
+
+    def write(self, f, header):
+        header = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        f.write(PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        position = 0
+        f.write(b"\0" * (_aligned(PREFIX.size + len(header)) - PREFIX.size - len(header)))
+        for offset, array in self.arrays:
+            f.write(b"\0" * (offset - position))
+            f.write(array.tobytes())
+            position = offset + array.nbytes
+
+
+def write_snapshot(f, days, documents):
+    """
+    Write days, an iterable of (key, payload) in key order, and the other
+    top level documents (experiments, meta, ...) to the binary file f
+    """
+    keys, data, cumulative = [], [], []
+    for key, payload in days:
+        keys.append(key)
+        data.append(payload.get("data", {}))
+        cumulative.append(payload.get("cumulative", {}))
+    n = len(keys)
+    writer = _Writer()
+    ordinals = np.array(keys, dtype='datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+    header = dict(
+        documents=documents,
+        keys=writer.add(np.array(keys, dtype=KEY_DTYPE)),
+        ordinals=writer.add(ordinals.astype(np.int32)),
+        data=dict(),
+        cumulative=dict()
+    )
+
+    for name in dict.fromkeys(k for d in data for k in d):
+        values = [d.get(name, _ABSENT) for d in data]
+        kind = _data_kind(values)
+        mask = np.array([v is None or v is _ABSENT for v in values], dtype=bool)
+        field = header["data"][name] = dict(kind=kind, mask=writer.add(mask))
+        nulls = np.array([v is None for v in values], dtype=bool)
+        if nulls.any():
+            field["nulls"] = writer.add(nulls)
+        if kind == "json":
+            field["values"] = writer.add(np.array([-1 if m else writer.string(json.dumps(v, ensure_ascii=False)) \
+                for v, m in zip(values, mask)], dtype=np.int32))
+            continue
+        array = np.zeros(n, dtype=dict(bool=np.bool_, int=np.int64, float=np.float64)[kind])
+        array[~mask] = [v for v, m in zip(values, mask) if not m]
+        field["values"] = writer.add(array)
+        if kind == "float":
+            ints = np.array([isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) \
+                for v in values], dtype=bool)
+            if ints.any():
+                field["ints"] = writer.add(ints)
+
+    for name in dict.fromkeys(k for c in cumulative for k in c):
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        records = []
+        for i, c in enumerate(cumulative):
+            records.extend(writer.string(json.dumps(r, ensure_ascii=False)) for r in c.get(name, ()))
+            offsets[i + 1] = len(records)
+        header["cumulative"][name] = dict(
+            offsets=writer.add(offsets),
+            records=writer.add(np.array(records, dtype=np.int32)),
+            present=writer.add(np.array([name in c for c in cumulative], dtype=bool))
+        )
+
+    header["strings"] = writer.add_strings()
+    writer.write(f, header)
+
+
+class Snapshot:
+    """
+    A database written by write_snapshot, opened with mmap: the day index
+    (keys and day ordinals, in key order) and numeric data fields are
+    numpy arrays viewing the file, without copying or parsing; a day's
+    other values and its cumulative records are decoded from the string
+    table only when the day is read.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = PREFIX.unpack_from(self._mmap)
+        assert magic == MAGIC, "%s is not a bluemoon snapshot"%path
+        self.header = json.loads(self._mmap[PREFIX.size:PREFIX.size + length].decode("utf-8"))
+        self._base = _aligned(PREFIX.size + length)
+        self.documents = self.header["documents"]
+        self.keys = self._array(self.header["keys"])
+        self.ordinals = self._array(self.header["ordinals"])
+        self._string_offsets = self._array(self.header["strings"]["offsets"])
+        self._strings = self._base + self.header["strings"]["blob"][0]
+        self._data = {name: {k: self._array(v) if k != "kind" else v for k, v in field.items()} \
+            for name, field in self.header["data"].items()}
+        self._cumulative = {name: {k: self._array(v) for k, v in field.items()} \
+            for name, field in self.header["cumulative"].items()}
+
+    def _array(self, ref):
+        offset, dtype, length = ref
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.frombuffer(self._mmap, dtype=dtype, count=length, offset=self._base + offset)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def data_fields(self):
+        return list(self._data)
+
+    def key_list(self, lo=0, hi=None):
+        return [k.decode("ascii") for k in self.keys[lo:hi].tolist()]
+
+    def rows(self, start=None, end=None):
+        """
+        (lo, hi): the rows of the days from start to end (inclusive day
+        keys, None for open ended)
+        """
+        lo = 0 if start is None else int(np.searchsorted(self.keys, start.encode("ascii"), side='left'))
+        hi = len(self) if end is None else int(np.searchsorted(self.keys, end.encode("ascii"), side='right'))
+        return lo, max(lo, hi)
+
+    def _string(self, i):
+        start = self._strings + int(self._string_offsets[i])
+        return self._mmap[start:self._strings + int(self._string_offsets[i + 1])].decode("utf-8")
+
+    def _value(self, field, i):
+        if field["kind"] == "json":
+            return json.loads(self._string(int(field["values"][i])))
+        value = field["values"][i].item()
+        if "ints" in field and field["ints"][i]:
+            return int(value)
+        return value
+
+    def data(self, i):
+        """
+        Day.data of the day in row i
+        """
+        data = dict()
+        for name, field in self._data.items():
+            if not field["mask"][i]:
+                data[name] = self._value(field, i)
+            elif "nulls" in field and field["nulls"][i]:
+                data[name] = None
+        return data
+
+    def cumulative(self, i):
+        cumulative = dict()
+        for name, field in self._cumulative.items():
+            if field["present"][i]:
+                cumulative[name] = [json.loads(self._string(int(r))) \
+                    for r in field["records"][field["offsets"][i]:field["offsets"][i + 1]]]
+        return cumulative
+
+    def payload(self, i):
+        """
+        The day in row i as serialized by Day.serialize
+        """
+        return dict(data=self.data(i), cumulative=self.cumulative(i))
+
+    def column(self, name, lo=0, hi=None):
+        """
+        A data field over rows lo to hi as a columnar.Column; numeric
+        fields are read-only views on the file
+        """
+        hi = len(self) if hi is None else hi
+        field = self._data[name]
+        mask = field["mask"][lo:hi]
+        if field["kind"] != "json":
+            return Column.wrap(field["kind"], field["values"][lo:hi], mask)
+        # Each distinct value (eg. a weekday name) is decoded once
+        present = np.flatnonzero(~mask)
+        ids, inverse = np.unique(field["values"][lo:hi][present], return_inverse=True)
+        decoded = np.empty(len(ids), dtype=object)
+        for j, i in enumerate(ids.tolist()):
+            decoded[j] = json.loads(self._string(i))
+        values = np.empty(hi - lo, dtype=object)
+        values[present] = decoded[inverse]
+        return Column.wrap("object", values, mask)
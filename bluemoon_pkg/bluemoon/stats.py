@@ -0,0 +1,199 @@
+import math
+import numpy as np
+
+MAX_VALUES = 64
+
+
+def _number(value):
+    # Numeric data values (bools as 0 and 1); anything else is not counted
+    if isinstance(value, (bool, np.bool_)):
+        return float(value)
+    if isinstance(value, (int, float, np.integer, np.floating)) and not \
+            (isinstance(value, (float, np.floating)) and math.isnan(value)):
+        return float(value)
+    return None
+
+
+class FieldStats:
+    """
+    Running count, mean and M2 (sum of squared deviations, as in Welford's
+    algorithm) of one field, and how often its most frequent values occur.
+    Values can be removed again, so a day that changes is taken out with
+    its old values and added back with the new ones.
+
+    At most max_values distinct values are counted; values seen once that
+    many are tracked are counted together in other, so the counts are
+    exact for values first seen while there was room, and lower bounds
+    otherwise.
+    """
+
+    def __init__(self, max_values=MAX_VALUES):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.counts = dict()
+        self.other = 0
+        self.max_values = max_values
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if x in self.counts or len(self.counts) < self.max_values:
+            self.counts[x] = self.counts.get(x, 0) + 1
+        else:
+            self.other += 1
+
+    def remove(self, x):
+        if self.n <= 1:
+            self.__init__(self.max_values)
+            return
+        delta = x - self.mean
+        self.mean -= delta / (self.n - 1)
+        self.m2 = max(self.m2 - delta * (x - self.mean), 0.0)
+        self.n -= 1
+        if x in self.counts:
+            self.counts[x] -= 1
+            if not self.counts[x]:
+                del self.counts[x]
+        elif self.other:
+            self.other -= 1
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else float('nan')
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def max_repetition(self):
+        return max(self.counts.values()) if self.counts else 0
+
+    def as_dict(self):
+        return dict(
+            n=self.n,
+            mean=self.mean,
+            m2=self.m2,
+            counts=[[v, c] for v, c in self.counts.items()],
+            other=self.other
+        )
+
+    @classmethod
+    def from_dict(cls, d, max_values=MAX_VALUES):
+        stats = cls(max_values)
+        stats.n, stats.mean, stats.m2, stats.other = d["n"], d["mean"], d["m2"], d.get("other", 0)
+        stats.counts = {v: c for v, c in d.get("counts", [])}
+        return stats
+
+
+class StatsCache:
+    """
+    FieldStats of every numeric data field over all days, kept up to date
+    by AllData.update from the days each update affects, and stored in
+    AllData.meta["stats"], so analyses need not rescan the history.
+
+    Fields that analyses derive in Dataset.set_ready (an analysis's field
+    and its compound fields) are recomputed after the update and are not
+    counted; see derive.
+    """
+
+    def __init__(self, max_values=MAX_VALUES):
+        self.days = 0
+        self.fields = dict()
+        self.max_values = max_values
+        self.derived = set()
+        self._counted = dict()
+
+    def derive(self, field_names):
+        """
+        Stop counting field_names (analyses, or sources whose records they
+        summarize) and their compound fields
+        """
+        new = set(field_names) - self.derived
+        if new:
+            self.derived |= new
+            self._counted = dict()
+            self.fields = {k: v for k, v in self.fields.items() if self.counted(k)}
+
+    def counted(self, field_name):
+        counted = self._counted.get(field_name)
+        if counted is None:
+            counted = self._counted[field_name] = field_name not in self.derived and \
+                not any(field_name.startswith(d + "_") for d in self.derived)
+        return counted
+
+    def _field(self, field_name):
+        stats = self.fields.get(field_name)
+        if stats is None:
+            stats = self.fields[field_name] = FieldStats(self.max_values)
+        return stats
+
+    def add_day(self, data):
+        self.days += 1
+        self.add(data)
+
+    def add(self, data):
+        for field_name, value in data.items():
+            x = _number(value)
+            if x is not None and self.counted(field_name):
+                self._field(field_name).add(x)
+
+    def remove(self, data):
+        for field_name, value in data.items():
+            x = _number(value)
+            if x is not None and field_name in self.fields:
+                self.fields[field_name].remove(x)
+                if not self.fields[field_name].n:
+                    del self.fields[field_name]
+
+    def update(self, old_data, new_data):
+        """
+        old_data: data of the affected days before the update, by key, for
+        those that existed; new_data: their data after it
+        """
+        for key, data in new_data.items():
+            if key in old_data:
+                self.remove(old_data[key])
+                self.add(data)
+            else:
+                self.add_day(data)
+
+    def keep(self, predicate):
+        """
+        Forget fields whose names do not satisfy predicate (eg. those that
+        are not saved)
+        """
+        self.fields = {k: v for k, v in self.fields.items() if predicate(k)}
+
+    def availability(self, field_name):
+        stats = self.fields.get(field_name)
+        return stats.n / self.days if stats and self.days else 0.0
+
+    def as_dict(self):
+        return dict(days=self.days, max_values=self.max_values, derived=sorted(self.derived),
+            fields={k: v.as_dict() for k, v in self.fields.items()})
+
+    @classmethod
+    def from_dict(cls, d):
+        cache = cls(d.get("max_values", MAX_VALUES))
+        cache.days = d.get("days", 0)
+        cache.derived = set(d.get("derived", []))
+        cache.fields = {k: FieldStats.from_dict(v, cache.max_values) \
+            for k, v in d.get("fields", {}).items()}
+        return cache
+
+    @classmethod
+    def build(cls, days, derived=(), max_values=MAX_VALUES):
+        """
+        From scratch, over days (eg. Dataset.days.values()); fields of the
+        sources the days have records of are taken as derived
+        """
+        days = list(days)
+        cache = cls(max_values)
+        cache.derive(set(derived).union(*(day.cumulative.keys() for day in days)))
+        for day in days:
+            cache.add_day(day.data)
+        return cache
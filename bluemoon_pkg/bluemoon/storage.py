@@ -0,0 +1,425 @@
+import os
+import json
+import heapq
+import sqlite3
+import argparse
+import tempfile
+from functools import partial
+
+from .jsonstream import TextWriter, MemberSelection, open_text, iter_days, read_document, write_document
+from .snapshot import Snapshot, write_snapshot
+
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+SNAPSHOT_EXTENSIONS = (".bmsnap",)
+
+
+def _atomic_write(path, write_fn, binary=False):
+    """
+    Write to a temporary file next to path, then move it over path, so that
+    a crash mid-write never leaves a partial file behind; write_fn gets a
+    text file, or with binary=True the raw one
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=".%s."%os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            if binary:
+                write_fn(raw)
+            else:
+                # Compressed by the extension of path, eg. .json.gz
+                with TextWriter(path, raw) as f:
+                    write_fn(f)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _day_payloads(all_data, keys=None):
+    serialize_fields = all_data.meta.get("serialize_fields")
+    days = all_data.dataset.days
+    for k in (days.keys() if keys is None else keys):
+        if k in days:
+            yield k, days[k].serialize(serialize_fields)
+
+
+def _documents(all_data):
+    # The changelog is stored apart, see _changelog_rows
+    return {k: v for k, v in all_data.as_dict(days=False).items() if k not in ("days", "changelog")}
+
+
+def _changelog_rows(changelog, n_stored):
+    """
+    (rewrite, entries): entries to append to the n_stored entries the
+    storage holds, or, when those do not match what was loaded, all
+    entries to replace them with
+    """
+    if changelog.rewrite or n_stored != changelog.stored:
+        return True, changelog.entries
+    return False, changelog.unsaved()
+
+
+def _field_selection(fields, sources):
+    # The data fields selected by fields or sources, as by
+    # models._selected_fields; None when neither is given
+    if fields is None and sources is None:
+        return None
+    prefixes = [str(source) for source in sources or []]
+    return MemberSelection(list(fields or []) + prefixes, [p + "_" for p in prefixes])
+
+
+def _json_each_value(kind, value):
+    # A value as given by SQLite's json_each, by its type
+    if kind in ("true", "false"):
+        return kind == "true"
+    if kind in ("object", "array") or (kind == "integer" and isinstance(value, str)):
+        value = json.loads(value)
+        return value[0] if kind == "integer" else value
+    return value
+
+
+def _outside(key, loaded_range):
+    start, end = loaded_range
+    return (start is not None and key < start) or (end is not None and key > end)
+
+
+def _check_loaded_range(loaded_range, keys):
+    """
+    After loading only some days, days outside that range are not known,
+    so saving one would overwrite what is stored for it
+    """
+    if loaded_range is not None:
+        outside = [k for k in keys if _outside(k, loaded_range)]
+        assert not outside, "Days %s..%s are outside the loaded range %s..%s; load them before updating"%(
+            min(outside), max(outside), *loaded_range)
+
+
+class JsonStorage:
+    """
+    The whole database as one JSON document, read and written a day at a
+    time; .gz and .zst files are compressed, and indent=None writes
+    compact JSON. Every save rewrites the file.
+    """
+
+    def __init__(self, path, indent=4):
+        self.path = path
+        self.indent = indent
+        # (start, end) of the last load, when only some days were loaded
+        self.loaded_range = None
+        # Changelog entries are appended to a JSON lines file next to path;
+        # the document's "changelog" says how many of its lines are valid
+        self.changelog_path = "%s.changelog"%path
+        self.changelog_entries = 0
+        self.changelog_lines = None
+
+    def load(self, start=None, end=None, lazy=False):
+        """
+        Only the days from start to end (inclusive day keys) are parsed;
+        with lazy=True, their payloads are returned as JSON text
+        """
+        with open_text(self.path) as f:
+            d = read_document(f, start, end, raw=lazy)
+        self.loaded_range = None if start is None and end is None else (start, end)
+        if isinstance(d.get("changelog"), dict):
+            self.changelog_entries = d.pop("changelog")["entries"]
+        return d
+
+    def load_changelog(self):
+        """
+        Changelog entries from the segment; lines after the ones the last
+        saved document counted (eg. from a save that did not finish) are
+        left out, and replaced on the next save
+        """
+        entries = []
+        self.changelog_lines = 0
+        if os.path.exists(self.changelog_path):
+            with open(self.changelog_path, encoding='utf-8') as f:
+                for line in f:
+                    self.changelog_lines += 1
+                    if len(entries) < self.changelog_entries:
+                        entries.append(json.loads(line))
+        return entries
+
+    def _save_changelog(self, changelog):
+        rewrite, entries = _changelog_rows(changelog, self.changelog_lines)
+        lines = [json.dumps(e, ensure_ascii=False) + "\n" for e in entries]
+        if rewrite:
+            _atomic_write(self.changelog_path, lambda f: f.writelines(lines))
+        elif lines:
+            with open(self.changelog_path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        self.changelog_lines = self.changelog_entries = len(changelog.entries)
+        return dict(segment=os.path.basename(self.changelog_path), entries=len(changelog.entries))
+
+    def load_data(self, start=None, end=None, fields=None, sources=None):
+        """
+        (key, data) of the days from start to end in key order; cumulative
+        records are skipped without being parsed. Given fields and/or
+        sources, data only has the fields they select (see
+        AllData.query), and the others are not parsed either.
+        """
+        with open_text(self.path) as f:
+            return sorted(((k, data or {}) for k, data in iter_days(f, start, end, part="data",
+                selection=_field_selection(fields, sources))), key=lambda item: item[0])
+
+    def save(self, all_data, days_affected=None):
+        documents = _documents(all_data)
+        # The segment is written first, so the document never counts
+        # entries that are not there
+        documents["changelog"] = self._save_changelog(all_data.changelog)
+        if self.loaded_range is None or not os.path.exists(self.path):
+            _atomic_write(self.path, lambda f: write_document(
+                f, _day_payloads(all_data), documents, indent=self.indent))
+            return
+
+        # Days outside the loaded range are copied over from the current
+        # file as they are, in key order with the loaded ones
+        _check_loaded_range(self.loaded_range, all_data.dataset.days.keys())
+        def write(f):
+            with open_text(self.path) as current:
+                outside = ((k, text) for k, text in iter_days(current, raw=True) \
+                    if _outside(k, self.loaded_range))
+                loaded = _day_payloads(all_data, sorted(all_data.dataset.days.keys()))
+                write_document(f, heapq.merge(outside, loaded, key=lambda item: item[0]),
+                    documents, indent=self.indent)
+        _atomic_write(self.path, write)
+
+
+class SnapshotStorage(JsonStorage):
+    """
+    The whole database as a binary snapshot (see snapshot.Snapshot),
+    opened with mmap: loading parses no day until it is accessed, and
+    queries read numeric fields straight from the file. Every save
+    rewrites the file; the changelog is kept as for JsonStorage.
+    """
+
+    def load(self, start=None, end=None, lazy=False):
+        """
+        Day payloads, from start to end (inclusive day keys), are read from
+        the snapshot when LazyDay (or, without lazy, AllData) first needs them
+        """
+        snapshot = Snapshot(self.path)
+        d = dict(snapshot.documents)
+        lo, hi = snapshot.rows(start, end)
+        d["days"] = {k: partial(snapshot.payload, i) for i, k in enumerate(snapshot.key_list(lo, hi), lo)}
+        self.loaded_range = None if start is None and end is None else (start, end)
+        if isinstance(d.get("changelog"), dict):
+            self.changelog_entries = d.pop("changelog")["entries"]
+        return d
+
+    def load_data(self, start=None, end=None, fields=None, sources=None):
+        snapshot = Snapshot(self.path)
+        lo, hi = snapshot.rows(start, end)
+        selection = _field_selection(fields, sources)
+        return [(k, {name: value for name, value in snapshot.data(i).items() \
+            if selection is None or selection(name)}) for i, k in enumerate(snapshot.key_list(lo, hi), lo)]
+
+    def load_columns(self, start=None, end=None, fields=None, sources=None):
+        """
+        (keys, ordinals, columns) of the days from start to end in key
+        order; columns are columnar.Column objects by field (only those
+        selected by fields and/or sources, when given), viewing the
+        snapshot for numeric fields
+        """
+        snapshot = Snapshot(self.path)
+        lo, hi = snapshot.rows(start, end)
+        selection = _field_selection(fields, sources)
+        return snapshot.key_list(lo, hi), snapshot.ordinals[lo:hi], \
+            {name: snapshot.column(name, lo, hi) for name in snapshot.data_fields \
+                if selection is None or selection(name)}
+
+    def save(self, all_data, days_affected=None):
+        documents = _documents(all_data)
+        documents["changelog"] = self._save_changelog(all_data.changelog)
+        days = _day_payloads(all_data, sorted(all_data.dataset.days.keys()))
+        if self.loaded_range is not None and os.path.exists(self.path):
+            # Days outside the loaded range are copied over from the
+            # current file, in key order with the loaded ones
+            _check_loaded_range(self.loaded_range, all_data.dataset.days.keys())
+            current = Snapshot(self.path)
+            outside = ((k, current.payload(i)) for i, k in enumerate(current.key_list()) \
+                if _outside(k, self.loaded_range))
+            days = heapq.merge(outside, days, key=lambda item: item[0])
+        _atomic_write(self.path, lambda f: write_snapshot(f, days, documents), binary=True)
+
+
+class SqliteStorage:
+    """
+    One row per day, holding its serialized payload (and a copy of its
+    data alone, for queries), and one row each for experiments, meta and
+    changelog. Saves only rewrite the affected days, in a single
+    transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (start, end) of the last load, when only some days were loaded
+        self.loaded_range = None
+        # Number of changelog rows as of the last load or save
+        self.changelog_rows = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS days (key TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, payload TEXT NOT NULL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS changelog (id INTEGER PRIMARY KEY, entry TEXT NOT NULL)")
+        # Databases from before queries have no data column; it is filled on save
+        if "data" not in [row[1] for row in connection.execute("PRAGMA table_info(days)")]:
+            connection.execute("ALTER TABLE days ADD COLUMN data TEXT")
+        return connection
+
+    def load(self, start=None, end=None, lazy=False):
+        """
+        Day payloads, from start to end (inclusive day keys), are returned
+        as JSON text, for LazyDay to parse on access
+        """
+        connection = self._connect()
+        try:
+            d = {name: json.loads(payload) for name, payload in
+                connection.execute("SELECT name, payload FROM documents")}
+            d["days"] = dict(connection.execute(
+                "SELECT key, payload FROM days WHERE key >= ? AND key <= ? ORDER BY key",
+                (start or "", end or "\uffff")))
+        finally:
+            connection.close()
+        self.loaded_range = None if start is None and end is None else (start, end)
+        return d
+
+    def load_changelog(self):
+        connection = self._connect()
+        try:
+            entries = [json.loads(entry) for entry, in
+                connection.execute("SELECT entry FROM changelog ORDER BY id")]
+        finally:
+            connection.close()
+        self.changelog_rows = len(entries)
+        return entries
+
+    def load_data(self, start=None, end=None, fields=None, sources=None):
+        """
+        (key, data) of the days from start to end in key order; the rest
+        of each payload is not read. Given fields and/or sources, SQLite
+        picks the fields they select (see AllData.query) out of each
+        day's data, and only those are returned.
+        """
+        if fields is not None or sources is not None:
+            return self._load_fields(start, end, fields, sources)
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT key, data, CASE WHEN data IS NULL THEN payload END FROM days "
+                "WHERE key >= ? AND key <= ? ORDER BY key", (start or "", end or "\uffff")).fetchall()
+        finally:
+            connection.close()
+        return [(k, json.loads(data) if data is not None else json.loads(payload).get("data", {})) \
+            for k, data, payload in rows]
+
+    def _load_fields(self, start, end, fields, sources):
+        fields = list(fields or [])
+        conditions = ["j.key IN (%s)"%", ".join("?" * len(fields))] if fields else []
+        params = list(fields)
+        for prefix in [str(source) for source in sources or []]:
+            conditions.append("j.key = ? OR substr(j.key, 1, ?) = ?")
+            params += [prefix, len(prefix) + 1, prefix + "_"]
+        # One row per selected field, with its value as SQLite has it;
+        # integers too large for SQLite are taken as they are written
+        query = (
+            "SELECT days.key, j.key, j.type, CASE WHEN j.type = 'integer' AND typeof(j.value) = 'real' "
+            "THEN json_extract(j.json, j.fullkey, j.fullkey) ELSE j.value END FROM days "
+            "LEFT JOIN json_each(COALESCE(days.data, json_extract(days.payload, '$.data'))) AS j ON %s "
+            "WHERE days.key >= ? AND days.key <= ? ORDER BY days.key, j.id"
+        )%(" OR ".join("(%s)"%c for c in conditions) or "0")
+        connection = self._connect()
+        try:
+            rows = connection.execute(query, params + [start or "", end or "\uffff"]).fetchall()
+        finally:
+            connection.close()
+        days = dict()
+        for k, name, kind, value in rows:
+            data = days.setdefault(k, {})
+            if name is not None:
+                data[name] = _json_each_value(kind, value)
+        return list(days.items())
+
+    def save(self, all_data, days_affected=None):
+        """
+        days_affected: keys of the days to write; None writes every day
+        """
+        days = all_data.dataset.days
+        keys = days.keys() if days_affected is None else days_affected
+        _check_loaded_range(self.loaded_range, keys)
+        rows = [(k, json.dumps(payload, ensure_ascii=False),
+            json.dumps(payload.get("data", {}), ensure_ascii=False)) \
+            for k, payload in _day_payloads(all_data, keys)]
+        documents = _documents(all_data)
+        start, end = self.loaded_range or (None, None)
+        rewrite, entries = _changelog_rows(all_data.changelog, self.changelog_rows)
+
+        connection = self._connect()
+        try:
+            with connection:
+                if days_affected is None:
+                    connection.execute("DELETE FROM days WHERE key >= ? AND key <= ?",
+                        (start or "", end or "\uffff"))
+                connection.executemany(
+                    "INSERT OR REPLACE INTO days (key, payload, data) VALUES (?, ?, ?)", rows)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO documents (name, payload) VALUES (?, ?)",
+                    [(k, json.dumps(v, ensure_ascii=False)) for k, v in documents.items()])
+                # Earlier versions kept the changelog as a document
+                connection.execute("DELETE FROM documents WHERE name = 'changelog'")
+                if rewrite:
+                    connection.execute("DELETE FROM changelog")
+                connection.executemany("INSERT INTO changelog (entry) VALUES (?)",
+                    [(json.dumps(e, ensure_ascii=False),) for e in entries])
+        finally:
+            connection.close()
+        self.changelog_rows = len(all_data.changelog.entries)
+
+
+def get_storage(db_target, indent=4):
+    """
+    Storage backend by file extension: .db, .sqlite and .sqlite3 files are
+    SQLite, .bmsnap files binary snapshots, anything else is JSON
+    (compressed for .gz and .zst, eg. db.json.gz); indent=None makes JSON
+    compact
+    """
+    if db_target.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteStorage(db_target)
+    if db_target.lower().endswith(SNAPSHOT_EXTENSIONS):
+        return SnapshotStorage(db_target)
+    return JsonStorage(db_target, indent=indent)
+
+
+def convert(source_target, db_target, indent=4):
+    """
+    Copy a database between backends, eg. to import or export JSON, to
+    compress or compact it, or to write a snapshot of it for fast startup
+    """
+    from .models import AllData
+
+    all_data = AllData.build(source_target, lazy=True)
+    all_data.storage = get_storage(db_target, indent=indent)
+    # Every day is new to the target
+    all_data.days_affected = None
+    all_data.save()
+    return len(all_data.dataset.days)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a bluemoon database between JSON and SQLite storage.")
+    parser.add_argument('source', type=str, help="Existing database to read.")
+    parser.add_argument('target', type=str,
+        help="Database to write; the extension picks the backend (.db for SQLite, .bmsnap for a binary snapshot), and .gz or .zst compresses JSON.")
+    parser.add_argument('--compact', action='store_true', default=False,
+        help="Flag that writes JSON without indentation")
+    opts = parser.parse_args()
+    print("Converted", convert(opts.source, opts.target, indent=None if opts.compact else 4), "days")
@@ -3,7 +3,7 @@
 import json
 import argparse
 
-from . import get_aggregate_data
+from . import get_aggregate_data, iter_aggregate_data
 from .data_sources import DataSource
 from .models import AllData
 from .add import bmdb_add_data
@@ -12,6 +12,14 @@ def test_get_aggregate_data(path_to_test_data):
     result = get_aggregate_data("%s/toggl*.csv"%path_to_test_data)
     assert (10, 14) == result.shape
 
+def test_iter_aggregate_data(path_to_test_data):
+    columns = DataSource.toggl.get_columns()
+    chunks = list(iter_aggregate_data("%s/toggl*.csv"%path_to_test_data,
+        chunksize=3, usecols=columns))
+    assert 4 == len(chunks) # 5 rows per file
+    assert 10 == sum(len(chunk) for chunk in chunks)
+    assert set(columns) == set(chunks[0].columns)
+
 def test_bmdb_add_data_toggl(path_to_test_data):
 
     db_target = "%s/test-sdb.json"%path_to_test_data
@@ -41,6 +49,7 @@ if __name__ == "__main__":
 
     # Test top-level utils
     test_get_aggregate_data(opts.path_to_test_data)
+    test_iter_aggregate_data(opts.path_to_test_data)
     test_bmdb_add_data_toggl(opts.path_to_test_data)
 
     print("ALL CLEAR!")
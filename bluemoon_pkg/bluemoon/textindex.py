@@ -0,0 +1,180 @@
+import re
+import numpy as np
+
+_TOKEN = re.compile(r"\w+")
+# Record ids are day ordinals shifted left by OFFSET_BITS, plus the offset
+# of the record within its day
+OFFSET_BITS = 20
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+def tokenize(text):
+    """
+    Lowercase words of text; anything that is not a str has none
+    """
+    return _TOKEN.findall(text.lower()) if isinstance(text, str) else []
+
+
+class TextIndex:
+    """
+    Inverted index of the Texts of cumulative records (eg. Toggl's project,
+    task, tags and description): for every field and token, the days (as
+    ordinals) and offsets of the records that mention it. Dataset.add and
+    Dataset.update keep it up to date for the days they change, and
+    AllData stores it with the database.
+    """
+
+    def __init__(self):
+        # field -> token -> ordinal -> record offsets
+        self.postings = dict()
+        # field -> ordinal -> tokens, to take a day out again; built on demand
+        self._day_tokens = None
+        # (field, token) -> sorted record ids, see _record_ids
+        self._ids = dict()
+
+    def _tokens_by_day(self):
+        if self._day_tokens is None:
+            self._day_tokens = dict()
+            for field, tokens in self.postings.items():
+                day_tokens = self._day_tokens[field] = dict()
+                for token, days in tokens.items():
+                    for ordinal in days:
+                        day_tokens.setdefault(ordinal, []).append(token)
+        return self._day_tokens
+
+    def remove_day(self, ordinal):
+        for field, day_tokens in self._tokens_by_day().items():
+            for token in day_tokens.pop(ordinal, ()):
+                days = self.postings[field][token]
+                del days[ordinal]
+                if not days:
+                    del self.postings[field][token]
+                self._ids.pop((field, token), None)
+
+    def add_day(self, day):
+        for field, records in day.cumulative.items():
+            tokens = self.postings.get(field)
+            for offset, record in enumerate(records):
+                texts = record.get("Texts") if hasattr(record, "get") else None
+                for token in set(tokenize(texts)):
+                    if tokens is None:
+                        tokens = self.postings[field] = dict()
+                    days = tokens.setdefault(token, dict())
+                    if day.ordinal not in days:
+                        days[day.ordinal] = []
+                        self._ids.pop((field, token), None)
+                        if self._day_tokens is not None:
+                            self._day_tokens.setdefault(field, dict()).setdefault(
+                                day.ordinal, []).append(token)
+                    days[day.ordinal].append(offset)
+
+    def set_day(self, day):
+        """
+        (Re)index a day whose records were added or changed
+        """
+        self.remove_day(day.ordinal)
+        self.add_day(day)
+
+    def keep(self, predicate):
+        """
+        Forget fields whose names do not satisfy predicate (eg. those that
+        are not saved)
+        """
+        self.postings = {k: v for k, v in self.postings.items() if predicate(k)}
+        self._day_tokens = None
+        self._ids = dict()
+
+    def _record_ids(self, field, token):
+        # Records that mention token as sorted ordinal << OFFSET_BITS | offset,
+        # kept until the token's days change
+        ids = self._ids.get((field, token))
+        if ids is None:
+            days = self.postings.get(field, {}).get(token)
+            if not days:
+                return None
+            ids = np.fromiter((o << OFFSET_BITS | offset for o, offsets in days.items() \
+                for offset in offsets), dtype=np.int64)
+            ids.sort()
+            self._ids[(field, token)] = ids
+        return ids
+
+    def _field_matches(self, query, field):
+        # Sorted ids of the records of field that mention every word of query
+        tokens = list(dict.fromkeys(tokenize(query)))
+        ids = [self._record_ids(field, t) for t in tokens]
+        if not ids or any(i is None for i in ids):
+            return np.zeros(0, dtype=np.int64)
+        ids.sort(key=len)
+        matches = ids[0]
+        for other in ids[1:]:
+            matches = np.intersect1d(matches, other, assume_unique=True)
+        return matches
+
+    def _fields(self, field):
+        return [field] if field is not None else list(self.postings)
+
+    def records(self, query, field=None):
+        """
+        (ordinal, field, offset) of every record that mentions all words of
+        query, by day
+        """
+        found = []
+        for f in self._fields(field):
+            ids = self._field_matches(query, f)
+            found.extend(zip((ids >> OFFSET_BITS).tolist(), [f] * len(ids),
+                (ids & OFFSET_MASK).tolist()))
+        return sorted(found)
+
+    def matches(self, query, field=None):
+        """
+        (ordinals, counts): the days with records that mention all words of
+        query, in date order, and how many records of each do
+        """
+        ordinals = np.concatenate([np.zeros(0, dtype=np.int64)] + \
+            [self._field_matches(query, f) >> OFFSET_BITS for f in self._fields(field)])
+        return np.unique(ordinals, return_counts=True)
+
+    def days(self, query, field=None):
+        """
+        Sorted ordinals of the days with a record that mentions all words of query
+        """
+        return self.matches(query, field)[0]
+
+    def counts(self, query, field=None):
+        """
+        Number of records that mention all words of query, by day ordinal
+        """
+        ordinals, counts = self.matches(query, field)
+        return dict(zip(ordinals.tolist(), counts.tolist()))
+
+    def count_array(self, query, ordinals, field=None):
+        """
+        counts for the days in ordinals, aligned with them (0 where none match)
+        """
+        matched, counts = self.matches(query, field)
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        result = np.zeros(len(ordinals), dtype=np.int64)
+        if len(matched):
+            i = np.minimum(np.searchsorted(matched, ordinals), len(matched) - 1)
+            found = matched[i] == ordinals
+            result[found] = counts[i[found]]
+        return result
+
+    def as_dict(self):
+        # Each day as [ordinal, offset, ...]; json object keys are strings
+        return dict(postings={field: {token: [[o] + offsets for o, offsets in days.items()] \
+            for token, days in tokens.items()} for field, tokens in self.postings.items()})
+
+    @classmethod
+    def from_dict(cls, d):
+        index = cls()
+        index.postings = {field: {token: {day[0]: day[1:] for day in days} \
+            for token, days in tokens.items()} for field, tokens in d.get("postings", {}).items()}
+        return index
+
+    @classmethod
+    def build(cls, days):
+        index = cls()
+        for day in days:
+            index.add_day(day)
+        return index
@@ -1,6 +1,41 @@
+import pickle
+import json
+import os
+import sys
+import time
+import subprocess
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import pandas as pd
 from bluemoon import get_aggregate_data
-from datetime import datetime
-from bluemoon.models import Day, Dataset
+from datetime import datetime, timedelta
+from bluemoon.models import Day, Dataset, AllData, record_digest
+from bluemoon import ephemeris
+from bluemoon.ephemeris import EphemerisIndex, ephem_moon, ephem_season
+from bluemoon.data_sources import DataSource
+from bluemoon import jsonstream
+from bluemoon.storage import convert, get_storage
+from bluemoon.add import bmdb_add_data, bmdb_add_batch, add_description, apply_datasets
+from bluemoon import service
+from bluemoon.benchmark import synthetic_oura, write_synthetic_lastfm
+from bluemoon import lastfm
+from bluemoon.analysis import exceptional_days, prioritize_columns, get_top_K, feature_matrix
+from bluemoon.stats import StatsCache
+from bluemoon.parse_cache import ParseCache
+from bluemoon.exist import sync_exist
+from bluemoon.textindex import TextIndex
+from bluemoon.instrument import Timings, listening, stage
+
+TEST_DATA = os.path.join(os.path.dirname(__file__), "data")
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Caches (eg. the ephemeris, parsed files) are kept out of ~/.cache
+    monkeypatch.setenv("BLUEMOON_CACHE_DIR", str(tmp_path / "bluemoon-cache"))
+    monkeypatch.setattr(ephemeris, "_index", None)
 
 def test_day_key():
     today = datetime.utcnow()
@@ -11,3 +46,786 @@ def test_day_key():
     assert d1.day_as_dt == d2.day_as_dt == d3.day_as_dt
     assert d1.day_as_str == d2.day_as_str == d3.day_as_str ==\
         d1.key == d2.key == d3.key
+
+def test_ephemeris_index_matches_ephem():
+    index = EphemerisIndex()
+    start = datetime(2019, 12, 20)
+    days, moon, season = index.moon_and_season(start, start + timedelta(days=60))
+    for i in range(0, 61, 3):
+        day_dt = start + timedelta(days=i)
+        assert index.moon(day_dt) == moon[i] == ephem_moon(day_dt)
+        assert index.season(day_dt) == season[i] == ephem_season(day_dt)
+
+def test_lazy_day_load():
+    payload = {"days": {"2018-05-07": {"data": {"*worklog": 8}, "cumulative": {}}}}
+    all_data = AllData()
+    all_data.from_dict(payload, lazy=True)
+    day = all_data.dataset.days["2018-05-07"]
+    assert not day.materialized
+    assert day.serialize() == payload["days"]["2018-05-07"]
+    assert not day.materialized
+    assert day.data["*worklog"] == 8
+    assert day.materialized
+
+def test_build_days_matches_build_day():
+    source = DataSource.toggl
+    df = get_aggregate_data(os.path.join(TEST_DATA, "toggl*.csv"),
+        usecols=source.get_columns(), dtype=source.get_dtypes())
+
+    by_row = Dataset()
+    for index, row in df.iterrows():
+        by_row.add(source.build_day(row), overwrite_fields=[])
+    by_day = Dataset()
+    for d in source.build_days(df):
+        by_day.add(d, overwrite_fields=[])
+
+    assert list(by_row.days) == list(by_day.days)
+    for key, d in by_row.days.items():
+        assert str(d.serialize()) == str(by_day.days[key].serialize())
+
+def test_sqlite_storage_matches_json(tmp_path):
+    data = os.path.join(TEST_DATA, "toggl*.csv")
+    json_target = str(tmp_path / "db.json")
+    sqlite_target = str(tmp_path / "db.sqlite")
+    for db_target in [json_target, sqlite_target]:
+        assert 4 == bmdb_add_data(db_target, DataSource.toggl, data, "test")
+        assert 4 == bmdb_add_data(db_target, DataSource.toggl, data, "test")
+
+    from_json = AllData.build(json_target).as_dict()
+    from_sqlite = AllData.build(sqlite_target).as_dict()
+    assert str(from_json) == str(from_sqlite)
+
+    exported = str(tmp_path / "exported.json")
+    assert 4 == convert(sqlite_target, exported)
+    assert str(AllData.build(exported).as_dict()) == str(from_json)
+
+def test_streaming_json_storage(tmp_path, monkeypatch):
+    source = os.path.join(TEST_DATA, "test-sdb.json")
+    expected = AllData.build(source).as_dict()
+    # Values cut off at every possible place by the end of a chunk
+    monkeypatch.setattr(jsonstream, "CHUNK_SIZE", 7)
+    for target, indent in [("db.json.gz", 4), ("db.json.zst", None), ("db.json", None)]:
+        convert(source, str(tmp_path / target), indent=indent)
+        assert AllData.build(str(tmp_path / target)).as_dict() == expected
+        assert AllData.build(str(tmp_path / target), lazy=True).as_dict() == expected
+    assert len((tmp_path / "db.json").read_text()) < os.path.getsize(source)
+
+    keys = sorted(expected["days"].keys())
+    # Fields picked out of each day's data, the others skipped
+    days = {"2018-05-0%d"%i: dict(data=data, cumulative={}) for i, data in enumerate([
+        {"*oura_a": 0.1 + 0.2, "*oura": 2**70, "*toggl_b": "x, \\\"}", "*toggl_c": [1, {"*oura_a": 2}], "d\u00e9": True},
+        {"*oura_b": None, "*ouraX": 3, "*toggl_b": {"e": [False]}, "d\u00e9": 1e-05},
+        {}], 1)}
+    for indent in [4, None]:
+        (tmp_path / "fields.json").write_text(json.dumps(dict(days=days), indent=indent))
+        convert(str(tmp_path / "fields.json"), str(tmp_path / "fields.sqlite"))
+        for target in ["fields.json", "fields.sqlite"]:
+            storage = get_storage(str(tmp_path / target))
+            for fields, sources in [(["*oura_a", "d\u00e9"], None), ([], None), (None, ["*oura"]),
+                    (["*toggl_b"], ["*toggl", "*fitbit"])]:
+                prefixes = tuple(source + "_" for source in sources or [])
+                selected = set(fields or []) | set(sources or [])
+                assert storage.load_data(fields=fields, sources=sources) == [(k, {name: value \
+                    for name, value in day["data"].items() if name in selected or name.startswith(prefixes)}) \
+                    for k, day in days.items()]
+
+    subset = AllData.build(str(tmp_path / "db.json.gz"), start=keys[1], end=keys[2])
+    assert sorted(subset.dataset.days.keys()) == keys[1:3]
+    subset.experiments["saved"] = True
+    subset.save(days_affected=None)
+    # Days outside the range are kept, in order
+    saved = AllData.build(str(tmp_path / "db.json.gz")).as_dict()
+    assert list(saved["days"].keys()) == keys
+    assert saved["days"] == expected["days"]
+    assert saved["experiments"]["saved"]
+
+def test_snapshot_storage(tmp_path):
+    data = os.path.join(TEST_DATA, "toggl*.csv")
+    db_target = str(tmp_path / "db.bmsnap")
+    assert 4 == bmdb_add_data(db_target, DataSource.toggl, data, "test")
+    assert 4 == bmdb_add_data(db_target, DataSource.toggl, data, "test")
+    json_target = str(tmp_path / "db.json")
+    convert(db_target, json_target)
+    assert AllData.build(db_target).as_dict() == AllData.build(json_target).as_dict()
+
+    # Values of every kind, with missing ones and explicit nulls
+    days = {"2018-05-0%d"%i: dict(data=data, cumulative={}) for i, data in enumerate([
+        {"*a": 1, "*b": 0.5, "*c": True, "*d": "x", "*e": [1, 2]},
+        {"*a": 2, "*b": 2, "*c": None, "*e": {"k": None}},
+        {"*b": float("nan"), "*d": None, "*f": 2**70}], 1)}
+    all_data = AllData(storage=get_storage(db_target))
+    all_data.from_dict(dict(days=days, meta=dict(note="kept")))
+    all_data.save()
+    loaded = AllData.build(db_target, lazy=True)
+    assert not any(day.materialized for day in loaded.dataset.days.values())
+    assert loaded.meta["note"] == "kept"
+    restored = loaded.dataset.days["2018-05-02"].serialize()
+    assert restored == days["2018-05-02"] and type(restored["data"]["*b"]) == int
+    assert loaded.dataset.days["2018-05-03"].data["*f"] == 2**70
+    arrays = AllData.query(db_target, fields=["*a", "*b", "*g"], end="2018-05-02", as_arrays=True)
+    # Views on the file, as long as nothing is missing
+    assert arrays["*a"].dtype == np.int64 and not arrays["*a"].flags.writeable
+    assert arrays["*b"].tolist() == [0.5, 2.0] and arrays["*g"].tolist() == [None, None]
+
+    # Without pandas (or ephem) until they are needed
+    code = "import sys, bluemoon.add; from bluemoon.models import AllData; " \
+        "AllData.query(%r, as_arrays=True); print(sorted({'pandas', 'ephem'} & set(sys.modules)))"%db_target
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert result.stdout.strip() == "[]", result.stderr
+
+def test_select_and_query(tmp_path):
+    synthetic_oura(10, start=datetime(2018, 5, 5)).to_csv(tmp_path / "oura.csv", index=False)
+    all_data = AllData()
+    for source, data in [(DataSource.toggl, os.path.join(TEST_DATA, "toggl*.csv")),
+            (DataSource.oura, str(tmp_path / "oura.csv"))]:
+        all_data.update(source.build_dataset(data), description=str(source))
+    all_data.dataset.set_ready(True)
+    keys = sorted(all_data.dataset.days.keys())
+    start, end = keys[1], keys[-2]
+
+    expected = all_data.dataset.asDataFrame().sort_values("day_str")
+    expected = expected[(expected.day_str >= start) & (expected.day_str <= end)]
+    selected = all_data.select(sources=[DataSource.oura], fields=["availability"], start=start, end=end)
+    oura_fields = [c for c in expected.columns if c.startswith(str(DataSource.oura))]
+    assert oura_fields and list(selected.columns) == ["day_dt", "day_str", "availability"] + oura_fields
+    assert list(selected.day_str) == list(expected.day_str)
+    for field in oura_fields:
+        assert selected[field].tolist() == expected[field].tolist()
+
+    all_data.dataset.enable_columnar()
+    columnar = all_data.select(sources=[DataSource.oura], start=start, end=end, as_arrays=True)
+    for field in oura_fields:
+        assert np.array_equal(columnar[field], selected[field].to_numpy(), equal_nan=True)
+
+    all_data.storage = get_storage(str(tmp_path / "db.json"))
+    all_data.save()
+    convert(str(tmp_path / "db.json"), str(tmp_path / "db.sqlite"))
+    convert(str(tmp_path / "db.json"), str(tmp_path / "db.bmsnap"))
+    for target in ["db.json", "db.sqlite", "db.bmsnap"]:
+        queried = AllData.query(str(tmp_path / target), sources=[DataSource.oura], start=start, end=end)
+        assert queried.equals(selected.drop(columns=["availability"]))
+        queried = AllData.query(str(tmp_path / target), fields=oura_fields[:0:-1], start=start, end=end)
+        assert queried.equals(selected[["day_dt", "day_str"] + oura_fields[:0:-1]])
+        # Only the selected fields are read from storage
+        storage = get_storage(str(tmp_path / target))
+        if target == "db.bmsnap":
+            assert list(storage.load_columns(start, end, fields=oura_fields[:1])[2]) == oura_fields[:1]
+        assert [set(d) for k, d in storage.load_data(start, end, sources=[DataSource.oura])] == \
+            [set(oura_fields)] * len(selected)
+        assert [set(d) for k, d in storage.load_data(start, end, fields=oura_fields[:1])] == \
+            [set(oura_fields[:1])] * len(selected)
+    # Straight from the snapshot's arrays
+    arrays = AllData.query(str(tmp_path / "db.bmsnap"), sources=[DataSource.oura], start=start, end=end,
+        as_arrays=True)
+    for field in oura_fields:
+        assert np.array_equal(arrays[field], columnar[field], equal_nan=True)
+
+def test_changelog_segment(tmp_path):
+    db_target = tmp_path / "db.json"
+    # A database whose changelog still lists every affected day
+    db_target.write_text(open(os.path.join(TEST_DATA, "test-sdb.json")).read())
+    legacy = json.loads(db_target.read_text())["changelog"]
+    all_data = AllData.build(str(db_target))
+    assert all_data.changelog[0]["ranges"] == [["2018-05-07", "2018-05-08"], ["2018-05-11", "2018-05-12"]]
+    all_data.save()
+    assert json.loads(db_target.read_text())["changelog"] == {"segment": "db.json.changelog", "entries": 1}
+
+    for description in ["nightly", "nightly"]:
+        all_data = AllData.build(str(db_target))
+        all_data.changelog.append(["2018-05-08", "2018-05-09"], description, day="2021-02-01")
+        all_data.save()
+    assert 3 == len(open(str(db_target) + ".changelog").readlines())
+
+    all_data = AllData.build(str(db_target))
+    assert [e["description"] for e in all_data.changelog.touched("2018-05-08")] == \
+        [legacy[0]["description"], "nightly", "nightly"]
+    assert [] == all_data.changelog.touched(datetime(2018, 5, 10))
+    all_data.meta["changelog_policy"] = dict(compact=True)
+    all_data.save()
+    # Compaction merges the nightly runs and rewrites the segment
+    all_data = AllData.build(str(db_target))
+    assert 2 == len(all_data.changelog) == len(open(str(db_target) + ".changelog").readlines())
+    assert 2 == all_data.changelog[1]["runs"]
+
+    convert(str(db_target), str(tmp_path / "db.sqlite"))
+    assert AllData.build(str(tmp_path / "db.sqlite")).changelog.entries == all_data.changelog.entries
+
+    # Keeping no entries is a policy too
+    result = subprocess.run([sys.executable, "-m", "bluemoon.changelog", str(tmp_path / "db.sqlite"),
+        "--max_entries", "0", "--keep_policy"], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(__file__)))
+    assert "Removed 2 entries" in result.stdout, result.stderr
+    all_data = AllData.build(str(tmp_path / "db.sqlite"))
+    assert 0 == len(all_data.changelog) and all_data.meta["changelog_policy"] == dict(max_entries=0)
+
+def test_exceptional_days():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"f%d"%i: rng.normal(size=400) for i in range(20)})
+    df = df.mask(rng.random(df.shape) < 0.2)
+    df["day_str"] = ["d%d"%i for i in range(len(df))]
+    df["repeated"] = [1, 2] * 195 + list(range(10))
+    df.loc[123, ["f3", "f7"]] = 12
+    result = exceptional_days(df)
+    assert result.sort_values("score").day_str.iloc[-1] == "d123"
+    assert result.exceptional[123] and set(result.reasons[123][:2]) == {"f3", "f7"}
+    assert result.exceptional.sum() < 10
+
+    assert "repeated" not in prioritize_columns(df, max_items=30, cutoff=100)
+    # Calendar columns are not features, however much they vary
+    calendar = df.assign(days_before=np.arange(len(df)), weekday_num=np.arange(len(df)) % 7,
+        moon=rng.random(len(df)), availability=rng.random(len(df)))
+    assert prioritize_columns(calendar, max_items=30) == prioritize_columns(df, max_items=30)
+    reasons = set().union(*exceptional_days(calendar, max_features=3).reasons)
+    assert reasons and reasons <= prioritize_columns(df, max_items=3)
+    assert get_top_K({"sleep": 5, "sleep score": 6, "hr": 3, "hrv": 4}, 2,
+        verbose=False, hide_shadowed=True) == {"sleep", "hrv"}
+
+def test_incremental_stats_match_rebuild(tmp_path):
+    all_data = AllData()
+    all_data.storage = get_storage(str(tmp_path / "db.json"))
+    # Overlapping imports: the second changes days the first added
+    for n, start in [(10, datetime(2018, 5, 5)), (10, datetime(2018, 5, 10))]:
+        synthetic_oura(n, start=start).to_csv(tmp_path / "oura.csv", index=False)
+        all_data.update(DataSource.oura.build_dataset(str(tmp_path / "oura.csv")), "oura")
+    all_data.update(DataSource.toggl.build_dataset(os.path.join(TEST_DATA, "toggl*.csv")), "toggl")
+    all_data.save()
+
+    stats = AllData.build(str(tmp_path / "db.json")).statistics()
+    expected = StatsCache.build(all_data.dataset.days.values())
+    assert stats.days == expected.days == 15 and stats.derived >= {str(DataSource.toggl)}
+    assert stats.fields.keys() == expected.fields.keys()
+    for field_name, f in expected.fields.items():
+        assert (stats.fields[field_name].n, stats.fields[field_name].counts) == (f.n, f.counts)
+        assert np.allclose([stats.fields[field_name].mean, stats.fields[field_name].m2],
+            [f.mean, f.m2]), field_name
+
+    all_data.dataset.set_ready(True)
+    # Fields derived by analyses are left to set_ready
+    df = all_data.dataset.asDataFrame()
+    assert "*toggl_duration" in df and "*toggl_duration" not in stats.fields
+    # and taken from df, rather than dropped
+    assert prioritize_columns(df, max_items=30, stats=stats) == prioritize_columns(df, max_items=30)
+    X, _, columns, _ = feature_matrix(df, stats=stats)
+    expected_X, _, expected_columns, _ = feature_matrix(df)
+    assert "*toggl_duration" in columns and columns == expected_columns
+    assert np.allclose(X, expected_X, atol=1e-5)
+    df = df[["day_str"] + list(stats.fields)]
+    assert prioritize_columns(df, max_items=5) == prioritize_columns(None, max_items=5, stats=stats)
+
+def test_text_index_follows_updates(tmp_path):
+    all_data = AllData()
+    all_data.storage = get_storage(str(tmp_path / "db.json"))
+    all_data.update(DataSource.toggl.build_dataset(os.path.join(TEST_DATA, "toggl-1.csv")), "toggl")
+    all_data.update(DataSource.toggl.build_dataset(os.path.join(TEST_DATA, "toggl*.csv")), "toggl")
+    dataset = all_data.dataset
+    assert dataset.search("react") == ["2018-05-07", "2018-05-08"]
+    assert dataset.search("German class") == ["2018-05-07"] and dataset.search("German react") == []
+    field = str(DataSource.toggl)
+    ordinal, _, offset = dataset.text_index.records("voice", field)[0]
+    assert dataset.days["2018-05-07"].cumulative[field][offset]["Project"] == "Voice / German"
+
+    # A new export replaces the records of a day
+    export = tmp_path / "toggl.csv"
+    lines = open(os.path.join(TEST_DATA, "toggl-2.csv")).read().splitlines()
+    export.write_text("\n".join([lines[0], lines[1].replace("React", "Vue")]) + "\n")
+    all_data.update(DataSource.toggl.build_dataset(str(export)), "toggl")
+    assert dataset.search("react") == ["2018-05-07"] and dataset.search("vue") == ["2018-05-08"]
+    assert dataset.text_index.postings == TextIndex.build(dataset.days.values()).postings
+
+    all_data.save()
+    convert(str(tmp_path / "db.json"), str(tmp_path / "db.sqlite"))
+    for target in ["db.json", "db.sqlite"]:
+        loaded = AllData.build(str(tmp_path / target), lazy=True, start="2018-05-08")
+        assert loaded.dataset.search("react") == ["2018-05-07"]
+    loaded.dataset.set_ready(True)
+    df = loaded.dataset.asDataFrame(text_features=["vue", "wage labor"]).set_index("day_str")
+    assert df["text_vue"].to_dict() == {"2018-05-08": 1, "2018-05-11": 0, "2018-05-12": 0}
+    assert loaded.dataset.asDataFrame(text_features={"paid": "wage labor"}, as_bool=True)["paid"].sum() == 1
+
+def test_columnar_dataframe_matches_rows():
+    source = DataSource.toggl
+    datasets = [Dataset(today=datetime(2018, 6, 1)),
+        Dataset(today=datetime(2018, 6, 1), columnar=True)]
+    for ds in datasets:
+        for d in source.build_days(get_aggregate_data(os.path.join(TEST_DATA, "toggl*.csv"))):
+            ds.add(d, overwrite_fields=[])
+        ds.add_dataset_analysis(str(source), source.get_accumulator())
+        ds.set_ready(True)
+
+    by_row, by_column = [ds.asDataFrame() for ds in datasets]
+    assert set(by_row.columns) == set(by_column.columns)
+    for column in by_row.columns:
+        assert list(by_row[column]) == list(by_column[column])
+
+def test_availability_and_days_before():
+    ds = Dataset(today=datetime(2020, 1, 10))
+    for day in [3, 1, 2, 5]:
+        ds.add(Day(year=2020, month=1, day=day), overwrite_fields=True)
+    ds.set_ready(True)
+    availability = {k: d.data["availability"] for k, d in ds.days.items()}
+    assert availability == {
+        "2020-01-01": 1 + 1/3, "2020-01-02": 1 + 1/3 + 1/3,
+        "2020-01-03": 1 + 1/3, "2020-01-05": 1}
+    assert ds.days["2020-01-05"].data["days_before"] == 5
+
+def test_incremental_set_ready_matches_full():
+    source = DataSource.toggl
+    today = datetime(2018, 6, 1)
+    first = Dataset(today=today)
+    for day in [1, 2, 5, 9]:
+        first.add(Day(year=2018, month=5, day=day), overwrite_fields=True)
+    first.set_ready(True)
+
+    new_data = Dataset(today=today)
+    for d in source.build_days(get_aggregate_data(os.path.join(TEST_DATA, "toggl*.csv"))):
+        new_data.add(d, overwrite_fields=[])
+    new_data.add_dataset_analysis(str(source), source.get_accumulator())
+    days_affected = first.update(new_data)
+    assert first.ready
+
+    full = Dataset(today=today)
+    for d in first.days.values():
+        full.add(d, overwrite_fields=True)
+    full.add_dataset_analysis(str(source), source.get_accumulator())
+    incremental = {k: dict(d.data) for k, d in first.days.items()}
+    full.set_ready(True)
+    for k, d in full.days.items():
+        assert incremental[k] == d.data, k
+
+def test_parallel_build_matches_serial():
+    source = DataSource.toggl
+    data = os.path.join(TEST_DATA, "toggl*.csv")
+    serial = source.build_dataset(data)
+    parallel = source.build_dataset(data, workers=3)
+    assert list(parallel.days.keys()) == list(serial.days.keys())
+
+    serial.set_ready(True)
+    parallel.set_ready(True, workers=3)
+    for k, d in serial.days.items():
+        assert parallel.days[k].data == d.data, k
+        # Records came back from worker processes, where NaN != NaN
+        assert {f: [record_digest(r) for r in rs] for f, rs in parallel.days[k].cumulative.items()} \
+            == {f: [record_digest(r) for r in rs] for f, rs in d.cumulative.items()}, k
+
+def test_overlapping_exports_are_deduplicated(tmp_path):
+    source = DataSource.toggl
+    data = os.path.join(TEST_DATA, "toggl*.csv")
+    db_target = str(tmp_path / "db.json")
+    bmdb_add_data(db_target, source, data, "test")
+
+    overlapping = source.build_dataset(os.path.join(TEST_DATA, "toggl-1.csv"))
+    all_data = AllData.build(db_target)
+    for d in overlapping.days.values():
+        all_data.dataset.add(d, overwrite_fields=False)
+    assert 10 == all_data.dataset.count_cumulative_entries(str(source))
+    # Digests are not stored, but computed again on load
+    assert "Digest" not in open(db_target).read()
+
+    # Records stored by earlier versions, without Minutes
+    all_data = AllData.build(os.path.join(TEST_DATA, "test-sdb.json"))
+    n_stored = all_data.dataset.count_cumulative_entries(str(source))
+    for d in overlapping.days.values():
+        all_data.dataset.add(d, overwrite_fields=False)
+    assert n_stored == all_data.dataset.count_cumulative_entries(str(source))
+
+def test_parse_cache_skips_unchanged_files(tmp_path):
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    for name in ["toggl-1.csv", "toggl-2.csv"]:
+        (exports / name).write_text(open(os.path.join(TEST_DATA, name)).read())
+    data = str(exports / "toggl*.csv")
+    digests = lambda ds: {k: [record_digest(r) for r in d.cumulative[str(DataSource.toggl)]] \
+        for k, d in ds.days.items()}
+
+    cache = ParseCache(str(tmp_path / "cache"))
+    expected = DataSource.toggl.build_dataset(data)
+    assert digests(DataSource.toggl.build_dataset(data, parse_cache=cache)) == digests(expected)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    # A new export, with the rows of an old one and one more
+    lines = (exports / "toggl-2.csv").read_text().splitlines()
+    (exports / "toggl-3.csv").write_text("\n".join(lines + [lines[-1].replace("Revision", "Review")]) + "\n")
+    cache = ParseCache(str(tmp_path / "cache"))
+    ds = DataSource.toggl.build_dataset(data, parse_cache=cache)
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert sum(map(len, digests(ds).values())) == 11
+
+    cache.max_bytes = max(os.path.getsize(p) for p in (tmp_path / "cache").glob("*.pickle"))
+    DataSource.toggl.build_dataset(str(exports / "toggl-1.csv"), parse_cache=cache)
+    assert cache.evict() == 2 and len(list((tmp_path / "cache").glob("*.pickle"))) == 1
+    # The entry used last is kept
+    assert cache.get(DataSource.toggl, str(exports / "toggl-1.csv")) is not None
+
+class _ExistStandIn(BaseHTTPRequestHandler):
+    # Serves server.history, {attribute: {day key: value}}, as Exist.io does
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, query, self.headers["Authorization"]))
+        attribute = url.path.rstrip("/").split("/")[-1]
+        if attribute == "attributes":
+            body = [dict(attribute=a) for a in self.server.history]
+        elif query.get("page") == "2" and not self.server.limited:
+            self.server.limited = True
+            return self._send(429, {}, {"Retry-After": "0"})
+        elif query.get("page") == "3" and getattr(self.server, "stalls", 0):
+            # Never answers, so the client times out
+            self.server.stalls -= 1
+            time.sleep(0.5)
+            self.close_connection = True
+            return
+        else:
+            limit, page = int(query["limit"]), int(query["page"])
+            days = sorted(k for k in self.server.history[attribute] if k >= query.get("date_min", ""))
+            body = dict(count=len(days), results=[dict(date=k, value=self.server.history[attribute][k]) \
+                for k in reversed(days)][(page - 1) * limit:page * limit])
+        self._send(200, body)
+
+    def _send(self, status, body, headers={}):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        for k, v in dict(headers, **{"Content-Length": len(content)}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+def test_exist_incremental_sync(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ExistStandIn)
+    server.daemon_threads = True
+    server.connections, server.requests, server.limited = 0, [], False
+    days = [(datetime(2020, 1, 1) + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(250)]
+    server.history = dict(steps={k: 1000 + i for i, k in enumerate(days)},
+        mood={k: i % 9 for i, k in enumerate(days[-30:])})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config = tmp_path / "exist.json"
+        config.write_text(json.dumps(dict(token="secret", base_url="http://127.0.0.1:%d"%server.server_port)))
+        db_target = str(tmp_path / "db.json")
+        assert 250 == bmdb_add_data(db_target, DataSource.exist, str(config), "exist")
+        assert server.limited and server.connections <= 4
+        assert {auth for _, _, auth in server.requests} == {"Bearer secret"}
+
+        server.requests = []
+        server.history["steps"]["2020-09-07"] = 5
+        server.history["mood"]["2020-09-06"] = 1
+        assert 2 == bmdb_add_data(db_target, DataSource.exist, str(config), "exist")
+        # Only the days since the last sync are fetched
+        assert {q.get("date_min") for _, q, _ in server.requests if "page" in q} == {"2020-09-06"}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    all_data = AllData.build(db_target)
+    assert all_data.meta["sync_cursors"][str(DataSource.exist)] == dict(steps="2020-09-07", mood="2020-09-06")
+    assert all_data.dataset.days["2020-01-01"].data["*exist_steps"] == 1000
+    assert all_data.dataset.days["2020-09-06"].data["*exist_mood"] == 1
+    assert "*exist_mood" not in all_data.dataset.days["2020-01-01"].data
+
+def test_exist_retries_timed_out_requests():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ExistStandIn)
+    server.daemon_threads = True
+    server.connections, server.requests, server.limited, server.stalls = 0, [], True, 2
+    days = [(datetime(2020, 1, 1) + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(250)]
+    server.history = dict(steps={k: i for i, k in enumerate(days)})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        histories = sync_exist("secret", ["steps"], base_url="http://127.0.0.1:%d"%server.server_port,
+            max_connections=1, backoff=0.01, timeout=0.2)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert histories["steps"] == sorted(server.history["steps"].items())
+    assert [q["page"] for _, q, _ in server.requests].count("3") == 3
+
+def test_exist_token_is_not_stored(tmp_path):
+    config = tmp_path / "exist.json"
+    config.write_text(json.dumps(dict(token="secret")))
+    args = ["db.json", "--data_source", "*exist", "--data", "secret", "--data_source", "*exist", "--data", str(config)]
+    sources = [(DataSource.exist, "secret"), (DataSource.exist, str(config))]
+    assert add_description(args, sources) == \
+        ".add db.json --data_source *exist --data <redacted> --data_source *exist --data %s"%config
+    assert add_description(["db.json", "--data=secret"], sources[:1]) == ".add db.json --data=<redacted>"
+
+    # Nor in the description of each source of a batch
+    datasets = [Dataset(), Dataset()]
+    for i, ds in enumerate(datasets):
+        d = Day(year=2020, month=1, day=1 + i)
+        d.set_value("*exist_steps", 1000)
+        ds.add(d, overwrite_fields=[])
+    all_data = AllData.build(str(tmp_path / "db.json"))
+    apply_datasets(all_data, sources, datasets, ".add")
+    assert [e["description"] for e in all_data.changelog] == \
+        [".add [*exist <redacted>]", ".add [*exist %s]"%config]
+
+def test_lastfm_streams_into_day_aggregates(tmp_path, monkeypatch):
+    export = str(tmp_path / "lastfm.csv")
+    write_synthetic_lastfm(export, 3000, 20, start=datetime(2019, 3, 1))
+    scrobbles = pd.read_csv(export, header=None, names=lastfm.COLUMNS)
+    played = pd.to_datetime(scrobbles.played, format="%d %b %Y %H:%M")
+    by_day = scrobbles.groupby(played.dt.strftime("%Y-%m-%d"))
+
+    # Chunks end within days, so their aggregates are merged
+    monkeypatch.setattr(lastfm, "CHUNK_SIZE", 128)
+    store = str(tmp_path / "scrobbles.sqlite")
+    ds = DataSource.lastfm.build_dataset(export, scrobble_store=store)
+    field = str(DataSource.lastfm)
+    assert sorted(ds.days) == sorted(by_day.groups)
+    for key, rows in by_day:
+        record, = ds.days[key].cumulative[field]
+        assert record["Plays"] == len(rows) and record["Artists"] == sorted(rows.artist.unique())
+        assert record["Hours"] == np.bincount(played[rows.index].dt.hour, minlength=24).tolist()
+
+    assert 0 == lastfm.ScrobbleStore(store).add(lastfm.parse_scrobbles(scrobbles))
+    stored = lastfm.ScrobbleStore(store).scrobbles(start="2019-03-02", end="2019-03-02")
+    assert len(stored) == len(scrobbles.drop_duplicates()[played.dt.strftime("%Y-%m-%d") == "2019-03-02"])
+
+    db_target = str(tmp_path / "db.json")
+    assert 20 == bmdb_add_data(db_target, DataSource.lastfm, export, "lastfm")
+    all_data = AllData.build(db_target)
+    all_data.dataset.add_dataset_analysis(field, DataSource.lastfm.get_accumulator())
+    all_data.dataset.set_ready(True)
+    df = all_data.dataset.asDataFrame().set_index("day_str")
+    assert df["*last.fm_plays"].to_dict() == by_day.size().to_dict()
+    assert df["*last.fm_artists"].to_dict() == by_day.artist.nunique().to_dict()
+
+def test_lastfm_overlapping_exports_count_scrobbles_once(tmp_path):
+    export = str(tmp_path / "lastfm.csv")
+    write_synthetic_lastfm(export, 2000, 10, start=datetime(2019, 3, 1))
+    with open(export) as f:
+        lines = f.readlines()
+    # Two exports sharing a third of the scrobbles, and a re-export of the first that has grown
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    (exports / "lastfm-1.csv").write_text("".join(lines[:1400]))
+    (exports / "lastfm-2.csv").write_text("".join(lines[700:]))
+    (exports / "lastfm-3.csv").write_text("".join(lines[:1500]))
+    scrobbles = pd.read_csv(export, header=None, names=lastfm.COLUMNS)
+    played = pd.to_datetime(scrobbles.played, format="%d %b %Y %H:%M").dt.strftime("%Y-%m-%d")
+    expected = scrobbles.drop_duplicates(["artist", "track", "played"]).groupby(played).size().to_dict()
+
+    data, field = str(exports / "*.csv"), str(DataSource.lastfm)
+    cache = ParseCache(str(tmp_path / "cache"))
+    for ds in [DataSource.lastfm.build_dataset(data),
+            DataSource.lastfm.build_dataset(data, parse_cache=cache),
+            DataSource.lastfm.build_dataset(data, parse_cache=cache)]:
+        assert {k: sum(r["Plays"] for r in d.cumulative[field]) for k, d in ds.days.items()} == expected
+    assert cache.hits == 3
+
+def test_lastfm_parse_cache_keeps_compact_scrobbles(tmp_path, monkeypatch):
+    export = str(tmp_path / "lastfm.csv")
+    write_synthetic_lastfm(export, 3000, 20, start=datetime(2019, 3, 1))
+    field = str(DataSource.lastfm)
+    records = lambda ds: {k: [r.as_dict() for r in d.cumulative[field]] for k, d in ds.days.items()}
+    expected = records(DataSource.lastfm.build_dataset(export))
+
+    # Parsed in chunks, of which only the compact form is kept, and cached
+    monkeypatch.setattr(lastfm, "CHUNK_SIZE", 128)
+    cache = ParseCache(str(tmp_path / "cache"))
+    assert records(DataSource.lastfm.build_dataset(export, parse_cache=cache)) == expected
+    assert records(DataSource.lastfm.build_dataset(export, parse_cache=cache)) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+    parsed, rows = cache.get(DataSource.lastfm, export)
+    assert isinstance(parsed, lastfm.CompactScrobbles) and rows == 3000
+    assert len(parsed) == len(pd.read_csv(export, header=None, names=lastfm.COLUMNS).drop_duplicates())
+    assert 0 < cache.size() < 24 * rows
+
+    # An entry larger than the whole cache is not kept
+    small = ParseCache(str(tmp_path / "small"), max_bytes=1000)
+    assert records(DataSource.lastfm.build_dataset(export, parse_cache=small)) == expected
+    assert small.size() == 0
+
+def test_compact_records_read_like_dicts(tmp_path):
+    schema = DataSource.toggl.get_record_schema()
+    record = schema.record(dict(Project="Wage Labor", Duration="00:59:15", Minutes=59))
+    assert record["Project"] == record.get("Project") == "Wage Labor"
+    assert record.get("Tags") is None and record.get("Missing", 0) == 0
+    assert dict(record) == record.as_dict()
+    assert pickle.loads(pickle.dumps(record)).as_dict() == record.as_dict()
+    assert not hasattr(Day(year=2020, month=1, day=1), "__dict__")
+
+    # Stored records are compact again once loaded, and saved as they were
+    field = str(DataSource.toggl)
+    for db_target in [str(tmp_path / "db.json"), str(tmp_path / "db.bmsnap")]:
+        bmdb_add_data(db_target, DataSource.toggl, os.path.join(TEST_DATA, "toggl*.csv"), "test")
+        with open(db_target, 'rb') as f:
+            stored = f.read()
+        for lazy in [False, True]:
+            all_data = AllData.build(db_target, lazy=lazy)
+            records = [r for d in all_data.dataset.days.values() for r in d.cumulative[field]]
+            assert len(records) == 10 and all(isinstance(r, schema.record_class) for r in records)
+            projects = [r["Project"] for r in records if r["Project"] == "Wage Labor"]
+            assert len(projects) > 1 and all(p is projects[0] for p in projects)
+            all_data.save(days_affected=None)
+            with open(db_target, 'rb') as f:
+                assert f.read() == stored
+
+def test_add_reports_stages(tmp_path):
+    timings = Timings()
+    with listening(timings):
+        bmdb_add_data(str(tmp_path / "db.json"), DataSource.toggl,
+            os.path.join(TEST_DATA, "toggl*.csv"), "test")
+    stages = {e["name"]: e for e in timings.breakdown()}
+    assert stages["bmdb_add_data"]["depth"] == 0
+    assert stages["build_dataset.toggl"]["rows"] == 10
+    assert stages["build_dataset.toggl"]["days"] == 4
+    assert stages["analysis.*toggl"]["parent"] == "Dataset.set_ready"
+    assert "AllData.save" in stages
+
+    # Same counts when the files come from the parse cache
+    cache = ParseCache(str(tmp_path / "cache"))
+    for _ in range(2):
+        timings = Timings()
+        with listening(timings):
+            DataSource.toggl.build_dataset(os.path.join(TEST_DATA, "toggl*.csv"), parse_cache=cache)
+        stages = {e["name"]: e for e in timings.breakdown()}
+        assert stages["build_dataset.toggl"]["rows"] == 10
+        assert stages["build_dataset.toggl"]["days"] == 4
+
+def test_stages_nest_within_their_thread():
+    timings = Timings()
+    started = threading.Barrier(2)
+    def run(name):
+        with stage(name):
+            started.wait()
+            with stage(name + ".inner"):
+                started.wait()
+    with listening(timings):
+        threads = [threading.Thread(target=run, args=(name,)) for name in ("a", "b")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    stages = {e["name"]: e for e in timings.breakdown()}
+    assert stages["a"]["depth"] == stages["b"]["depth"] == 0
+    assert stages["a"]["parent"] is None and stages["b"]["parent"] is None
+    assert stages["a.inner"]["parent"] == "a" and stages["b.inner"]["parent"] == "b"
+    assert [e["name"] for e in timings.breakdown()] in \
+        (["a", "a.inner", "b", "b.inner"], ["b", "b.inner", "a", "a.inner"])
+
+def test_add_batch_saves_once_with_changelog_per_source(tmp_path):
+    worklog = tmp_path / "worklog.json"
+    worklog.write_text(json.dumps({"first_day": "2018-05-01", "last_day": "2018-05-10",
+        "working_days": "MTWRF", "working_hours": 8, "exceptions": {}}))
+    db_target = str(tmp_path / "db.json")
+    n_updates = bmdb_add_batch(db_target, [
+        (DataSource.toggl, os.path.join(TEST_DATA, "toggl*.csv")),
+        (DataSource.worklog, str(worklog))], "test", max_workers=2)
+    assert [4, 10] == n_updates
+
+    all_data = AllData.build(db_target)
+    assert 2 == len(all_data.changelog)
+    assert 10 == all_data.dataset.count_cumulative_entries(str(DataSource.toggl))
+    assert 8 == all_data.dataset.days["2018-05-07"].data[str(DataSource.worklog)]
+
+def test_service_ingests_new_files(tmp_path):
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    db_target = str(tmp_path / "db.sqlite")
+    now = [0.0]
+    ingest = service.IngestService(db_target, [(DataSource.toggl, str(exports / "toggl*.csv"))],
+        save_delay=5, max_save_delay=60, clock=lambda: now[0])
+    server = ingest.serve(str(tmp_path / "db.sock"))
+    try:
+        (exports / "toggl-1.csv").write_bytes(open(os.path.join(TEST_DATA, "toggl-1.csv"), 'rb').read())
+        # Only once the file has not changed for a poll
+        assert 0 == ingest.poll()
+        assert 0 < ingest.poll()
+        assert service.request(str(tmp_path / "db.sock"), "status")["unsaved"]
+        now[0] += 5
+        ingest.poll()
+        assert not ingest.status()["unsaved"]
+
+        (exports / "toggl-2.csv").write_bytes(open(os.path.join(TEST_DATA, "toggl-2.csv"), 'rb').read())
+        # Written again, as if not finished before
+        (exports / "toggl-1.csv").write_bytes(open(os.path.join(TEST_DATA, "toggl-1.csv"), 'rb').read())
+        os.utime(exports / "toggl-1.csv", ns=(1, 1))
+        ingest.poll()
+        assert service.request(str(tmp_path / "db.sock"), "poll")["updates"] > 0
+        assert [] == ingest.changed_files()
+        selected = service.request(str(tmp_path / "db.sock"), "select", fields=["*toggl_ct"])
+        assert 10 == sum(selected["*toggl_ct"])
+        assert service.request(str(tmp_path / "db.sock"), "search", query="react")
+    finally:
+        stop = threading.Event()
+        stop.set()
+        # Saves on the way out
+        ingest.run(stop=stop)
+        server.shutdown()
+        server.server_close()
+
+    expected = str(tmp_path / "expected.sqlite")
+    bmdb_add_data(expected, DataSource.toggl, os.path.join(TEST_DATA, "toggl*.csv"), "test")
+    assert AllData.build(db_target).as_dict()["days"] == AllData.build(expected).as_dict()["days"]
+    # Files ingested before a restart are not ingested again
+    restarted = service.IngestService(db_target, ingest.watches, settle=0)
+    assert 0 == restarted.poll()
+
+def test_service_on_database_of_earlier_versions(tmp_path):
+    # Records stored without Minutes (or a Digest) match their new copies
+    db_target = tmp_path / "db.json"
+    db_target.write_text(open(os.path.join(TEST_DATA, "test-sdb.json")).read())
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    (exports / "toggl-1.csv").write_bytes(open(os.path.join(TEST_DATA, "toggl-1.csv"), 'rb').read())
+    field = str(DataSource.toggl)
+    stored = {k: len(d.cumulative[field]) for k, d in AllData.build(str(db_target)).dataset.days.items()}
+    ingest = service.IngestService(str(db_target), [(DataSource.toggl, str(exports / "toggl*.csv"))], settle=0)
+    ingest.poll()
+    days = ingest.all_data.dataset.days
+    assert {k: len(d.cumulative[field]) for k, d in days.items()} == stored
+
+    # The days of the file are redone as built from all the exports
+    expected = DataSource.toggl.build_dataset(os.path.join(TEST_DATA, "toggl*.csv"))
+    expected.set_ready(True)
+    for k in DataSource.toggl.build_dataset(str(exports / "toggl-1.csv")).days:
+        assert days[k].data["*toggl_duration"] == expected.days[k].data["*toggl_duration"]
+
+def test_service_merges_lastfm_aggregates(tmp_path):
+    export = str(tmp_path / "lastfm.csv")
+    write_synthetic_lastfm(export, 600, 5, start=datetime(2020, 1, 1))
+    with open(export) as f:
+        lines = f.readlines()
+    exports = tmp_path / "exports"
+    exports.mkdir()
+    db_target = str(tmp_path / "db.sqlite")
+    # Added from a file the service does not watch
+    (tmp_path / "other.csv").write_text("".join(lines[450:]))
+    bmdb_add_data(db_target, DataSource.lastfm, str(tmp_path / "other.csv"), "other")
+    cache = ParseCache(str(tmp_path / "cache"))
+    ingest = service.IngestService(db_target, [(DataSource.lastfm, str(exports / "lastfm*.csv"))],
+        settle=0, parse_cache=cache)
+    field = str(DataSource.lastfm)
+    def plays():
+        return {k: sum(r["Plays"] for r in d.cumulative[field]) \
+            for k, d in ingest.all_data.dataset.days.items()}
+
+    (exports / "lastfm-1.csv").write_text("".join(lines[:300]))
+    assert 0 < ingest.poll()
+    # The export grows, and another one overlaps it and the other file
+    with open(exports / "lastfm-1.csv", 'a') as f:
+        f.write("".join(lines[300:400]))
+    os.utime(exports / "lastfm-1.csv", ns=(1, 1))
+    assert 0 < ingest.poll()
+    (exports / "lastfm-2.csv").write_text("".join(lines[200:500]))
+    assert 0 < ingest.poll()
+    ingest.save()
+    # Only the file that changed is parsed each time
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    expected = str(tmp_path / "expected.sqlite")
+    bmdb_add_data(expected, DataSource.lastfm, export, "test")
+    all_data = AllData.build(expected)
+    assert plays() == {k: sum(r["Plays"] for r in d.cumulative[field]) \
+        for k, d in all_data.dataset.days.items()}
+    assert sum(plays().values()) == 600
+    assert AllData.build(db_target).as_dict()["days"] == all_data.as_dict()["days"]